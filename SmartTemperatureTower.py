@@ -10,12 +10,47 @@
 #
 
 import argparse
+from array import array
+import bisect
+import concurrent.futures
 import configparser
+import contextlib
+import cProfile
+import csv
+import gzip
+import hashlib
+import http.client
+import http.server
+import itertools
+import json
+import math
+import mmap
 from os.path import isfile,isdir
 import os
 import re
+import shutil
+import socketserver
+import struct
 import subprocess
 import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import zlib
+
+# Locks on files: fcntl on POSIX, msvcrt on Windows
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+# NumPy is optional. If present, STL data is processed vectorized on a memory map.
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 ### Defaults section
 
@@ -24,7 +59,22 @@ cmdOpenScad = "C:\\Program Files\\OpenSCAD\\openscad.com"
 cmdPrusaSlicer = "C:\\Program Files\\Prusa3D\\PrusaSlicer\\prusa-slicer-console.exe"
 
 # Open Prusa-Slicer -> Help -> Show Configuration Folder
-iniPSD = os.environ["APPDATA"]+"\\PrusaSlicer"
+iniPSD = os.environ.get("APPDATA", "")+"\\PrusaSlicer"
+
+# Directory for cached intermediate results and its size limit in MB
+cacheDir = "STT_Cache"
+cacheMaxSize = 500
+
+# Cache entries not used for this many days are removed
+cacheMaxAge = 30
+
+# Config bundles used within this many seconds are never evicted, as a
+# Prusa-Slicer process (of this or another run) may still be loading them
+configBundleMinAge = 3600
+
+# Directory for intermediate files (tower STL, sliced G-code). A RAM-backed
+# tmpfs keeps them off the disk; without one, the current directory is used.
+scratchDir = "/dev/shm" if isdir("/dev/shm") and os.access("/dev/shm", os.W_OK) else "."
 
 # All required data files we need to build a Calibration Tower
 requiredFiles = {
@@ -33,8 +83,205 @@ requiredFiles = {
     "stlStand": "SmartTemperatureTower_Stand.stl"
 }
 
+# Geometry of the tower (parameters of parameterized_STTMod.scad): height of a
+# floor in mm, scale of the footprint and the floor variant ("full" or "quick",
+# which keeps only the overhang and the bridge). Set by the command line.
+towerGeometry = {"floor_height": 10.0, "xy_scale": 1.0, "variant": "full"}
+standardGeometry = dict(towerGeometry)
+
+# Geometry of --quick (each value can be changed by its own option)
+quickGeometry = {"floor_height": 6.0, "xy_scale": 0.8, "variant": "quick"}
+
 ### Functions
 
+# Lock the whole file f exclusively, waits until it is free
+def lockFile(f):
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        return
+    f.seek(0)
+    while True:
+        try:
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+            return
+        except OSError:
+            pass
+
+# Release a lock of lockFile
+def unlockFile(f):
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+        return
+    f.seek(0)
+    msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+# Re-entrant lock of the cache for threads and processes: the outermost
+# acquire of a thread also locks the file "lock" in cacheDir, so several runs
+# can share one cache.
+class CacheLock:
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.depth = 0
+        self.file = None
+
+    def __enter__(self):
+        self.lock.acquire()
+        if self.depth == 0:
+            try:
+                os.makedirs(cacheDir, exist_ok=True)
+                self.file = open(os.path.join(cacheDir, "lock"), 'a+b')
+                lockFile(self.file)
+            except BaseException:
+                if self.file is not None:
+                    self.file.close()
+                    self.file = None
+                self.lock.release()
+                raise
+        self.depth += 1
+        return(self)
+
+    def __exit__(self, *exc):
+        self.depth -= 1
+        if self.depth == 0:
+            unlockFile(self.file)
+            self.file.close()
+            self.file = None
+        self.lock.release()
+
+# Serializes cache updates of concurrent batch jobs and other processes
+cacheLock = CacheLock()
+
+# Write a file atomically: yields a temporary name next to filename, which
+# replaces filename if the block succeeds and is removed otherwise. A layer
+# index sidecar file (.idx) written for the temporary name is moved as well.
+@contextlib.contextmanager
+def atomicOutput(filename):
+    partial = "{}.{}-{}.part".format(filename, os.getpid(), threading.get_ident())
+    try:
+        yield(partial)
+        if isfile(partial + ".idx"):
+            os.replace(partial + ".idx", filename + ".idx")
+        os.replace(partial, filename)
+    finally:
+        for f in (partial, partial + ".idx"):
+            if isfile(f):
+                os.remove(f)
+
+# Error of an external tool. The message is the tool's output.
+class ToolError(Exception):
+    pass
+
+# Slicer profile not found
+class ProfileError(Exception):
+    def __init__(self, kind, path):
+        Exception.__init__(self, path)
+        self.kind = kind
+        self.path = path
+
+# Stage instrumentation (--timings, --trace, --profile). While enabled, each
+# timedStage() appends a record with wall time, CPU time and peak RSS of the
+# child processes it ran and the bytes read and written by the process.
+stageTiming = {"enabled": False, "records": [], "profiler": None, "profileDepth": 0}
+stageLock = threading.Lock()
+stageStack = threading.local()
+
+# Read/written bytes of this process (Linux only, zeros elsewhere)
+def getIOCounters():
+    counters = {"rchar": 0, "wchar": 0}
+    try:
+        with open("/proc/self/io", 'r') as f:
+            for line in f:
+                name, value = line.split(":")
+                if name in counters:
+                    counters[name] = int(value)
+    except (OSError, ValueError):
+        pass
+    return(counters)
+
+# Record a stage. With --profile, stages of the main thread run under cProfile
+# (worker threads of the batch mode are not profiled).
+@contextlib.contextmanager
+def timedStage(name):
+    if not stageTiming["enabled"]:
+        yield
+        return
+    record = {"name": name, "tid": threading.get_ident(), "childCPU": 0.0, "childMaxRSS": 0,
+              "childRead": 0, "childWritten": 0}
+    stack = stageStack.__dict__.setdefault("stack", [])
+    stack.append(record)
+    profiler = stageTiming["profiler"]
+    if threading.current_thread() is not threading.main_thread():
+        profiler = None
+    io = getIOCounters()
+    record["start"] = time.perf_counter()
+    if profiler is not None:
+        if stageTiming["profileDepth"] == 0:
+            profiler.enable()
+        stageTiming["profileDepth"] += 1
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            stageTiming["profileDepth"] -= 1
+            if stageTiming["profileDepth"] == 0:
+                profiler.disable()
+        record["wall"] = time.perf_counter() - record["start"]
+        ioAfter = getIOCounters()
+        record["read"] = ioAfter["rchar"] - io["rchar"]
+        record["written"] = ioAfter["wchar"] - io["wchar"]
+        stack.pop()
+        with stageLock:
+            stageTiming["records"].append(record)
+
+# Add the resource usage of a finished child process to all running stages of this thread
+def recordChildUsage(usage):
+    for record in getattr(stageStack, "stack", []):
+        record["childCPU"] += usage.ru_utime + usage.ru_stime
+        # ru_maxrss is in KB on Linux, in bytes on macOS
+        rss = usage.ru_maxrss if sys.platform == "darwin" else usage.ru_maxrss * 1024
+        record["childMaxRSS"] = max(record["childMaxRSS"], rss)
+        record["childRead"] += usage.ru_inblock * 512
+        record["childWritten"] += usage.ru_oublock * 512
+
+# Run a process and return a CompletedProcess with its (combined) output as text.
+# Where possible, its resource usage is added to the running stages.
+def runProcess(cmd):
+    if not stageTiming["enabled"] or not hasattr(os, "wait4"):
+        return(subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True))
+    with subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True) as proc:
+        output = proc.stdout.read()
+        pid, status, usage = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+    recordChildUsage(usage)
+    return(subprocess.CompletedProcess(cmd, proc.returncode, output))
+
+# Print the table of recorded stages
+def printTimings():
+    records = sorted(stageTiming["records"], key=lambda r: r["start"])
+    print()
+    print("{:<24} {:>9} {:>10} {:>10} {:>10} {:>10}".format(
+          "Stage", "Wall [s]", "Child CPU", "Child RSS", "Read", "Written"))
+    for r in records:
+        print("{:<24} {:>9.3f} {:>9.3f}s {:>8.1f}MB {:>8.1f}MB {:>8.1f}MB".format(
+              r["name"], r["wall"], r["childCPU"], r["childMaxRSS"] / 1024 / 1024,
+              (r["read"] + r["childRead"]) / 1024 / 1024, (r["written"] + r["childWritten"]) / 1024 / 1024))
+    print()
+
+# Write the recorded stages as Chrome/Perfetto trace (chrome://tracing, ui.perfetto.dev)
+def writeTrace(filename):
+    events = []
+    if stageTiming["records"]:
+        t0 = min(r["start"] for r in stageTiming["records"])
+    for r in stageTiming["records"]:
+        events.append({
+            "name": r["name"], "cat": "stage", "ph": "X", "pid": os.getpid(), "tid": r["tid"],
+            "ts": (r["start"] - t0) * 1e6, "dur": r["wall"] * 1e6,
+            "args": {"childCPU_s": r["childCPU"], "childMaxRSS_bytes": r["childMaxRSS"],
+                     "read_bytes": r["read"] + r["childRead"], "written_bytes": r["written"] + r["childWritten"]}
+        })
+    with open(filename, 'w') as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
 # Get option from ini file. If not present or empty, use default
 def getOpt(iniSect, name, default):
     if name in iniSect and iniSect[name] != "":
@@ -50,13 +297,2449 @@ def checkRequiredFiles():
             return(0)
     return(1)
 
-# Determine Z-size of a STL
-def getSTLZSize(filename):
+# Calculate the SHA-256 of a file's content. Hashes are kept in memory as long
+# as size and mtime of the file are unchanged (for long running processes).
+fileHashes = {}
+def fileHash(filename):
+    st = os.stat(filename)
+    statKey = (os.path.abspath(filename), st.st_size, st.st_mtime_ns)
+    if statKey in fileHashes:
+        return(fileHashes[statKey])
+    h = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    fileHashes[statKey] = h.hexdigest()
+    return(fileHashes[statKey])
+
+# Binary STL: 80 byte header, uint32 triangle count, then 50 byte records
+# (normal, 3 vertices, attribute). Only the vertex Z values are of interest here.
+stlZRecord = struct.Struct("<20xf8xf8xf2x")
+stlVertexRe = re.compile(rb'vertex\s+\S+\s+\S+\s+(\S+)')
+stlFacetRe = re.compile(rb'(?:normal|vertex)\s+(\S+)\s+(\S+)\s+(\S+)')
+stlTriangle = struct.Struct("<12f2x")
+if numpy is not None:
+    stlDtype = numpy.dtype([('normal', '<f4', (3,)), ('vertex', '<f4', (3, 3)), ('attr', '<u2')])
+
+# A STL is binary if its size matches the triangle count in the header.
+# (ASCII detection by "solid" is not reliable, some exporters write it into binary headers)
+def isBinarySTL(filename):
+    size = os.path.getsize(filename)
+    if size < 84:
+        return(False)
+    with open(filename, 'rb') as f:
+        f.seek(80)
+        count = struct.unpack("<I", f.read(4))[0]
+    return(size == 84 + 50 * count)
+
+# Get lowest and highest Z of all vertices of a STL
+def getSTLZRange(filename):
+    if os.path.getsize(filename) == 0:
+        return(0.0, 0.0)
+    with open(filename, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        if isBinarySTL(filename):
+            count = struct.unpack_from("<I", mm, 80)[0]
+            if count == 0:
+                return(0.0, 0.0)
+            if numpy is not None:
+                tri = numpy.frombuffer(mm, dtype=stlDtype, count=count, offset=84)
+                z = tri['vertex'][:, :, 2]
+                zmin, zmax = float(z.min()), float(z.max())
+                del tri, z  # release the exported buffer before the mmap closes
+                return(zmin, zmax)
+            view = memoryview(mm)[84:84 + 50 * count]
+            z = array('f', [v for rec in stlZRecord.iter_unpack(view) for v in rec])
+            view.release()
+        else:
+            z = array('f', [float(m.group(1)) for m in stlVertexRe.finditer(mm)])
+    if len(z) == 0:
+        return(0.0, 0.0)
+    return(min(z), max(z))
+
+# Load all triangles of a STL as flat float32 data, 12 values per triangle
+# (normal, 3 vertices). Returns a (n, 12) NumPy array, or an array('f') without NumPy.
+def loadSTLMesh(filename):
+    if isBinarySTL(filename):
+        with open(filename, 'rb') as f:
+            data = f.read()
+        count = struct.unpack_from("<I", data, 80)[0]
+        if numpy is not None:
+            tri = numpy.frombuffer(data, dtype=stlDtype, count=count, offset=84)
+            return(numpy.hstack((tri['normal'], tri['vertex'].reshape(-1, 9))))
+        return(array('f', [v for rec in stlTriangle.iter_unpack(memoryview(data)[84:]) for v in rec]))
+    with open(filename, 'rb') as f:
+        data = f.read()
+    mesh = array('f', [float(v) for m in stlFacetRe.finditer(data) for v in m.groups()])
+    if numpy is not None:
+        return(numpy.frombuffer(mesh, dtype='<f4').reshape(-1, 12))
+    return(mesh)
+
+# Store a mesh as raw float32 data, so it can be memory mapped later
+def saveMesh(mesh, filename):
+    with open(filename + ".tmp", 'wb') as f:
+        if numpy is not None:
+            numpy.ascontiguousarray(mesh, dtype='<f4').tofile(f)
+        else:
+            mesh.tofile(f)
+    os.replace(filename + ".tmp", filename)
+
+# Map a mesh stored with saveMesh()
+def mapMesh(filename):
+    if numpy is not None:
+        if os.path.getsize(filename) == 0:
+            return(numpy.zeros((0, 12), dtype='<f4'))
+        return(numpy.memmap(filename, dtype='<f4', mode='r').reshape(-1, 12))
+    mesh = array('f')
+    with open(filename, 'rb') as f:
+        mesh.frombytes(f.read())
+    return(mesh)
+
+# Concatenate meshes, each shifted by its Z offset: [(mesh, dz), ...].
+# All of them are moved by dx, dy in XY.
+def joinMeshes(parts, dx=0, dy=0):
+    if numpy is not None:
+        mesh = numpy.concatenate([part for part, dz in parts])
+        start = 0
+        for part, dz in parts:
+            mesh[start:start + len(part), 5::3] += dz
+            start += len(part)
+        if dx or dy:
+            mesh[:, 3::3] += dx
+            mesh[:, 4::3] += dy
+        return(mesh)
+    mesh = array('f')
+    for part, dz in parts:
+        shifted = array('f', part)
+        for i in range(0, len(shifted), 12):
+            shifted[i + 5] += dz
+            shifted[i + 8] += dz
+            shifted[i + 11] += dz
+            if dx or dy:
+                for j in (3, 6, 9):
+                    shifted[i + j] += dx
+                    shifted[i + j + 1] += dy
+        mesh.extend(shifted)
+    return(mesh)
+
+# Get the XY bounding box of a mesh as (xmin, xmax, ymin, ymax)
+def getMeshXYRange(mesh):
+    if numpy is not None:
+        return((float(mesh[:, 3::3].min()), float(mesh[:, 3::3].max()),
+                float(mesh[:, 4::3].min()), float(mesh[:, 4::3].max())))
+    xs = [mesh[i::12] for i in (3, 6, 9)]
+    ys = [mesh[i::12] for i in (4, 7, 10)]
+    return((min(map(min, xs)), max(map(max, xs)), min(map(min, ys)), max(map(max, ys))))
+
+# Write a mesh as ASCII STL, like OpenSCAD does
+def writeSTLMeshASCII(mesh, filename):
+    rows = [mesh[12 * i:12 * i + 12] for i in range(len(mesh) // 12)] if numpy is None else mesh
+    with open(filename, 'w') as f:
+        f.write("solid OpenSCAD_Model\n")
+        for row in rows:
+            f.write("  facet normal %g %g %g\n    outer loop\n" % tuple(row[0:3]))
+            for v in range(3):
+                f.write("      vertex %g %g %g\n" % tuple(row[3 + 3 * v:6 + 3 * v]))
+            f.write("    endloop\n  endfacet\n")
+        f.write("endsolid OpenSCAD_Model\n")
+
+# Write a mesh as binary STL
+def writeSTLMesh(mesh, filename):
+    with open(filename, 'wb') as f:
+        f.write(b"SmartTemperatureTower".ljust(80, b" "))
+        if numpy is not None:
+            tri = numpy.zeros(len(mesh), dtype=stlDtype)
+            tri['normal'] = mesh[:, 0:3]
+            tri['vertex'] = mesh[:, 3:12].reshape(-1, 3, 3)
+            f.write(struct.pack("<I", len(tri)))
+            tri.tofile(f)
+        else:
+            count = len(mesh) // 12
+            f.write(struct.pack("<I", count))
+            for i in range(count):
+                f.write(stlTriangle.pack(*mesh[12 * i:12 * i + 12]))
+
+# Convert an ASCII STL to binary STL, which is a fraction of the size and much
+# faster to parse for Prusa-Slicer. Returns the size of the ASCII STL, or None
+# if the file was binary already.
+def convertSTLToBinary(filename):
+    if isBinarySTL(filename):
+        return(None)
+    with timedStage("convert STL"):
+        size = os.path.getsize(filename)
+        writeSTLMesh(loadSTLMesh(filename), filename + ".tmp")
+        os.replace(filename + ".tmp", filename)
+        return(size)
+
+# Arguments for OpenSCAD to write binary STL. Versions without --export-format
+# reject them; those are remembered in openScadBinary and run without.
+openScadBinaryArgs = [ "--export-format", "binstl" ]
+openScadBinary = {}
+
+# Run OpenSCAD with args, asking for binary STL. Returns the CompletedProcess.
+def runOpenScad(args):
+    if openScadBinary.get(cmdOpenScad, True):
+        rc = runProcess([ cmdOpenScad, *openScadBinaryArgs, *args ])
+        if rc.returncode == 0 or "export-format" not in rc.stdout:
+            return(rc)
+        openScadBinary[cmdOpenScad] = False
+    return(runProcess([ cmdOpenScad, *args ]))
+
+# OpenSCAD -D arguments of the tower geometry, none for the standard geometry
+def geometryDefines():
+    defines = []
+    for name, value in towerGeometry.items():
+        if value != standardGeometry[name]:
+            defines += [ "-D", name + "=" + ("\"" + value + "\"" if isinstance(value, str) else "%g" % value) ]
+    return(defines)
+
+# Use another tower geometry within a with block
+@contextlib.contextmanager
+def useGeometry(geometry):
+    saved = dict(towerGeometry)
+    towerGeometry.update(geometry)
+    try:
+        yield
+    finally:
+        towerGeometry.update(saved)
+
+# Height of a floor in mm: the floor STL scaled to the floor height of the geometry
+def getFloorHeight():
+    return(float(getSTLZSize(requiredFiles["stlFloor"])) * towerGeometry["floor_height"] / 10)
+
+# Cache key of a tower STL rendered by OpenSCAD
+def towerSTLKey(tfirst, tlast, tstep):
+    return(cacheKey("stl", tfirst, tlast, tstep,
+                    fileHash(requiredFiles["scadFile"]), fileHash(requiredFiles["stlFloor"]),
+                    fileHash(requiredFiles["stlStand"]), getToolVersion(cmdOpenScad), *geometryDefines()) + ".stl")
+
+# Render a single part of the tower with OpenSCAD. Returns the CompletedProcess.
+def renderPart(part, temp, filename):
+    return(runOpenScad( [ "-o", filename,
+                          "-D", "part=\"" + part + "\"", "-D", "tfirst=" + str(temp),
+                          *geometryDefines(), requiredFiles["scadFile"] ] ))
+
+# Floor library entry of a part ("floor" or "base"). The library
+# is bound to the hashes of the input files and the OpenSCAD version.
+def partEntry(part, temp=0):
+    libKey = cacheKey("floors", fileHash(requiredFiles["scadFile"]), fileHash(requiredFiles["stlFloor"]),
+                      fileHash(requiredFiles["stlStand"]), getToolVersion(cmdOpenScad), *geometryDefines())[:16]
+    return(os.path.join(cacheDir, "floors", "{}-{}-{}.f32".format(libKey, part, temp)))
+
+# Render a part with OpenSCAD and store it in the floor library. OpenSCAD runs
+# outside of the cache lock, so several parts can be rendered at the same time.
+def renderPartEntry(part, temp, entry):
+    stlTemp = os.path.join(scratchDir, "CT_Part-{}-{}-{}-{}.stl".format(os.getpid(), threading.get_ident(), part, temp))
+    try:
+        rc = renderPart(part, temp, stlTemp)
+        if rc.returncode != 0:
+            raise ToolError(rc.stdout)
+        mesh = loadSTLMesh(stlTemp)
+    finally:
+        if isfile(stlTemp):
+            os.remove(stlTemp)
+    os.makedirs(os.path.dirname(entry), exist_ok=True)
+    with cacheLock:
+        saveMesh(mesh, entry)
+
+# Get a pre-rendered part from the floor library. Missing parts are rendered
+# once with OpenSCAD.
+def getPartMesh(part, temp=0):
+    entry = partEntry(part, temp)
+    with cacheLock:
+        if isfile(entry):
+            os.utime(entry)
+            return(mapMesh(entry))
+    renderPartEntry(part, temp, entry)
+    with cacheLock:
+        return(mapMesh(entry))
+
+# Render the parts (list of (part, temp)) missing in the floor library with up
+# to workers OpenSCAD processes at the same time. Returns the number rendered.
+def renderParts(parts, workers=1):
+    missing = [(part, temp, partEntry(part, temp)) for part, temp in dict.fromkeys(parts)]
+    missing = [(part, temp, entry) for part, temp, entry in missing if not isfile(entry)]
+    if missing:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+            for future in [pool.submit(renderPartEntry, *args) for args in missing]:
+                future.result()
+    return(len(missing))
+
+# Check the temperatures of a tower: the step must not be 0 and must lead from
+# tfirst to tlast, as the M104 commands use it with its sign. Raises ValueError.
+def checkTempRange(tfirst, tlast, tstep):
+    if tstep == 0:
+        raise ValueError("the temperature step must not be 0")
+    if (tlast - tfirst) * tstep < 0:
+        raise ValueError("the temperature step {} does not lead from {} to {} (use {})".format(
+                         tstep, tfirst, tlast, -tstep))
+
+# Get the floor temperatures the same way parameterized_STTMod.scad does
+def getFloorTemps(tfirst, tlast, tstep):
+    tstep1 = -abs(tstep) if tfirst > tlast else abs(tstep)
+    floors = int(abs((tfirst - tlast) / tstep1)) + 1
+    if floors < 2:
+        return([])
+    return([tfirst + i * tstep1 for i in range(floors)])
+
+# Parts of a tower with their Z offsets: one floor per temperature label. The
+# lowest one is the "base", the stand united with the first floor by OpenSCAD, as
+# the stand overlaps it. The floors above only touch at their top and bottom faces.
+def towerParts(tfirst, tlast, tstep):
+    parts = []
+    for i, temp in enumerate(getFloorTemps(tfirst, tlast, tstep)):
+        parts.append(("base" if i == 0 else "floor", temp, towerGeometry["floor_height"] * i))
+    return(parts)
+
+# Build the tower STL out of pre-rendered parts (same result as parameterized_STTMod.scad).
+# Missing parts are rendered by up to workers OpenSCAD processes in parallel
+# first. Returns the number of parts rendered.
+def buildTowerNative(tfirst, tlast, tstep, filename, workers=1):
+    parts = towerParts(tfirst, tlast, tstep)
+    rendered = renderParts([(part, temp) for part, temp, z in parts], workers)
+    writeSTLMesh(joinMeshes([(getPartMesh(part, temp), z) for part, temp, z in parts]), filename)
+    return(rendered)
+
+# Determine Z-size of a STL (formatted like Prusa-Slicer's "--info" output).
+# Results are cached by the file's content hash. With stlZSizeStore disabled
+# (--no-cache), they are only kept in memory, not read from or written to
+# the cache directory.
+stlZSizeCache = {}
+stlZSizeStore = {"enabled": True}
+def getSTLZSize(filename, useCache=True):
+    if not useCache:
+        with timedStage("STL info"):
+            zmin, zmax = getSTLZRange(filename)
+        return("%f" % (zmax - zmin))
+
+    digest = fileHash(filename)
+    if not stlZSizeStore["enabled"]:
+        if digest not in stlZSizeCache:
+            stlZSizeCache[digest] = getSTLZSize(filename, useCache=False)
+        return(stlZSizeCache[digest])
+
+    cacheFile = os.path.join(cacheDir, "stlinfo.json")
+    if not stlZSizeCache:
+        stlZSizeCache.update(loadJSON(cacheFile))
+
+    with cacheLock:
+        if digest not in stlZSizeCache:
+            stlZSizeCache[digest] = getSTLZSize(filename, useCache=False)
+            saveJSON(cacheFile, stlZSizeCache)
+    return(stlZSizeCache[digest])
+
+# Get the version string of an external tool (first line of the output of
+# the given option). The result is cached as long as the executable itself
+# is unchanged.
+toolVersions = {}
+def getToolVersion(cmd, option="--version"):
+    st = os.stat(cmd)
+    toolKey = "{}|{}|{}".format(cmd, st.st_mtime_ns, st.st_size)
+    if toolKey in toolVersions:
+        return(toolVersions[toolKey])
+    versionFile = os.path.join(cacheDir, "versions.json")
+    with cacheLock:
+        versions = loadJSON(versionFile)
+        if toolKey not in versions:
+            sp = runProcess([cmd, option])
+            versions[toolKey] = (sp.stdout.strip().splitlines() or [""])[0]
+            saveJSON(versionFile, versions)
+        toolVersions[toolKey] = versions[toolKey]
+    return(versions[toolKey])
+
+# Read a JSON file, return an empty dict if missing or broken
+def loadJSON(filename):
+    try:
+        with open(filename, 'r') as f:
+            return(json.load(f))
+    except (OSError, ValueError):
+        return({})
+
+# Write a JSON file. Failing to write cache metadata is not fatal.
+def saveJSON(filename, data):
+    try:
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(filename + ".tmp", 'w') as f:
+            json.dump(data, f, indent=1)
+        os.replace(filename + ".tmp", filename)
+    except OSError:
+        pass
+
+# Build a cache key out of all inputs that influence a result
+def cacheKey(*parts):
+    return(hashlib.sha256(json.dumps(parts).encode()).hexdigest())
+
+# Count cache hits and misses per cache area
+def cacheCount(area, hit):
+    statsFile = os.path.join(cacheDir, "stats.json")
+    with cacheLock:
+        stats = loadJSON(statsFile)
+        counter = stats.setdefault(area, {"hits": 0, "misses": 0})
+        counter["hits" if hit else "misses"] += 1
+        saveJSON(statsFile, stats)
+
+# Copy a cached result to target. Returns False on a cache miss.
+# A hit refreshes the entry's mtime, which is used as LRU timestamp.
+# The entry is opened under the lock, so an eviction by another process
+# cannot remove it before it is copied.
+def cacheGet(area, key, target, compressed=False):
+    entry = os.path.join(cacheDir, area, key)
+    with cacheLock:
+        if not isfile(entry):
+            cacheCount(area, False)
+            return(False)
+        os.utime(entry)
+        f = open(entry, 'rb')
+    with f, open(target, 'wb') as dst:
+        src = gzip.open(f, 'rb') if compressed else f
+        shutil.copyfileobj(src, dst, gcodeChunkSize)
+    cacheCount(area, True)
+    return(True)
+
+# Store a result in the cache and evict old entries if the cache gets too big
+def cachePut(area, key, source, compressed=False):
+    entry = os.path.join(cacheDir, area, key)
+    os.makedirs(os.path.dirname(entry), exist_ok=True)
+    # Threads and processes may store the same entry at the same time
+    tmp = "{}.{}-{}.tmp".format(entry, os.getpid(), threading.get_ident())
+    if compressed:
+        with open(source, 'rb') as src, gzip.open(tmp, 'wb', compresslevel=6) as dst:
+            shutil.copyfileobj(src, dst, gcodeChunkSize)
+    else:
+        shutil.copyfile(source, tmp)
+    with cacheLock:
+        os.replace(tmp, entry)
+        cacheEvict()
+
+# List all cache entries as (mtime, size, path)
+def cacheEntries():
+    entries = []
+    if not isdir(cacheDir):
+        return(entries)
+    for area in os.listdir(cacheDir):
+        areaDir = os.path.join(cacheDir, area)
+        if not isdir(areaDir):
+            continue
+        for name in os.listdir(areaDir):
+            if name.endswith(".tmp"):
+                continue  # still being written
+            try:
+                st = os.stat(os.path.join(areaDir, name))
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, os.path.join(areaDir, name)))
+    return(entries)
+
+# Remove entries not used for cacheMaxAge days, then least recently used
+# entries until the cache fits into cacheMaxSize. Config bundles used within
+# configBundleMinAge seconds are kept (getConfigBundle touches them on use).
+def cacheEvict():
+    entries = sorted(cacheEntries())
+    total = sum(e[1] for e in entries)
+    limit = int(cacheMaxSize) * 1024 * 1024
+    now = time.time()
+    oldest = now - float(cacheMaxAge) * 86400
+    configDir = os.path.join(cacheDir, "config")
+    for mtime, size, path in entries:
+        if total <= limit and mtime >= oldest:
+            break
+        if mtime > now - configBundleMinAge and os.path.dirname(path) == configDir:
+            continue
+        try:
+            os.remove(path)
+        except OSError:
+            continue  # in use (Windows)
+        total -= size
+
+# Print cache usage and hit rates
+def printCacheStats():
+    stats = loadJSON(os.path.join(cacheDir, "stats.json"))
+    entries = cacheEntries()
+    print()
+    print("Cache directory: " + os.path.abspath(cacheDir))
+    print("Size limit:      {} MB".format(cacheMaxSize))
+    print("Max. age:        {} days".format(cacheMaxAge))
+    print()
+    print("{:<10} {:>8} {:>12} {:>8} {:>8}".format("Area", "Entries", "Size (MB)", "Hits", "Misses"))
+    areas = sorted(set(stats.keys()) | set(os.path.basename(os.path.dirname(e[2])) for e in entries))
+    for area in areas:
+        inArea = [e for e in entries if os.path.basename(os.path.dirname(e[2])) == area]
+        counter = stats.get(area, {"hits": 0, "misses": 0})
+        print("{:<10} {:>8} {:>12.1f} {:>8} {:>8}".format(area, len(inArea),
+              sum(e[1] for e in inArea) / 1024 / 1024, counter["hits"], counter["misses"]))
+    print()
+
+# Layer markers inserted by Prusa-Slicer (--before-layer-gcode). The pattern
+# starts with a literal, so the regex engine can search it quickly. That the
+# marker starts a line is checked separately.
+layerMarkerRe = re.compile(rb';CT_LAYER:([0-9]+)$', re.M)
+
+# Z of a layer: Prusa-Slicer's ;Z: comment of the layer change or a move with Z
+zCommentRe = re.compile(rb'\n;Z:([-0-9.]+)\n')
+zMoveRe = re.compile(rb'^G[01] [^;\n]*Z([-0-9.]+)', re.M)
+
+# Block size for reading G-code that cannot be memory mapped (e.g. pipes)
+gcodeChunkSize = 4 * 1024 * 1024
+
+# Create the M104 schedule: returns a function, which is called with the number
+# and Z of each ;CT_LAYER marker and returns the G-code to insert after it (or None).
+# The first change is at firstChange, so the bottom layers use the default temp.
+# Further changes are every floorLayer layers.
+def tempChanges(startTemp, tempStep, floorLayer, firstChange=2):
+    state = {"nextChange": firstChange, "nextTemp": startTemp}
+    def onLayer(layer, z):
+        if layer != state["nextChange"]:
+            return(None)
+        gcode = b"M104 S%d\n" % state["nextTemp"]
+        if state["nextChange"] == firstChange:
+            state["nextChange"] = floorLayer
+        else:
+            state["nextChange"] += floorLayer
+        state["nextTemp"] += tempStep
+        return(gcode)
+    return(onLayer)
+
+# G-code of the floor transforms, called with the value of the floor. fan is
+# given in percent, retract is the firmware retraction length (M207, only used
+# with G10/G11 retraction), pa the pressure advance factor (M900 K).
+floorTransforms = {
+    "temp": lambda value: b"M104 S%d\n" % round(value),
+    "fan": lambda value: b"M106 S%d\n" % round(min(max(value, 0), 100) * 2.55),
+    "flow": lambda value: b"M221 S%d\n" % round(value),
+    "retract": lambda value: b"M207 S%.2f\n" % value,
+    "pa": lambda value: b"M900 K%.3f\n" % value
+}
+
+# Parse a transform given as NAME=START:STEP[:EVERY[:COUNT]]. The value starts
+# at START and changes by STEP every EVERY floors. With COUNT, it starts over
+# after COUNT values (fan=0:100:1:2 alternates the fan between 0 and 100%).
+def parseTransform(text):
+    name, sep, values = text.partition("=")
+    fields = values.split(":")
+    if name not in floorTransforms or not sep or not 2 <= len(fields) <= 4:
+        raise ValueError("expected NAME=START:STEP[:EVERY[:COUNT]] with NAME one of " + ", ".join(floorTransforms))
+    transform = {"name": name, "start": float(fields[0]), "step": float(fields[1]),
+                 "every": int(fields[2]) if len(fields) > 2 else 1,
+                 "count": int(fields[3]) if len(fields) > 3 else 0}
+    if transform["every"] < 1 or transform["count"] < 0:
+        raise ValueError("EVERY must be at least 1 and COUNT must not be negative")
+    return(transform)
+
+# Value of a parsed transform on floor (counted from 0)
+def transformValue(transform, floor):
+    step = floor // transform["every"]
+    if transform["count"] > 0:
+        step %= transform["count"]
+    return(transform["start"] + step * transform["step"])
+
+# Like tempChanges, but for a parsed transform and the changes after the first
+# one are at the first layer of each floor (a layer belongs to the floor its top
+# is in). The G-code is only inserted when the value changes.
+def floorChanges(transform, floorHeight, firstChange=2):
+    state = {"lastFloor": None, "lastValue": None}
+    def onLayer(layer, z):
+        if state["lastFloor"] is None and layer != firstChange:
+            return(None)
+        floor = max(math.ceil((z - 0.001) / floorHeight) - 1, 0)
+        if state["lastFloor"] is not None and floor <= state["lastFloor"]:
+            return(None)
+        state["lastFloor"] = floor
+        value = transformValue(transform, floor)
+        if value == state["lastValue"]:
+            return(None)
+        state["lastValue"] = value
+        return(floorTransforms[transform["name"]](value))
+    return(onLayer)
+
+# The temperature transform of a tower: startTemp, changed by tempStep every
+# floor, unless a temp transform replaces it (the last one wins, like in the G-code)
+def tempTransform(startTemp, tempStep, transforms=()):
+    temps = [transform for transform in transforms if transform["name"] == "temp"]
+    if temps:
+        return(temps[-1])
+    return({"name": "temp", "start": startTemp, "step": tempStep, "every": 1, "count": 0})
+
+# The M104 schedule of a tower: startTemp, changed by tempStep every floor
+def floorTempChanges(startTemp, tempStep, floorHeight, firstChange=2):
+    return(floorChanges(tempTransform(startTemp, tempStep), floorHeight, firstChange))
+
+# Fuse the schedules of several transforms into one: the G-code of all
+# transforms for a layer is inserted at once, in the order of schedules
+def fusedChanges(schedules):
+    def onLayer(layer, z):
+        gcode = b"".join([g for g in (schedule(layer, z) for schedule in schedules) if g is not None])
+        return(gcode or None)
+    return(onLayer)
+
+# Schedule of a tower: the temperatures from startTemp/tempStep (unless a temp
+# transform replaces them), followed by the given transforms
+def towerChanges(startTemp, tempStep, floorHeight, transforms=(), firstChange=2):
+    schedules = []
+    if not any(transform["name"] == "temp" for transform in transforms):
+        schedules.append(floorTempChanges(startTemp, tempStep, floorHeight, firstChange))
+    schedules += [floorChanges(transform, floorHeight, firstChange) for transform in transforms]
+    return(fusedChanges(schedules))
+
+# Get the Z of the layer of marker m in buf. prevEnd is the end of the
+# previous marker, the ;Z: comment is expected between both. Returns None
+# if buf holds no Z for this layer.
+def findLayerZ(buf, prevEnd, m):
+    pos = buf.rfind(b"\n;Z:", prevEnd, m.start())
+    zc = zCommentRe.match(buf, pos) if pos >= 0 else None
+    if zc is None:
+        zc = zMoveRe.search(buf, m.end())
+    if zc is None:
+        return(None)
+    return(float(zc.group(1)))
+
+# Find the ;CT_LAYER markers in a buffer holding complete lines: yields
+# (layer, z, start of the marker line, end of the marker line). state keeps
+# the last Z between subsequent buffers of a stream.
+def findMarkers(buf, state=None):
+    if state is None:
+        state = {"z": 0.0}
+    prevEnd = 0
+    for m in layerMarkerRe.finditer(buf):
+        start = m.start()
+        if start > 0 and buf[start - 1:start] != b"\n":
+            continue
+        z = findLayerZ(buf, prevEnd, m)
+        if z is not None:
+            state["z"] = z
+        end = m.end()
+        if buf[end:end + 1] == b"\n":
+            end += 1
+        yield(int(m.group(1)), state["z"], start, end)
+        prevEnd = m.end()
+
+# Layer changes of G-code without ;CT_LAYER markers (e.g. sliced elsewhere),
+# in the order they are looked for: the comments of Prusa-, Super- and
+# OrcaSlicer, of Cura, a bare ;Z: comment. Without any of them, a move to a
+# higher Z followed by an extruding move starts a layer (z-hops do not extrude).
+layerStyles = {
+    "LAYER_CHANGE": re.compile(rb';LAYER_CHANGE\r?$', re.M),
+    "LAYER": re.compile(rb';LAYER:-?[0-9]+\r?$', re.M),
+    "Z": re.compile(rb';Z:[-0-9.]+\r?$', re.M)
+}
+zNextRe = re.compile(rb';Z:([-0-9.]+)')
+printMoveRe = re.compile(rb'^G1 [^;\n]*[XY][-0-9.]+ [^;\n]*E[0-9.]', re.M)
+
+# Get the layer style of buf: one of layerStyles or "Z move"
+def detectLayerStyle(buf):
+    for style, styleRe in layerStyles.items():
+        for m in styleRe.finditer(buf):
+            if m.start() == 0 or buf[m.start() - 1:m.start()] == b"\n":
+                return(style)
+    return("Z move")
+
+# Find the layer changes of the given style in a buffer holding complete
+# lines: yields (layer, z, start of the line, end of the line) like
+# findMarkers, with the layers numbered from 0. The Z of a comment is taken
+# from the ;Z: comment on the same or the next line, else from the next move with Z.
+def findLayerChanges(buf, style):
+    layer = 0
+    if style == "Z move":
+        lastZ = -math.inf
+        moves = list(zMoveRe.finditer(buf))
+        for m, following in itertools.zip_longest(moves, moves[1:]):
+            z = float(m.group(1))
+            if z <= lastZ + 1e-6 or not printMoveRe.search(buf, m.end(), following.start() if following else len(buf)):
+                continue
+            end = buf.find(b"\n", m.end()) + 1 or len(buf)
+            yield(layer, z, m.start(), end)
+            layer += 1
+            lastZ = z
+        return
+    z = 0.0
+    for m in layerStyles[style].finditer(buf):
+        start = m.start()
+        if start > 0 and buf[start - 1:start] != b"\n":
+            continue
+        zc = zNextRe.match(buf, start) or zNextRe.match(buf, m.end() + 1)
+        if zc is None:
+            zc = zMoveRe.search(buf, m.end())
+        if zc is not None:
+            z = float(zc.group(1))
+        end = m.end()
+        if buf[end:end + 1] == b"\n":
+            end += 1
+        yield(layer, z, start, end)
+        layer += 1
+
+# Find the insert positions in a buffer holding complete lines: yields (offset, gcode)
+def markerInserts(buf, base, onLayer, state=None):
+    for layer, z, start, end in findMarkers(buf, state):
+        gcode = onLayer(layer, z)
+        if gcode is not None:
+            yield(base + end, gcode)
+
+# Copy count bytes from offset of inFd to the current position of outFd.
+# Uses zero-copy system calls where available, plain reads otherwise.
+def copyRange(inFd, outFd, offset, count):
+    while count > 0:
+        n = 0
+        try:
+            if hasattr(os, "copy_file_range"):
+                n = os.copy_file_range(inFd, outFd, count, offset)
+            elif hasattr(os, "sendfile") and sys.platform.startswith("linux"):
+                n = os.sendfile(outFd, inFd, offset, count)
+        except OSError:
+            n = 0
+        if n == 0:
+            data = os.pread(inFd, min(count, gcodeChunkSize), offset) if hasattr(os, "pread") else None
+            if data is None:
+                os.lseek(inFd, offset, os.SEEK_SET)
+                data = os.read(inFd, min(count, gcodeChunkSize))
+            if not data:
+                raise IOError("Unexpected end of G-code input")
+            n = os.write(outFd, data)
+        offset += n
+        count -= n
+
+# Copy size bytes from inFd to outFd and insert G-code at the given offsets:
+# inserts is an iterable of (offset, gcode) ordered by offset
+def copyInserts(inFd, outFd, inserts, size):
+    pos = 0
+    for offset, gcode in inserts:
+        copyRange(inFd, outFd, pos, offset - pos)
+        os.write(outFd, gcode)
+        pos = offset
+    copyRange(inFd, outFd, pos, size - pos)
+
+# Write buf to out (a file object or GCodeWriter) and insert G-code at the
+# given offsets. Large spans are written in blocks of gcodeChunkSize.
+def writeInserts(buf, out, inserts):
+    pos = 0
+    for offset, gcode in itertools.chain(inserts, [(len(buf), b"")]):
+        for start in range(pos, offset, gcodeChunkSize):
+            out.write(buf[start:min(start + gcodeChunkSize, offset)])
+        out.write(gcode)
+        pos = offset
+
+# Copy G-code from inFile to outFile and insert the G-code returned by onLayer
+# after the matching ;CT_LAYER markers. Regular files are scanned memory mapped
+# and copied in spans between the insert positions. Other inputs (file objects
+# like pipes) are read in blocks. Memory usage is constant in both cases.
+# outFile is a filename or a GCodeWriter.
+def injectGCode(inFile, outFile, onLayer):
+    with contextlib.ExitStack() as stack:
+        out = stack.enter_context(open(outFile, 'wb')) if isinstance(outFile, str) else outFile
+        if isinstance(inFile, str) and os.path.getsize(inFile) > 0:
+            with open(inFile, 'rb') as inp, mmap.mmap(inp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                if out is outFile:
+                    writeInserts(mm, out, markerInserts(mm, 0, onLayer))
+                else:
+                    copyInserts(inp.fileno(), out.fileno(), markerInserts(mm, 0, onLayer), len(mm))
+            return
+        inp = open(inFile, 'rb') if isinstance(inFile, str) else inFile
+        try:
+            rest = b""
+            state = {"z": 0.0}
+            while True:
+                chunk = inp.read(gcodeChunkSize)
+                buf = rest + chunk
+                cut = len(buf) if not chunk else buf.rfind(b"\n") + 1
+                pos = 0
+                for offset, gcode in markerInserts(buf[:cut], 0, onLayer, state):
+                    out.write(buf[pos:offset])
+                    out.write(gcode)
+                    pos = offset
+                out.write(buf[pos:cut])
+                rest = buf[cut:]
+                if not chunk:
+                    break
+        finally:
+            if inp is not inFile:
+                inp.close()
+
+# Layer index of a G-code file: a list of (layer, z, offset, length) per
+# ;CT_LAYER marker. offset is the start of the marker line, length reaches
+# up to the next marker (the last layer up to the end of the file).
+# It can be stored as sidecar file <gcode>.idx, which is bound to the size
+# and mtime of the G-code file.
+layerIndexHeader = struct.Struct("<8sqq")
+layerIndexRecord = struct.Struct("<Idqq")
+
+# Build the layer index in one pass over the G-code. The Z of a layer is taken
+# from Prusa-Slicer's ;Z: comment of the layer change or else from the first
+# move with Z after the marker. G-code without ;CT_LAYER markers is indexed
+# by the layer changes of its layer style (see detectLayerStyle).
+def buildLayerIndex(filename):
+    index = []
+    if os.path.getsize(filename) == 0:
+        return(index)
+    with open(filename, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        markers = findMarkers(mm)
+        first = next(markers, None)
+        if first is None:
+            markers = findLayerChanges(mm, detectLayerStyle(mm))
+        else:
+            markers = itertools.chain([first], markers)
+        for layer, z, start, end in markers:
+            if index:
+                prevLayer, prevZ, offset, length = index[-1]
+                index[-1] = (prevLayer, prevZ, offset, start - offset)
+            index.append((layer, z, start, len(mm) - start))
+    return(index)
+
+# Write the layer index as sidecar file of filename
+def saveLayerIndex(filename, index):
+    st = os.stat(filename)
+    with open(filename + ".idx", 'wb') as f:
+        f.write(layerIndexHeader.pack(b"STTLIDX1", st.st_size, st.st_mtime_ns))
+        for entry in index:
+            f.write(layerIndexRecord.pack(*entry))
+
+# Read the sidecar layer index of filename. Returns None if it is missing
+# or does not belong to the current content of filename.
+def loadLayerIndex(filename):
+    if not isfile(filename + ".idx"):
+        return(None)
+    st = os.stat(filename)
+    with open(filename + ".idx", 'rb') as f:
+        data = f.read()
+    if len(data) < layerIndexHeader.size:
+        return(None)
+    magic, size, mtime = layerIndexHeader.unpack_from(data)
+    if magic != b"STTLIDX1" or size != st.st_size or mtime != st.st_mtime_ns:
+        return(None)
+    return(list(layerIndexRecord.iter_unpack(memoryview(data)[layerIndexHeader.size:])))
+
+# Get the layer index of filename from its sidecar file or build it
+def getLayerIndex(filename, save=False):
+    index = loadLayerIndex(filename)
+    if index is None:
+        index = buildLayerIndex(filename)
+        if save:
+            saveLayerIndex(filename, index)
+    return(index)
+
+# Read the G-code of a single layer (by position in the index)
+def readLayer(filename, index, i):
+    layer, z, offset, length = index[i]
+    with open(filename, 'rb') as f:
+        f.seek(offset)
+        return(f.read(length))
+
+# Adjust a layer index to the file written by copyInserts with the given inserts
+def shiftLayerIndex(index, inserts):
+    shifted = []
+    inserts = sorted(inserts)
+    shift = 0
+    i = 0
+    for layer, z, offset, length in index:
+        added = 0
+        while i < len(inserts) and inserts[i][0] <= offset:
+            shift += len(inserts[i][1])
+            i += 1
+        while i < len(inserts) and inserts[i][0] < offset + length:
+            added += len(inserts[i][1])
+            shift += len(inserts[i][1])
+            i += 1
+        shifted.append((layer, z, offset + shift - added, length + added))
+    return(shifted)
+
+# Insert positions for the G-code of the schedule onLayer (see towerChanges).
+# Only the marker lines are read, using the offsets of the layer index.
+def floorInserts(filename, index, onLayer):
+    inserts = []
+    with open(filename, 'rb') as f:
+        for layer, z, offset, length in index:
+            gcode = onLayer(layer, z)
+            if gcode is not None:
+                f.seek(offset)
+                inserts.append((offset + len(f.readline()), gcode))
+    return(inserts)
+
+# Copy inFile to outFile (a filename or a GCodeWriter) with G-code inserted at the given offsets
+def injectAtOffsets(inFile, outFile, inserts):
+    with open(inFile, 'rb') as inp:
+        if not isinstance(outFile, str):
+            if os.fstat(inp.fileno()).st_size == 0:
+                return
+            with mmap.mmap(inp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                writeInserts(mm, outFile, inserts)
+            return
+        with open(outFile, 'wb') as out:
+            copyInserts(inp.fileno(), out.fileno(), inserts, os.fstat(inp.fileno()).st_size)
+
+###
+# Output formats of the final G-code: plain, gzip, MeatPack or binary G-code
+###
+
+# File extension per output format
+gcodeFormats = {"gcode": ".gcode", "gz": ".gcode.gz", "meatpack": ".mpk", "bgcode": ".bgcode"}
+
+# Remove comments, surplus whitespace and empty lines from complete G-code lines
+gcodeCommentRe = re.compile(rb';[^\n]*')
+gcodeBlanksRe = re.compile(rb'  +')
+gcodeEmptyLinesRe = re.compile(rb'\n\n+')
+def stripGCode(buf):
+    if b";" in buf:
+        buf = gcodeCommentRe.sub(b"", buf)
+    buf = buf.replace(b"\t", b" ").replace(b"\r", b"")
+    if b"  " in buf:
+        buf = gcodeBlanksRe.sub(b" ", buf)
+    buf = buf.replace(b" \n", b"\n").replace(b"\n ", b"\n")
+    if b"\n\n" in buf:
+        buf = gcodeEmptyLinesRe.sub(b"\n", buf)
+    return(buf.lstrip(b" \n"))
+
+# MeatPack packs the characters "0123456789.E\nGX" into 4 bit nibbles, two per
+# byte. Other characters follow the packed byte in full, with 0xF as nibble.
+# Spaces are removed from G moves ("no spaces" mode, where 'E' replaces ' ').
+meatPackChars = b"0123456789.E\nGX"
+meatPackNibbles = bytes(meatPackChars.index(c) if c in meatPackChars else 15 for c in range(256))
+meatPackEnable = b"\xff\xff\xfb"
+meatPackNoSpaces = b"\xff\xff\xf7"
+meatPackReset = b"\xff\xff\xf9"
+meatPackPairs = []
+
+# Packed bytes of each character pair, indexed by the pair as little endian uint16
+def meatPackPairTable():
+    table = []
+    for pair in range(65536):
+        c1, c2 = pair & 0xff, pair >> 8
+        p1, p2 = meatPackNibbles[c1], meatPackNibbles[c2]
+        table.append(bytes([p1 | p2 << 4]) + (bytes([c1]) if p1 == 15 else b"") + (bytes([c2]) if p2 == 15 else b""))
+    return(table)
+
+# Pack the character pairs of buf (even length)
+def meatPackBuffer(buf):
+    if numpy is not None:
+        pairs = numpy.frombuffer(buf, numpy.uint8).reshape(-1, 2)
+        nibbles = numpy.frombuffer(meatPackNibbles, numpy.uint8)[pairs]
+        full1 = nibbles[:, 0] == 15
+        full2 = nibbles[:, 1] == 15
+        sizes = 1 + full1.astype(numpy.intp) + full2
+        pos = numpy.cumsum(sizes) - sizes
+        out = numpy.empty(int(sizes.sum()), numpy.uint8)
+        out[pos] = nibbles[:, 0] | nibbles[:, 1] << 4
+        out[pos[full1] + 1] = pairs[full1, 0]
+        out[pos[full2] + 1 + full1[full2]] = pairs[full2, 1]
+        return(out.tobytes())
+    if not meatPackPairs:
+        meatPackPairs.extend(meatPackPairTable())
+    pairs = array('H', buf)
+    if sys.byteorder == "big":
+        pairs.byteswap()
+    return(b"".join(map(meatPackPairs.__getitem__, pairs)))
+
+# MeatPack encode G-code (complete lines). Comments are removed. Lines of odd
+# length (with newline) are padded by an empty line, so they pack into pairs.
+def meatPack(buf):
+    lines = [line.replace(b" ", b"") if line[:1] == b"G" else line for line in stripGCode(buf).split(b"\n")[:-1]]
+    return(meatPackBuffer(b"".join([line + b"\n" if len(line) % 2 else line + b"\n\n" for line in lines])))
+
+# Binary G-code (Prusa .bgcode): file header, then blocks of
+#   type, compression, uncompressed size[, compressed size] | encoding | data | CRC32
+# Metadata blocks hold "key=value" lines. G-code blocks are deflate compressed.
+bgcodeHeader = struct.Struct("<4sIH")
+bgcodeBlockHeader = struct.Struct("<HHI")
+bgcodeBlockSize = 65536
+bgcodeFileMetadata, bgcodeGCode, bgcodeSlicerMetadata, bgcodePrinterMetadata, bgcodePrintMetadata = 0, 1, 2, 3, 4
+bgcodePrinterKeys = ["printer_model", "filament_type", "nozzle_diameter", "bed_temperature", "brim_width",
+                     "fill_density", "layer_height", "temperature", "ironing", "support_material",
+                     "max_layer_z", "extruder_colour", "filament used [mm]", "filament used [g]",
+                     "estimated printing time (normal mode)"]
+bgcodePrintKeys = ["filament used [mm]", "filament used [cm3]", "filament used [g]", "filament cost",
+                   "total filament used [g]", "total filament cost", "estimated printing time (normal mode)",
+                   "estimated first layer printing time (normal mode)"]
+
+# Encode one block, data is deflate compressed if compress is set
+def bgcodeBlock(blockType, data, encoding=0, compress=False):
+    if compress:
+        packed = zlib.compress(data, 6)
+        header = bgcodeBlockHeader.pack(blockType, 1, len(data)) + struct.pack("<I", len(packed))
+    else:
+        packed = data
+        header = bgcodeBlockHeader.pack(blockType, 0, len(data))
+    block = header + struct.pack("<H", encoding) + packed
+    return(block + struct.pack("<I", zlib.crc32(block)))
+
+# Encode a metadata block out of (key, value) pairs
+def bgcodeMetadata(blockType, items):
+    data = "".join("{}={}\n".format(key, value) for key, value in items)
+    return(bgcodeBlock(blockType, data.encode("utf-8")))
+
+# Read the "; key = value" comments Prusa-Slicer writes at the end of the G-code
+# (statistics and configuration) and the slicer name of the first line
+def readGCodeMetadata(filename, tail=1024 * 1024):
+    metadata = {}
+    with open(filename, 'rb') as f:
+        first = f.readline()
+        f.seek(max(os.fstat(f.fileno()).st_size - tail, 0))
+        for m in re.finditer(rb'^; ([^=\n]+?) = ([^\n]*)$', f.read(), re.M):
+            metadata[m.group(1).decode("utf-8", "replace")] = m.group(2).decode("utf-8", "replace").rstrip("\r")
+    m = re.match(rb'; generated by (.*?) on ', first)
+    metadata["Producer"] = m.group(1).decode("utf-8", "replace") if m else "SmartTemperatureTower"
+    return(metadata)
+
+# Writes the final G-code in one of the gcodeFormats, optionally without
+# comments and surplus whitespace (strip). Data is processed in complete lines.
+# bytesIn counts the plain G-code written to it (for the transfer report).
+# With upload (see GCodeUpload), the written file is also sent to a printer host.
+class GCodeWriter:
+    def __init__(self, filename, fmt="gcode", strip=False, metadata=None, upload=None):
+        self.fmt = fmt
+        self.strip = strip
+        self.rest = b""
+        self.block = []
+        self.blockSize = 0
+        self.bytesIn = 0
+        self.file = open(filename, 'wb') if upload is None else UploadTee(open(filename, 'wb'), upload)
+        if fmt == "gz":
+            # filename is a temporary name (see atomicOutput), so none is stored in the header
+            self.out = gzip.GzipFile(filename='', mode='wb', compresslevel=6, fileobj=self.file)
+        else:
+            self.out = self.file
+        if fmt == "meatpack":
+            self.out.write(meatPackEnable + meatPackNoSpaces)
+        if fmt == "bgcode":
+            metadata = metadata or {}
+            self.out.write(bgcodeHeader.pack(b"GCDE", 1, 1))
+            self.out.write(bgcodeMetadata(bgcodeFileMetadata, [("Producer", metadata.get("Producer", "SmartTemperatureTower"))]))
+            self.out.write(bgcodeMetadata(bgcodePrinterMetadata, [(k, metadata[k]) for k in bgcodePrinterKeys if k in metadata]))
+            self.out.write(bgcodeMetadata(bgcodePrintMetadata, [(k, metadata[k]) for k in bgcodePrintKeys if k in metadata]))
+            self.out.write(bgcodeMetadata(bgcodeSlicerMetadata, [(k, v) for k, v in metadata.items() if k != "Producer"]))
+
+    def write(self, data):
+        self.bytesIn += len(data)
+        buf = self.rest + data
+        cut = buf.rfind(b"\n") + 1
+        self.rest = buf[cut:]
+        if cut > 0:
+            self.encode(buf[:cut])
+
+    def encode(self, buf):
+        if self.fmt == "meatpack":
+            self.out.write(meatPack(buf))
+            return
+        if self.strip:
+            buf = stripGCode(buf)
+        if self.fmt != "bgcode":
+            self.out.write(buf)
+            return
+        self.block.append(buf)
+        self.blockSize += len(buf)
+        if self.blockSize >= bgcodeBlockSize:
+            self.flushBlocks(False)
+
+    # Write the collected G-code as blocks of bgcodeBlockSize (split at line ends)
+    def flushBlocks(self, final):
+        buf = b"".join(self.block)
+        pos = 0
+        while len(buf) - pos >= bgcodeBlockSize or (final and pos < len(buf)):
+            end = buf.rfind(b"\n", pos, pos + bgcodeBlockSize) + 1
+            if end <= pos:
+                end = buf.find(b"\n", pos + bgcodeBlockSize) + 1
+            data = buf[pos:end]
+            if self.strip:
+                self.out.write(bgcodeBlock(bgcodeGCode, meatPackEnable + meatPackNoSpaces + meatPack(data) + meatPackReset, 1, True))
+            else:
+                self.out.write(bgcodeBlock(bgcodeGCode, data, 0, True))
+            pos = end
+        self.block = [buf[pos:]]
+        self.blockSize = len(buf) - pos
+
+    def close(self):
+        if self.rest:
+            self.encode(self.rest + b"\n")
+            self.rest = b""
+        if self.fmt == "bgcode":
+            self.flushBlocks(True)
+        if self.fmt == "meatpack":
+            self.out.write(meatPackReset)
+        self.out.close()
+        if self.file is not self.out:
+            self.file.close()
+
+# Format seconds as H:MM:SS
+def formatDuration(seconds):
+    seconds = int(round(seconds))
+    return("{}:{:02d}:{:02d}".format(seconds // 3600, seconds // 60 % 60, seconds % 60))
+
+# Print size of the plain and the written G-code and the time to send both
+# over a serial line with baud (8N1: 10 bits per byte)
+def printTransferReport(plainSize, filename, baud):
+    size = os.path.getsize(filename)
+    def duration(n):
+        return(formatDuration(n * 10 / baud))
+    print()
+    print("GCODE size:        {:.2f} MB -> {:.2f} MB (ratio {:.2f}:1)".format(
+          plainSize / 1024 / 1024, size / 1024 / 1024, plainSize / size if size else 0.0))
+    print("Transfer time:     {} -> {} at {} baud (saves {})".format(
+          duration(plainSize), duration(size), baud, duration(max(plainSize - size, 0))))
+
+###
+# Upload to a printer host (OctoPrint, Moonraker)
+###
+
+# Upload API of OctoPrint, used if the URL has no path. Moonraker offers the same.
+uploadPath = "/api/files/local"
+
+# Size of the chunks sent to the printer host
+uploadChunkSize = 256 * 1024
+
+# Formats (see gcodeFormats) the upload APIs of OctoPrint and Moonraker accept:
+# both reject .gcode.gz, .mpk and .bgcode files
+uploadFormats = ["gcode"]
+
+# Idle connections per host, reused by the next upload (e.g. of a batch job started
+# after another one finished; jobs running at the same time open their own)
+uploadConnections = {}
+uploadConnectionsLock = threading.Lock()
+uploadStats = {"connections": 0, "reused": 0}
+
+# Get a connection to the host of url (scheme, netloc), an idle one if possible
+def getUploadConnection(scheme, netloc):
+    with uploadConnectionsLock:
+        idle = uploadConnections.get((scheme, netloc))
+        if idle:
+            uploadStats["reused"] += 1
+            return(idle.pop())
+        uploadStats["connections"] += 1
+    if scheme == "https":
+        return(http.client.HTTPSConnection(netloc, timeout=60))
+    return(http.client.HTTPConnection(netloc, timeout=60))
+
+# Return a connection after a complete request, so it can be reused
+def releaseUploadConnection(scheme, netloc, conn):
+    with uploadConnectionsLock:
+        uploadConnections.setdefault((scheme, netloc), []).append(conn)
+
+# Upload of a file to a printer host, sent while the file is written: a
+# multipart/form-data POST with chunked transfer encoding. The request is
+# started by the first write, so no connection is held open while slicing.
+# Errors do not stop writing the local file, they are kept in error.
+# Times are relative to the creation of the upload (the start of the run).
+class GCodeUpload:
+    def __init__(self, url, filename, startPrint=False, apiKey=None):
+        self.url = url
+        parsed = urllib.parse.urlsplit(url)
+        self.scheme = parsed.scheme or "http"
+        self.netloc = parsed.netloc
+        self.path = parsed.path if parsed.path not in ("", "/") else uploadPath
+        self.filename = filename
+        self.startPrint = startPrint
+        self.apiKey = apiKey
+        self.boundary = "----SmartTemperatureTower" + os.urandom(8).hex()
+        self.conn = None
+        self.buffer = []
+        self.bufferSize = 0
+        self.bytesSent = 0
+        self.error = None
+        self.status = None
+        self.start = time.perf_counter()
+        self.firstByte = None
+        self.sent = None
+        self.response = None
+
+    # Send the request line, the headers and the form fields before the file
+    def begin(self):
+        fields = [("print", "true")] if self.startPrint else []
+        preamble = "".join("--{}\r\nContent-Disposition: form-data; name=\"{}\"\r\n\r\n{}\r\n".format(
+                           self.boundary, name, value) for name, value in fields)
+        preamble += ("--{}\r\nContent-Disposition: form-data; name=\"file\"; filename=\"{}\"\r\n"
+                     "Content-Type: application/octet-stream\r\n\r\n").format(self.boundary, self.filename)
+        for attempt in range(2):
+            self.conn = getUploadConnection(self.scheme, self.netloc)
+            try:
+                self.conn.putrequest("POST", self.path, skip_accept_encoding=True)
+                self.conn.putheader("Content-Type", "multipart/form-data; boundary=" + self.boundary)
+                self.conn.putheader("Transfer-Encoding", "chunked")
+                if self.apiKey:
+                    self.conn.putheader("X-Api-Key", self.apiKey)
+                self.conn.endheaders()
+                self.sendChunk(preamble.encode())
+                return
+            except (OSError, http.client.HTTPException):
+                # An idle connection may have been closed by the host
+                self.conn.close()
+                if attempt == 1:
+                    raise
+
+    def sendChunk(self, data):
+        self.conn.send(b"%x\r\n" % len(data) + data + b"\r\n")
+
+    def write(self, data):
+        if self.error is not None or not data:
+            return
+        self.buffer.append(bytes(data))
+        self.bufferSize += len(data)
+        if self.bufferSize >= uploadChunkSize:
+            self.flush()
+
+    def flush(self):
+        if self.error is not None or not self.buffer:
+            return
+        try:
+            if self.conn is None:
+                self.begin()
+            self.sendChunk(b"".join(self.buffer))
+            if self.firstByte is None:
+                self.firstByte = time.perf_counter() - self.start
+            self.bytesSent += self.bufferSize
+        except (OSError, http.client.HTTPException) as e:
+            self.fail(e)
+        self.buffer = []
+        self.bufferSize = 0
+
+    def fail(self, e):
+        self.error = str(e) or type(e).__name__
+        if self.conn is not None:
+            self.conn.close()
+
+    # Send the rest and the end of the request, then wait for the response
+    def finish(self):
+        self.flush()
+        if self.error is not None:
+            return
+        try:
+            if self.conn is None:
+                self.begin()
+            self.sendChunk("\r\n--{}--\r\n".format(self.boundary).encode())
+            self.conn.send(b"0\r\n\r\n")
+            self.sent = time.perf_counter() - self.start
+            rc = self.conn.getresponse()
+            body = rc.read()
+            self.response = time.perf_counter() - self.start - self.sent
+            self.status = rc.status
+        except (OSError, http.client.HTTPException) as e:
+            self.fail(e)
+            return
+        if not 200 <= self.status < 300:
+            self.fail(Exception("HTTP {} {}: {}".format(self.status, rc.reason,
+                                body.decode("utf-8", "replace").strip()[:200])))
+            return
+        if rc.will_close:
+            self.conn.close()
+        else:
+            releaseUploadConnection(self.scheme, self.netloc, self.conn)
+
+# File object, which also sends everything written to it to an upload
+class UploadTee:
+    def __init__(self, f, upload):
+        self.f = f
+        self.upload = upload
+        self.name = f.name
+
+    def write(self, data):
+        self.upload.write(data)
+        return(self.f.write(data))
+
+    def flush(self):
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+# Print the result of an upload
+def printUploadReport(upload):
+    print()
+    if upload.error is not None:
+        print("ERROR: Upload to {} failed: {}".format(upload.url, upload.error))
+        return
+    duration = upload.sent + upload.response
+    print("Upload:            {} to {} (HTTP {}{})".format(upload.filename, upload.url, upload.status,
+          ", print started" if upload.startPrint else ""))
+    print("First byte sent:   {:.2f} s after the start".format(upload.firstByte if upload.firstByte is not None else upload.sent))
+    print("Response after:    {:.3f} s after the last byte".format(upload.response))
+    print("Transfer:          {:.2f} MB in {:.2f} s ({:.2f} MB/s)".format(upload.bytesSent / 1024 / 1024,
+          duration - (upload.firstByte or 0), upload.bytesSent / 1024 / 1024 / max(duration - (upload.firstByte or 0), 1e-6)))
+
+###
+# Print time estimate
+###
+
+# Printer limits of the estimator (Prusa-Slicer printer settings) and their
+# defaults (Prusa i3 MK3S). Accelerations in mm/s², feedrates and jerk in mm/s.
+printerLimitDefaults = {
+    "machine_max_acceleration_extruding": 1250, "machine_max_acceleration_retracting": 1250,
+    "machine_max_acceleration_travel": 1250,
+    "machine_max_acceleration_x": 1000, "machine_max_acceleration_y": 1000,
+    "machine_max_acceleration_z": 200, "machine_max_acceleration_e": 5000,
+    "machine_max_feedrate_x": 200, "machine_max_feedrate_y": 200,
+    "machine_max_feedrate_z": 12, "machine_max_feedrate_e": 120,
+    "machine_max_jerk_x": 8, "machine_max_jerk_y": 8, "machine_max_jerk_z": 0.4, "machine_max_jerk_e": 4.5
+}
+
+# Read the "key = value" lines of a Prusa-Slicer ini file
+def readIniValues(filename):
+    values = {}
+    with open(filename, 'r', encoding="utf-8", errors="replace") as f:
+        for line in f:
+            key, sep, value = line.partition(" = ")
+            if sep:
+                values[key.strip()] = value.strip()
+    return(values)
+
+# Get the printer limits from the printer profile (if given), else from the
+# configuration at the end of the G-code, else the defaults. Values of
+# Prusa-Slicer are "normal,stealth", the normal mode is used.
+def getPrinterLimits(printerIni, gcodeFile):
+    values = readIniValues(printerIni) if printerIni and isfile(printerIni) else {}
+    metadata = readGCodeMetadata(gcodeFile)
+    limits = {}
+    for key, default in printerLimitDefaults.items():
+        try:
+            limits[key] = float((values.get(key) or metadata.get(key)).split(",")[0])
+        except (AttributeError, ValueError):
+            limits[key] = default
+    return(limits)
+
+# Lines the estimator uses besides G0/G1/G92: layer Z, accelerations (M204 P
+# for printing, T for travel, S for both), dwell (G4 P in ms, S in s), E mode
+estimateSpecialRe = re.compile(rb'\n(;Z:|M204 [PST]|G4 [PS]|M82|M83)([-0-9.]*)')
+estimateMoveRe = re.compile(rb'\n(G[01]|G92) ([^\n;]*)')
+estimateNone, estimateMove, estimateSetPos, estimateLayer, estimateAccelPrint, estimateAccelTravel, \
+    estimateAccelBoth, estimateDwellMs, estimateDwellS, estimateAbsoluteE, estimateRelativeE = range(11)
+estimateKinds = {b";Z:": estimateLayer, b"M204 P": estimateAccelPrint, b"M204 T": estimateAccelTravel,
+                 b"M204 S": estimateAccelBoth, b"G4 P": estimateDwellMs, b"G4 S": estimateDwellS,
+                 b"M82": estimateAbsoluteE, b"M83": estimateRelativeE}
+
+# Parse the numbers starting at the positions pos of the uint8 array a
+# (digits, '.' and a leading '-'), one character column at a time
+if numpy is not None:
+    estimateNumChars = numpy.zeros(256, bool)
+    estimateNumChars[list(b"-0123456789.")] = True
+    estimateAxisChars = numpy.zeros(256, bool)
+    estimateAxisChars[list(b"XYZEF")] = True
+def parseNumbers(a, pos, width=16):
+    mantissa = numpy.zeros(len(pos))
+    decimals = numpy.zeros(len(pos), numpy.intp)
+    alive = numpy.ones(len(pos), bool)
+    dot = numpy.zeros(len(pos), bool)
+    for column in range(width):
+        c = a[pos + column]
+        alive &= estimateNumChars[c]
+        if not alive.any():
+            break
+        digit = c.astype(numpy.intp) - 48
+        isDigit = alive & (digit >= 0) & (digit <= 9)
+        mantissa = numpy.where(isDigit, mantissa * 10 + digit, mantissa)
+        decimals += isDigit & dot
+        dot |= alive & (c == 46)
+    values = mantissa / 10.0 ** decimals
+    return(numpy.where(a[pos] == 45, -values, values))
+
+# Parse a buffer of complete lines into the rows the estimator uses: returns
+# the arrays kind, X, Y, Z, E, F and value (NaN if not given)
+def parseEstimateRows(buf):
+    n = len(buf)
+    a = numpy.frombuffer(buf + b"\n" * 20, numpy.uint8)
+    starts = numpy.concatenate(([0], numpy.flatnonzero(a[:n - 1] == 10) + 1))
+    c0, c1, c2 = a[starts], a[starts + 1], a[starts + 2]
+    kind = numpy.full(len(starts), estimateNone, numpy.int8)
+    kind[(c0 == 71) & ((c1 == 48) | (c1 == 49)) & (c2 == 32)] = estimateMove
+    kind[(c0 == 71) & (c1 == 57) & (c2 == 50)] = estimateSetPos
+    value = numpy.full(len(starts), numpy.nan)
+    special = [(m.start(), estimateKinds[m.group(1)], float(m.group(2) or "nan"))
+               for m in estimateSpecialRe.finditer(b"\n" + buf)]
+    if special:
+        offsets, kinds, values = zip(*special)
+        line = numpy.searchsorted(starts, offsets)
+        kind[line] = kinds
+        value[line] = values
+
+    # Axis words: a letter of XYZEF after a space and followed by a number
+    pos = numpy.flatnonzero(a[:n] == 32) + 1
+    pos = pos[estimateAxisChars[a[pos]]]
+    pos = pos[estimateNumChars[a[pos + 1]]]
+    line = numpy.searchsorted(starts, pos, 'right') - 1
+    isMove = (kind[line] == estimateMove) | (kind[line] == estimateSetPos)
+    pos, line = pos[isMove], line[isMove]
+    numbers = parseNumbers(a, pos + 1)
+    axes = []
+    for letter in b"XYZEF":
+        column = numpy.full(len(starts), numpy.nan)
+        isLetter = a[pos] == letter
+        column[line[isLetter]] = numbers[isLetter]
+        axes.append(column)
+    keep = kind != estimateNone
+    return([kind[keep]] + [column[keep] for column in axes] + [value[keep]])
+
+# Forward fill the NaNs of values, starting with first. The result holds first
+# as element 0, followed by the filled values.
+def forwardFill(values, first):
+    values = numpy.concatenate(([first], values))
+    index = numpy.where(numpy.isnan(values), 0, numpy.arange(len(values)))
+    numpy.maximum.accumulate(index, out=index)
+    return(values[index])
+
+# Time of trapezoidal moves: length, cruise speed v, acceleration a, entry
+# speed ve and exit speed vx. Entry/exit speeds which cannot be reached within
+# length are lowered. Works on floats (xp = math) and arrays (xp = numpy).
+def trapezoidTimes(length, v, a, ve, vx, xp):
+    minimum, maximum = (min, max) if xp is math else (numpy.minimum, numpy.maximum)
+    vx = minimum(vx, xp.sqrt(ve * ve + 2 * a * length))
+    ve = minimum(ve, xp.sqrt(vx * vx + 2 * a * length))
+    accel = (v * v - ve * ve) / (2 * a)
+    decel = (v * v - vx * vx) / (2 * a)
+    peak = minimum(v, xp.sqrt((2 * a * length + ve * ve + vx * vx) / 2))
+    cruise = maximum(length - accel - decel, 0)
+    return((peak - ve) / a + (peak - vx) / a + cruise / v)
+
+# Limit speeds (or accelerations) along the unit vectors u (rows of x, y, z, e)
+# by the per axis limits
+def axisLimited(values, u, limits):
+    with numpy.errstate(divide="ignore"):
+        for axis in range(4):
+            values = numpy.minimum(values, limits[axis] / numpy.abs(u[:, axis]))
+    return(values)
+
+# Estimate one block of rows (see parseEstimateRows). state holds position,
+# feedrate, modes and layer Z between blocks, times and filament are added per
+# floor. The first move of a block starts and its last move ends at jerk speed.
+def estimateRows(rows, state, limits, floorHeight, times, filament):
+    kind, x, y, z, e, f, value = rows
+    positioned = (kind == estimateMove) | (kind == estimateSetPos)
+    def filled(values, isSet, key):
+        result = forwardFill(numpy.where(isSet, values, numpy.nan), state[key])
+        state[key] = result[-1]
+        return(result)
+    px = filled(x, positioned, "x")
+    py = filled(y, positioned, "y")
+    pz = filled(z, positioned, "z")
+    pe = filled(e, positioned, "e")
+    feed = filled(f, positioned, "f")[1:]
+    relative = filled(numpy.where(kind == estimateRelativeE, 1.0, 0.0),
+                      (kind == estimateRelativeE) | (kind == estimateAbsoluteE), "relative")[1:]
+    accelPrint = filled(value, (kind == estimateAccelPrint) | (kind == estimateAccelBoth), "accelPrint")[1:]
+    accelTravel = filled(value, (kind == estimateAccelTravel) | (kind == estimateAccelBoth), "accelTravel")[1:]
+    layerZ = filled(value, kind == estimateLayer, "layerZ")[1:]
+    rowFloor = numpy.maximum(numpy.ceil((layerZ - 0.001) / floorHeight) - 1, 0).astype(numpy.intp)
+
+    delta = numpy.stack([numpy.diff(px), numpy.diff(py), numpy.diff(pz),
+                         numpy.where(relative == 1, numpy.nan_to_num(e), numpy.diff(pe))], axis=1)
+    lengthXYZ = numpy.sqrt((delta[:, :3] ** 2).sum(axis=1))
+    length = numpy.where(lengthXYZ > 0, lengthXYZ, numpy.abs(delta[:, 3]))
+    move = (kind == estimateMove) & (length > 0)
+    delta, lengthXYZ, length = delta[move], lengthXYZ[move], length[move]
+    feed, accelPrint, accelTravel, floor = feed[move], accelPrint[move], accelTravel[move], rowFloor[move]
+
+    u = delta / length[:, None]
+    maxFeed = [limits["machine_max_feedrate_" + axis] for axis in "xyze"]
+    maxAccel = [limits["machine_max_acceleration_" + axis] for axis in "xyze"]
+    jerk = [limits["machine_max_jerk_" + axis] for axis in "xyze"]
+    v = axisLimited(numpy.maximum(feed / 60, 0.1), u, maxFeed)
+    extruding = (lengthXYZ > 0) & (delta[:, 3] > 0)
+    a = numpy.where(lengthXYZ == 0, limits["machine_max_acceleration_retracting"],
+        numpy.where(extruding, numpy.where(numpy.isnan(accelPrint), limits["machine_max_acceleration_extruding"], accelPrint),
+                               numpy.where(numpy.isnan(accelTravel), limits["machine_max_acceleration_travel"], accelTravel)))
+    a = axisLimited(numpy.where(a > 0, a, limits["machine_max_acceleration_extruding"]), u, maxAccel)
+    stop = axisLimited(v, u, jerk)
+    junction = axisLimited(numpy.minimum(v[:-1], v[1:]), u[1:] - u[:-1], jerk)
+    ve = numpy.concatenate((stop[:1], junction))
+    vx = numpy.concatenate((junction, stop[-1:]))
+    seconds = trapezoidTimes(length, v, a, ve, vx, numpy)
+
+    dwell = numpy.where(kind == estimateDwellMs, value / 1000, numpy.where(kind == estimateDwellS, value, 0))
+    size = int(rowFloor.max()) + 1
+    if len(times) < size:
+        times.extend([0.0] * (size - len(times)))
+        filament.extend([0.0] * (size - len(filament)))
+    for i, t in enumerate(numpy.bincount(floor, seconds, size) + numpy.bincount(rowFloor, numpy.nan_to_num(dwell), size)):
+        times[i] += t
+    for i, mm in enumerate(numpy.bincount(floor, numpy.maximum(delta[:, 3], 0), size)):
+        filament[i] += mm
+
+# Same as estimateRows without NumPy, one line at a time. state["pending"]
+# holds the last move until the junction speed to the next one is known, an
+# empty buf ends it.
+def estimateLines(buf, state, limits, floorHeight, times, filament):
+    maxFeed = [limits["machine_max_feedrate_" + axis] for axis in "xyze"]
+    maxAccel = [limits["machine_max_acceleration_" + axis] for axis in "xyze"]
+    jerk = [limits["machine_max_jerk_" + axis] for axis in "xyze"]
+    def limited(value, u, axisLimits):
+        for axis in range(4):
+            if u[axis] != 0:
+                value = min(value, axisLimits[axis] / abs(u[axis]))
+        return(value)
+    def add(floor, seconds, mm):
+        while len(times) <= floor:
+            times.append(0.0)
+            filament.append(0.0)
+        times[floor] += seconds
+        filament[floor] += mm
+    def finish(exitSpeed):
+        length, v, a, ve, u, floor, mm = state["pending"]
+        add(floor, trapezoidTimes(length, v, a, ve, min(exitSpeed, v), math), mm)
+        state["pending"] = None
+
+    lines = itertools.chain(estimateMoveRe.finditer(b"\n" + buf), estimateSpecialRe.finditer(b"\n" + buf))
+    for m in sorted(lines, key=lambda m: m.start()):
+        floor = max(math.ceil((state["layerZ"] - 0.001) / floorHeight) - 1, 0)
+        kind = estimateKinds.get(m.group(1))
+        if kind is None:
+            words = {word[:1]: word[1:] for word in m.group(2).split() if word[:1] in b"XYZEF"}
+            try:
+                words = {letter: float(number) for letter, number in words.items()}
+            except ValueError:
+                continue
+            old = [state["x"], state["y"], state["z"], state["e"]]
+            for key, letter in (("x", b"X"), ("y", b"Y"), ("z", b"Z"), ("e", b"E"), ("f", b"F")):
+                if letter in words:
+                    state[key] = words[letter]
+            if m.group(1) == b"G92":
+                continue
+            delta = [state["x"] - old[0], state["y"] - old[1], state["z"] - old[2],
+                     words.get(b"E", 0.0) if state["relative"] == 1 else state["e"] - old[3]]
+            lengthXYZ = math.sqrt(delta[0] ** 2 + delta[1] ** 2 + delta[2] ** 2)
+            length = lengthXYZ if lengthXYZ > 0 else abs(delta[3])
+            if length == 0:
+                continue
+            u = [d / length for d in delta]
+            v = limited(max(state["f"] / 60, 0.1), u, maxFeed)
+            if lengthXYZ == 0:
+                a = limits["machine_max_acceleration_retracting"]
+            elif delta[3] > 0:
+                a = limits["machine_max_acceleration_extruding"] if math.isnan(state["accelPrint"]) else state["accelPrint"]
+            else:
+                a = limits["machine_max_acceleration_travel"] if math.isnan(state["accelTravel"]) else state["accelTravel"]
+            a = limited(a if a > 0 else limits["machine_max_acceleration_extruding"], u, maxAccel)
+            entry = limited(v, u, jerk)
+            if state["pending"] is not None:
+                du = [u[axis] - state["pending"][4][axis] for axis in range(4)]
+                entry = limited(min(v, state["pending"][1]), du, jerk)
+                finish(entry)
+            state["pending"] = (length, v, a, entry, u, floor, max(delta[3], 0))
+        elif kind == estimateLayer:
+            state["layerZ"] = float(m.group(2))
+        elif kind in (estimateAccelPrint, estimateAccelTravel, estimateAccelBoth) and m.group(2):
+            if kind != estimateAccelTravel:
+                state["accelPrint"] = float(m.group(2))
+            if kind != estimateAccelPrint:
+                state["accelTravel"] = float(m.group(2))
+        elif kind in (estimateDwellMs, estimateDwellS) and m.group(2):
+            add(floor, float(m.group(2)) / (1000 if kind == estimateDwellMs else 1), 0.0)
+        elif kind in (estimateAbsoluteE, estimateRelativeE):
+            state["relative"] = 1.0 if kind == estimateRelativeE else 0.0
+    if state["pending"] is not None and not buf:
+        finish(limited(state["pending"][1], state["pending"][4], jerk))
+
+# Initial state of the estimator (see estimateRows)
+def estimateState():
+    return({"x": 0.0, "y": 0.0, "z": 0.0, "e": 0.0, "f": 1200.0, "relative": 0.0, "layerZ": 0.0,
+            "accelPrint": float("nan"), "accelTravel": float("nan"), "pending": None})
+
+# Estimate a buffer of complete lines with NumPy or else line by line. An
+# empty buf ends the last move of the line by line estimator.
+def estimateBlock(buf, state, limits, floorHeight, times, filament):
+    if buf and numpy is not None:
+        rows = parseEstimateRows(buf)
+        if len(rows[0]) > 0:
+            estimateRows(rows, state, limits, floorHeight, times, filament)
+    elif buf or state["pending"] is not None:
+        estimateLines(buf, state, limits, floorHeight, times, filament)
+
+# Estimate the print time of a G-code file, read in blocks of gcodeChunkSize.
+# Returns (times, filament): seconds and extruded filament (mm) per floor,
+# a layer belongs to the floor its ;Z: is in. Moves are planned trapezoidal
+# with classic jerk at the junctions, limited by the printer limits.
+def estimatePrintTime(filename, limits, floorHeight):
+    state = estimateState()
+    times, filament = [], []
+    with open(filename, 'rb') as f:
+        rest = b""
+        while True:
+            chunk = f.read(gcodeChunkSize)
+            buf = rest + chunk
+            cut = len(buf) if not chunk else buf.rfind(b"\n") + 1
+            if cut > 0:
+                estimateBlock(buf[:cut], state, limits, floorHeight, times, filament)
+            rest = buf[cut:]
+            if not chunk:
+                break
+    estimateBlock(b"", state, limits, floorHeight, times, filament)
+    return(times, filament)
+
+# Estimate the print time of each layer of the layer index (see buildLayerIndex).
+# The G-code before the first layer is estimated first to set up the state.
+# Returns the seconds per layer.
+def estimateLayerTimes(filename, index, limits):
+    state = estimateState()
+    times, filament = [], []
+    layerTimes = []
+    with open(filename, 'rb') as f:
+        for offset, length in [(0, index[0][2])] + [(offset, length) for layer, z, offset, length in index]:
+            f.seek(offset)
+            before = sum(times)
+            estimateBlock(f.read(length), state, limits, math.inf, times, filament)
+            layerTimes.append(sum(times) - before)
+    before = sum(times)
+    estimateBlock(b"", state, limits, math.inf, times, filament)
+    layerTimes[-1] += sum(times) - before
+    return(layerTimes[1:])
+
+# Parse Prusa-Slicer's "; estimated printing time (normal mode) = 1d 2h 3m 4s"
+def getSlicerPrintTime(metadata):
+    text = metadata.get("estimated printing time (normal mode)")
+    if not text:
+        return(None)
+    units = {"d": 86400, "h": 3600, "m": 60, "s": 1}
+    return(sum(int(number) * units[unit] for number, unit in re.findall(r'([0-9]+)([dhms])', text)))
+
+# Estimate the print time of gcodeFile and print the report. printerIni is
+# the printer profile with the limits (or "" to use those in the G-code).
+def printEstimate(gcodeFile, printerIni, startTemp, tempStep, transforms=()):
+    with timedStage("estimate"):
+        floorHeight = getFloorHeight()
+        times, filament = estimatePrintTime(gcodeFile, getPrinterLimits(printerIni, gcodeFile), floorHeight)
+    printTimeReport(times, filament, tempTransform(startTemp, tempStep, transforms),
+                    getSlicerPrintTime(readGCodeMetadata(gcodeFile)))
+
+# Print time and filament per floor and the total, compared to the estimate of
+# Prusa-Slicer. The temperatures are those of the temperature transform temp
+# (see tempTransform), as written by the M104 commands.
+def printTimeReport(times, filament, temp, slicerTime):
+    print()
+    print("{:>5} {:>6} {:>10} {:>12}".format("Floor", "Temp", "Time", "Filament"))
+    for floor, seconds in enumerate(times):
+        print("{:>5} {:>6} {:>10} {:>10.2f} m".format(floor + 1, round(transformValue(temp, floor)),
+              formatDuration(seconds), filament[floor] / 1000))
+    total = sum(times)
+    print("{:<12} {:>10} {:>10.2f} m".format("Total", formatDuration(total), sum(filament) / 1000))
+    if slicerTime:
+        print("{:<12} {:>10} (difference {:+.1f}%)".format("Prusa-Slicer", formatDuration(slicerTime),
+              (total - slicerTime) / slicerTime * 100))
+    print()
+
+###
+# Lookahead of the temperature changes
+###
+
+# Temperature set by the start G-code (the last one before the first layer)
+tempSetRe = re.compile(rb'^M10[49] [^;\n]*S([0-9.]+)', re.M)
+tempChangeRe = re.compile(rb'M104 S([0-9.]+)')
+moveLineRe = re.compile(rb'^G[01] ', re.M)
+
+# Move the M104 inserts of the temperature schedule earlier, so the hotend
+# reaches the new temperature when the floor starts. A change by dT takes
+# dT / heaterRate seconds. Going back from the layer of the change, whole
+# layers are skipped while their estimated time (layerTimes) fits, the rest
+# is taken from the moves at the end of the layer before, assuming all moves
+# of a layer take the same time. A change is not moved into the layer of the
+# previous one, nor into the first layer. Returns (inserts, report) with one
+# report row (floor, layer, temp, ramp seconds, layer of the M104, settle
+# seconds relative to the start of the layer, negative if before) per change.
+def leadInserts(filename, index, inserts, layerTimes, heaterRate, floorHeight):
+    offsets = [offset for layer, z, offset, length in index]
+    moved, report = [], []
+    with open(filename, 'rb') as f:
+        m = None
+        for m in tempSetRe.finditer(f.read(offsets[0])):
+            pass
+        temp = float(m.group(1)) if m else None
+        bound = 0
+        for offset, gcode in inserts:
+            target = float(tempChangeRe.match(gcode).group(1))
+            i = bisect.bisect_right(offsets, offset) - 1
+            ramp = abs(target - temp) / heaterRate if temp is not None else 0.0
+            lead = 0.0
+            k = i
+            while k - 1 > bound and lead + layerTimes[k - 1] <= ramp:
+                lead += layerTimes[k - 1]
+                k -= 1
+            moves = []
+            if k - 1 > bound and lead < ramp and layerTimes[k - 1] > 0:
+                moves = [move.start() for move in moveLineRe.finditer(readLayer(filename, index, k - 1))]
+            if moves:
+                k -= 1
+                n = int(len(moves) * (1 - (ramp - lead) / layerTimes[k]))
+                lead += layerTimes[k] * (len(moves) - n) / len(moves)
+                offset = offsets[k] + moves[n]
+            elif k < i:
+                f.seek(offsets[k])
+                offset = offsets[k] + len(f.readline())
+            moved.append((offset, gcode))
+            floor = max(math.ceil((index[i][1] - 0.001) / floorHeight) - 1, 0)
+            report.append((floor + 1, index[i][0], target, ramp, index[k][0], ramp - lead))
+            temp = target
+            bound = k
+    return((sorted(moved, key=lambda insert: insert[0]), report))
+
+# Print when the hotend is expected to have reached the temperature of each floor
+def printSettleReport(report, heaterRate):
+    print()
+    print("Heater ramp rate: {:.1f} C/s".format(heaterRate))
+    print("{:>5} {:>6} {:>8} {:>8} {:>10} {:>10}".format("Floor", "Temp", "Layer", "Ramp", "M104 at", "Settled"))
+    for floor, layer, temp, ramp, insertLayer, settle in report:
+        print("{:>5} {:>6g} {:>8} {:>6.1f} s {:>10} {:>+8.1f} s".format(
+              floor, temp, layer, ramp, "layer {}".format(insertLayer), settle))
+    print("(Settled: seconds after the start of the floor, negative if before)")
+    print()
+
+# Estimate print time and filament of the tower in gcodeFile and of the standard
+# tower with the same temperatures and profiles, which is created and sliced in
+# workDir (using the cache). Returns ((times, filament), (standard times, filament)).
+def estimateSavings(gcodeFile, startTemp, endTemp, tempStep, loadProfilesList, printerProfile, workDir,
+                    engine="openscad", useCache=True):
+    stlFile = os.path.join(workDir, "CT_Standard.stl")
+    standardGCode = os.path.join(workDir, "CT_Standard.gcode")
+    with timedStage("estimate"):
+        estimate = estimatePrintTime(gcodeFile, getPrinterLimits(printerProfile, gcodeFile), getFloorHeight())
+    with useGeometry(standardGeometry):
+        createSTL(startTemp, endTemp, tempStep, stlFile, engine, useCache)
+        createGCode(stlFile, standardGCode, loadProfilesList, useCache)
+        with timedStage("estimate"):
+            standard = estimatePrintTime(standardGCode, getPrinterLimits(printerProfile, standardGCode), getFloorHeight())
+    return((estimate, standard))
+
+# Print the print time and filament saved against the standard tower (see estimateSavings)
+def printSavingsReport(estimate, standard):
+    seconds, mm = sum(estimate[0]), sum(estimate[1])
+    standardSeconds, standardMM = sum(standard[0]), sum(standard[1])
+    print()
+    print("{:<16} {:>10} {:>12}".format("", "Time", "Filament"))
+    print("{:<16} {:>10} {:>10.2f} m".format("Standard tower", formatDuration(standardSeconds), standardMM / 1000))
+    print("{:<16} {:>10} {:>10.2f} m".format("This tower", formatDuration(seconds), mm / 1000))
+    saved = standardSeconds - seconds
+    print("{:<16} {:>10} {:>10.2f} m".format("Saved", ("-" if saved < 0 else "") + formatDuration(abs(saved)),
+          (standardMM - mm) / 1000))
+    if standardSeconds > 0 and standardMM > 0:
+        print("{:<16} {:>9.0f}% {:>11.0f}%".format("", (standardSeconds - seconds) / standardSeconds * 100,
+              (standardMM - mm) / standardMM * 100))
+    print()
+
+# Previous line by line implementation of the M104 injector (reference for --benchmark)
+def injectGCodeText(inFile, outFile, startTemp, tempStep, floorLayer, firstChange=2):
+    nextChange=firstChange
+    nextTemp=startTemp
+    gcodeInput = open(inFile, 'r')
+    gcodeOutput = open(outFile, 'w')
+    for LINE in gcodeInput:
+        gcodeOutput.write(LINE)
+        if re.match('^;CT_LAYER:[0-9]+$', LINE):
+            lineNum = int(re.sub('^;CT_LAYER:([0-9]+)','\\1',LINE))
+            if lineNum == nextChange:
+                gcodeOutput.write("M104 S" + str(nextTemp) + '\n')
+                if nextChange == firstChange:
+                    nextChange=floorLayer
+                else:
+                    nextChange+=floorLayer
+                nextTemp+=tempStep
+    gcodeInput.close()
+    gcodeOutput.close()
+
+# Write a synthetic G-code file with ;CT_LAYER markers like Prusa-Slicer would
+# create it. It ends after about size bytes or the given number of layers.
+def writeSyntheticGCode(filename, size=None, layers=None, layerHeight=0.2, movesPerLayer=400, firstLayerHeight=None):
+    if firstLayerHeight is None:
+        firstLayerHeight = layerHeight
+    body = "".join("G1 X%.3f Y%.3f E%.5f F1800\n" % (100 + (i % 40), 100 + (i * 7) % 30, 0.04)
+                   for i in range(movesPerLayer)).encode()
+    with open(filename, 'wb') as f:
+        f.write(b"; synthetic G-code\nG21\nG90\nM83\nM104 S215\nG28\n")
+        layer = 0
+        while (size is None or f.tell() < size) and (layers is None or layer < layers):
+            z = firstLayerHeight + layerHeight * layer
+            f.write(b";LAYER_CHANGE\n;Z:%.2f\n;CT_LAYER:%d\nG1 Z%.3f F7800\n" % (z, layer, z))
+            f.write(body)
+            layer += 1
+        f.write(b"M104 S0\nM84\n")
+
+# Measure the throughput of the M104 injector with synthetic G-code
+def benchmarkInjector(size=100 * 1024 * 1024, directory="."):
+    inFile = os.path.join(directory, "CT_Bench.gcode")
+    outFile = os.path.join(directory, "CT_Bench-out.gcode")
+    refFile = os.path.join(directory, "CT_Bench-ref.gcode")
+    print("M104 injector with {} MB synthetic G-code".format(size // 1024 // 1024))
+    writeSyntheticGCode(inFile, size=size)
+    mb = os.path.getsize(inFile) / 1024 / 1024
+
+    start = time.perf_counter()
+    injectGCodeText(inFile, refFile, 190, 5, 50)
+    tText = time.perf_counter() - start
+
+    start = time.perf_counter()
+    injectGCode(inFile, outFile, tempChanges(190, 5, 50))
+    tStream = time.perf_counter() - start
+
+    print("  line by line (text):  {:10.1f} MB/s".format(mb / tText))
+    print("  streaming (bytes):    {:10.1f} MB/s".format(mb / tStream))
+    if fileHash(refFile) != fileHash(outFile):
+        print("  WARNING: Results differ!")
+    for f in (inFile, outFile, refFile):
+        os.remove(f)
+    print()
+
+# Determine Z-size of a STL using Prusa-Slicer (reference for --benchmark)
+def getSTLZSizeSlicer(filename):
     sp = subprocess.run([cmdPrusaSlicer, "--info", filename], 
                          capture_output=True, text=True)
     ini = configparser.ConfigParser()
     ini.read_string(sp.stdout)
-    return(ini[filename]["size_z"])
+    return(ini[os.path.basename(filename)]["size_z"])
+
+# Compare native STL reader against Prusa-Slicer's "--info"
+def benchmarkSTLZSize(filename, runs=20):
+    print("STL Z-size of "+filename)
+    start = time.perf_counter()
+    ref = getSTLZSizeSlicer(filename)
+    tSlicer = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for i in range(runs):
+        size = getSTLZSize(filename, useCache=False)
+    tNative = (time.perf_counter() - start) / runs
+
+    getSTLZSize(filename)
+    start = time.perf_counter()
+    for i in range(runs):
+        getSTLZSize(filename)
+    tCached = (time.perf_counter() - start) / runs
+
+    print("  prusa-slicer --info: {:>12}  {:10.3f} ms".format(ref, tSlicer * 1000))
+    print("  native reader:       {:>12}  {:10.3f} ms".format(size, tNative * 1000))
+    print("  native (cached):     {:>12}  {:10.3f} ms".format(size, tCached * 1000))
+    if float(ref) != float(size):
+        print("  WARNING: Results differ!")
+    print()
+
+# Compare a tower STL (11 floors) as ASCII and as binary intermediate: size and
+# parse time of the native reader and of Prusa-Slicer's "--info"
+def benchmarkIntermediateSTL(directory=scratchDir, runs=5):
+    mesh = joinMeshes([(loadSTLMesh(requiredFiles["stlStand"]), 0)] +
+                      [(loadSTLMesh(requiredFiles["stlFloor"]), 10 * i) for i in range(11)])
+    asciiFile = os.path.join(directory, "CT_Bench-ascii.stl")
+    binaryFile = os.path.join(directory, "CT_Bench-binary.stl")
+    writeSTLMeshASCII(mesh, asciiFile)
+    writeSTLMesh(mesh, binaryFile)
+    print("Intermediate STL of an 11 floor tower in " + directory)
+    for name, filename in (("ASCII", asciiFile), ("binary", binaryFile)):
+        start = time.perf_counter()
+        for i in range(runs):
+            loadSTLMesh(filename)
+        tNative = (time.perf_counter() - start) / runs
+        start = time.perf_counter()
+        getSTLZSizeSlicer(filename)
+        tSlicer = time.perf_counter() - start
+        print("  {:<7} {:8.1f} MB   native {:10.3f} ms   prusa-slicer --info {:10.3f} ms".format(
+              name, os.path.getsize(filename) / 1024 / 1024, tNative * 1000, tSlicer * 1000))
+        os.remove(filename)
+    print()
+
+# Run an external tool. Raises ToolError with the tool's output if it fails.
+def runTool(cmd):
+    rc = runProcess(cmd)
+    if rc.returncode != 0:
+        raise ToolError(rc.stdout)
+    return(rc)
+
+# Flatten the profiles of loadProfilesList into one config file, so Prusa-Slicer
+# loads a single file. Later profiles override earlier ones, like with several
+# --load options. The config bundle is cached by the hashes of the profiles.
+# It is worked out from the current profiles before each slicer run, so edited
+# profiles are used and an evicted bundle is written again.
+# Returns the --load arguments of the bundle.
+def getConfigBundle(loadProfilesList):
+    profiles = loadProfilesList[1::2]
+    if len(profiles) < 2:
+        return(loadProfilesList)
+    entry = configBundleEntry(profiles)
+    with cacheLock:
+        if isfile(entry):
+            os.utime(entry)
+            return([ "--load", entry ])
+    values = {}
+    for profile in profiles:
+        values.update(readIniValues(profile))
+    os.makedirs(os.path.dirname(entry), exist_ok=True)
+    tmp = "{}.{}-{}.tmp".format(entry, os.getpid(), threading.get_ident())
+    with open(tmp, 'w', encoding="utf-8", newline="\n") as f:
+        f.write("# config bundle of {} profiles, generated by SmartTemperatureTower.py\n".format(len(profiles)))
+        for key, value in values.items():
+            f.write(key + " = " + value + "\n")
+    with cacheLock:
+        os.replace(tmp, entry)
+    return([ "--load", entry ])
+
+# Cache entry of the config bundle of profiles (by their current content)
+def configBundleEntry(profiles):
+    return(os.path.join(cacheDir, "config", cacheKey("config", [fileHash(p) for p in profiles]) + ".ini"))
+
+# Get the --load arguments for Prusa-Slicer. Empty profile names are skipped.
+# They are flattened into one config bundle for each slicer run (see getConfigBundle).
+# The profiles are looked up in iniDir (default: iniPSD).
+def getLoadProfilesList(printProfile, printerProfile, filamentProfile, iniDir=None):
+    iniDir = iniPSD if iniDir == None else iniDir
+    loadProfilesList = []
+    for kind, name in (("print", printProfile), ("printer", printerProfile), ("filament", filamentProfile)):
+        if name == "":
+            continue
+        profile = os.path.join(iniDir, kind, name)
+        if not isfile(profile):
+            raise ProfileError(kind, profile)
+        loadProfilesList.append("--load")
+        loadProfilesList.append(profile)
+    return(loadProfilesList)
+
+# STEP 1: Create STL file of the Calibration Tower. It is always binary STL;
+# ASCII STL of older OpenSCAD versions is converted. The native engine renders
+# missing parts with up to workers OpenSCAD processes.
+# Returns how it was created ("", "cached", "native" or the converted size).
+def createSTL(tfirst, tlast, tstep, stlFile, engine="openscad", useCache=True, workers=1):
+    with timedStage("render STL"):
+        if isfile(stlFile):
+            os.remove(stlFile)
+        if engine == "native":
+            rendered = buildTowerNative(tfirst, tlast, tstep, stlFile, workers)
+            return("native" + (", {} parts rendered".format(rendered) if rendered else ""))
+        if useCache and cacheGet("stl", towerSTLKey(tfirst, tlast, tstep), stlFile):
+            convertSTLToBinary(stlFile)
+            return("cached")
+        rc = runOpenScad( [ "-o", stlFile,
+                            "-D", "tfirst=" + str(tfirst), "-D", "tlast=" + str(tlast),
+                            "-D", "tstep=" + str(tstep), *geometryDefines(), requiredFiles["scadFile"] ] )
+        if rc.returncode != 0:
+            raise ToolError(rc.stdout)
+        asciiSize = convertSTLToBinary(stlFile)
+        if useCache:
+            cachePut("stl", towerSTLKey(tfirst, tlast, tstep), stlFile)
+        if asciiSize is not None:
+            return("converted from {:.1f} MB ASCII STL".format(asciiSize / 1024 / 1024))
+        return("")
+
+# Cache key of a sliced G-code file. It covers the STL (or list of STLs), the
+# content of all loaded profiles, the slicing arguments and the Prusa-Slicer version.
+def slicedGCodeKey(stlFile, loadProfilesList, sliceArgs):
+    stlHash = fileHash(stlFile) if isinstance(stlFile, str) else [fileHash(f) for f in stlFile]
+    return(cacheKey("gcode", stlHash, [fileHash(p) for p in loadProfilesList[1::2]],
+                    sliceArgs, getToolVersion(cmdPrusaSlicer, "--help")) + ".gcode.gz")
+
+# Arguments for Prusa-Slicer, which influence the sliced result
+sliceArgs = [ "--center", "120,120", "--before-layer-gcode", ";CT_LAYER:[layer_num]" ]
+
+# Prusa-Slicer command line to slice stlFile (or a list of STLs) into gcodeFile
+def sliceCommand(stlFile, gcodeFile, loadProfilesList, args=sliceArgs):
+    return( [ cmdPrusaSlicer, "--loglevel", "2", "--printer-technology", "FFF",
+                              *args,
+                              *loadProfilesList,
+                              "--export-gcode", "--loglevel", "1",
+                              "--output", gcodeFile,
+                              *([ stlFile ] if isinstance(stlFile, str) else stlFile) ] )
+
+# STEP 2: Create GCODE file using Prusa Slicer
+# Returns how it was created ("" or "cached").
+def createGCode(stlFile, gcodeFile, loadProfilesList, useCache=True, args=sliceArgs):
+    with timedStage("slice"):
+        if isfile(gcodeFile):
+            os.remove(gcodeFile)
+        if useCache:
+            key = slicedGCodeKey(stlFile, loadProfilesList, args)
+            if cacheGet("gcode", key, gcodeFile, compressed=True):
+                return("cached")
+        runTool(sliceCommand(stlFile, gcodeFile, getConfigBundle(loadProfilesList), args))
+        if useCache:
+            cachePut("gcode", key, gcodeFile, compressed=True)
+        return("")
+
+# STEP 3: Insert M104 (set temp) on floor changes. The floor boundaries are
+# found by Z using the layer index. If saveIndex is set, the layer index of
+# the output file is stored as its sidecar file. gcodeOut is a filename or a
+# GCodeWriter (no layer index then). The G-code of further transforms (see
+# parseTransform) is inserted in the same pass. A layer index of gcodeIn
+# already at hand can be passed as index.
+# With heaterRate (C/s), the M104 commands are moved earlier using the layer
+# times estimated with the printer limits (see leadInserts), the other
+# transforms stay at the floor changes. Returns the settle report then.
+def addM104(gcodeIn, gcodeOut, startTemp, tempStep, saveIndex=False, transforms=(), index=None,
+            heaterRate=None, limits=None):
+    report = None
+    with timedStage("inject M104"):
+        if index is None:
+            index = getLayerIndex(gcodeIn)
+        floorHeight = getFloorHeight()
+        if heaterRate is None:
+            inserts = floorInserts(gcodeIn, index, towerChanges(startTemp, tempStep, floorHeight, transforms))
+        else:
+            temps = [transform for transform in transforms if transform["name"] == "temp"]
+            others = [floorChanges(transform, floorHeight) for transform in transforms if transform["name"] != "temp"]
+            inserts = floorInserts(gcodeIn, index, towerChanges(startTemp, tempStep, floorHeight, temps))
+            with timedStage("estimate layers"):
+                layerTimes = estimateLayerTimes(gcodeIn, index, limits)
+            inserts, report = leadInserts(gcodeIn, index, inserts, layerTimes, heaterRate, floorHeight)
+            inserts = sorted(inserts + floorInserts(gcodeIn, index, fusedChanges(others)), key=lambda insert: insert[0])
+        injectAtOffsets(gcodeIn, gcodeOut, inserts)
+        if saveIndex:
+            saveLayerIndex(gcodeOut, shiftLayerIndex(index, inserts))
+    return(report)
+
+# Arguments for Prusa-Slicer to slice a part of a split tower. The parts are
+# placed by createSplitSTLs, so they must not be arranged.
+splitSliceArgs = [ "--dont-arrange", "--before-layer-gcode", ";CT_LAYER:[layer_num]" ]
+
+# STEP 1 split: Create one STL per part of the tower for slicing in parallel.
+# Part 0 is the stand with the first floor, part k is floor k. Each part holds
+# the floors next to it as context, so the layers of its own floor are sliced
+# like in the whole tower (no top or bottom surfaces at the seams). All parts
+# are placed in XY where "--center 120,120" puts the whole tower.
+# Missing floors are rendered by up to workers OpenSCAD processes first.
+# Returns [(stlFile, zOffset, zFrom, zTo)]: the part's layers with
+# zFrom < Z + zOffset <= zTo are kept.
+def createSplitSTLs(tfirst, tlast, tstep, directory, workers=1):
+    with timedStage("render STL"):
+        temps = getFloorTemps(tfirst, tlast, tstep)
+        if not temps:
+            return([])
+        renderParts([(part, temp) for part, temp, z in towerParts(tfirst, tlast, tstep)] + [("floor", temps[0])], workers)
+        h = towerGeometry["floor_height"]
+        meshes = [getPartMesh("base" if i == 0 else "floor", temp) for i, temp in enumerate(temps)]
+        base = [(meshes[0], 0)] + [(mesh, h) for mesh in meshes[1:2]]
+        xmin, xmax, ymin, ymax = getMeshXYRange(joinMeshes(base))
+        dx = 120 - (xmin + xmax) / 2
+        dy = 120 - (ymin + ymax) / 2
+
+        parts = []
+        for i in range(len(temps)):
+            if i == 0:
+                stack, zOffset = base, 0
+            else:
+                stack = [(getPartMesh("floor", temps[i - 1]), 0), (meshes[i], h)]
+                stack += [(mesh, 2 * h) for mesh in meshes[i + 1:i + 2]]
+                zOffset = h * (i - 1)
+            stlFile = os.path.join(directory, "CT_Part{}.stl".format(i))
+            writeSTLMesh(joinMeshes(stack, dx, dy), stlFile)
+            parts.append((stlFile, zOffset, h * i if i > 0 else -math.inf,
+                          h * (i + 1) if i < len(temps) - 1 else math.inf))
+        return(parts)
+
+# Get the values of all loaded profiles (see getLoadProfilesList)
+def getProfileValues(loadProfilesList):
+    values = {}
+    for profile in loadProfilesList[1::2]:
+        values.update(readIniValues(profile))
+    return(values)
+
+# Get (first layer height, layer height) from the loaded profiles, None if
+# they are not set there. A first layer height in % is relative to the layer height.
+def getProfileLayerHeights(loadProfilesList):
+    values = getProfileValues(loadProfilesList)
+    try:
+        layerHeight = float(values["layer_height"])
+        firstLayer = values["first_layer_height"]
+        if firstLayer.endswith("%"):
+            return((layerHeight * float(firstLayer[:-1]) / 100, layerHeight))
+        return((float(firstLayer), layerHeight))
+    except (KeyError, ValueError):
+        return(None)
+
+# Get (first layer height, layer height) of a sliced G-code file from its
+# configuration comments, else from the Z of its first two layers
+def getGCodeLayerHeights(filename):
+    metadata = readGCodeMetadata(filename)
+    try:
+        return((float(metadata["first_layer_height"]), float(metadata["layer_height"])))
+    except (KeyError, ValueError):
+        index = buildLayerIndex(filename)
+        return((index[0][1], index[1][1] - index[0][1]))
+
+# First layer height of a part starting at zOffset, so its layers end at the
+# same Z as the layers of the whole tower
+def alignedFirstLayer(zOffset, firstLayer, layerHeight):
+    rest = (zOffset - firstLayer) % layerHeight
+    if rest > layerHeight - 1e-6:
+        rest = 0
+    height = layerHeight - rest
+    if height < 0.5 * layerHeight:
+        height += layerHeight
+    return(height)
+
+# Lines of a part changed when stitching: the Z of moves and ;Z: comments, the
+# ;CT_LAYER markers (renumbered) and M73 progress (dropped, it is per part)
+stitchRe = re.compile(rb'^(?:(G[01] [^;\n]*Z)([-0-9.]+)|(;Z:)([-0-9.]+)$|;CT_LAYER:[0-9]+$|M73 [^\n]*\n)', re.M)
+eMoveRe = re.compile(rb'^G(?:[01]|92) [^;\n]*E([-0-9.]+)', re.M)
+
+# Format a Z value like Prusa-Slicer (no trailing zeros)
+def formatZ(z):
+    return(("%.3f" % z).rstrip("0").rstrip(".").encode())
+
+# Get the absolute E position at offset end of buf (last E of a move or G92)
+def lastE(buf, end):
+    while end > 0:
+        start = buf.rfind(b"\n", 0, max(end - 65536, 0)) + 1
+        e = None
+        for m in eMoveRe.finditer(buf, start, end):
+            e = m.group(1)
+        if e is not None:
+            return(float(e))
+        end = start
+    return(0.0)
+
+# Stitch the sliced parts [(gcodeFile, zOffset, zFrom, zTo)] into one G-code
+# file. Each part contributes the layers with zFrom < Z <= zTo (after adding
+# zOffset), the first part also its start G-code and the last part its end
+# G-code. With absolute E, a G92 at each seam sets the E position the part expects.
+def stitchGCode(parts, gcodeFile):
+    state = {"layer": 0, "dz": 0}
+    def rewrite(m):
+        if m.group(1) is not None or m.group(3) is not None:
+            if state["dz"] == 0:
+                return(m.group(0))
+            prefix, z = (m.group(1), m.group(2)) if m.group(1) is not None else (m.group(3), m.group(4))
+            return(prefix + formatZ(float(z) + state["dz"]))
+        if m.group(0).startswith(b"M73"):
+            return(b"")
+        state["layer"] += 1
+        return(b";CT_LAYER:%d" % (state["layer"] - 1))
+
+    relativeE = True
+    with open(gcodeFile, 'wb') as out:
+        for i, (partFile, zOffset, zFrom, zTo) in enumerate(parts):
+            index = buildLayerIndex(partFile)
+            with open(partFile, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                # Cut at the ;LAYER_CHANGE before the marker, so ;Z: stays with its layer
+                seams = []
+                prevOffset = 0
+                for layer, z, offset, length in index:
+                    cut = mm.rfind(b";LAYER_CHANGE\n", prevOffset, offset)
+                    seams.append((z + zOffset, offset if cut < 0 else cut))
+                    prevOffset = offset
+                start = 0 if i == 0 else next((cut for z, cut in seams if z > zFrom + 1e-4), len(mm))
+                end = len(mm) if i == len(parts) - 1 else next((cut for z, cut in seams if z > zTo + 1e-4), len(mm))
+                if i == 0:
+                    relativeE = mm.rfind(b"\nM83", 0, end) > mm.rfind(b"\nM82", 0, end)
+                elif not relativeE:
+                    out.write(b"G92 E%.5f\n" % lastE(mm, start))
+                state["dz"] = zOffset
+                out.write(stitchRe.sub(rewrite, mm[start:end]))
+
+# STEP 2 split: Slice the parts of createSplitSTLs with workers parallel
+# Prusa-Slicer processes and stitch them into gcodeFile. The first layer
+# height of each part is chosen so its layers match the whole tower. The
+# layer heights are taken from the profiles or else from the sliced first part.
+# Returns how the G-code was created.
+def createGCodeSplit(parts, gcodeFile, loadProfilesList, workers, useCache=True):
+    if isfile(gcodeFile):
+        os.remove(gcodeFile)
+    gcodeParts = [(os.path.splitext(stlFile)[0] + ".gcode", zOffset, zFrom, zTo)
+                  for stlFile, zOffset, zFrom, zTo in parts]
+    heights = getProfileLayerHeights(loadProfilesList)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+        futures = [pool.submit(createGCode, parts[0][0], gcodeParts[0][0], loadProfilesList, useCache, splitSliceArgs)]
+        if heights is None:
+            futures[0].result()
+            heights = getGCodeLayerHeights(gcodeParts[0][0])
+        for (stlFile, zOffset, zFrom, zTo), (partGCode, *rest) in zip(parts[1:], gcodeParts[1:]):
+            args = splitSliceArgs + ["--first-layer-height", "%.4f" % alignedFirstLayer(zOffset, *heights)]
+            futures.append(pool.submit(createGCode, stlFile, partGCode, loadProfilesList, useCache, args))
+        results = [future.result() for future in futures]
+    with timedStage("stitch"):
+        stitchGCode(gcodeParts, gcodeFile)
+    cached = results.count("cached")
+    return("{} parts".format(len(parts)) + (", {} cached".format(cached) if cached else ""))
+
+###
+# Multi-tower plates
+###
+
+# Printer settings for the placement of several towers (Prusa-Slicer defaults)
+plateDefaults = {
+    "bed_shape": "0x0,200x0,200x200,0x200",
+    "duplicate_distance": "6",
+    "extruder_clearance_radius": "20",
+    "extruder_clearance_height": "20"
+}
+
+# Arguments for Prusa-Slicer to slice the towers placed by createTowerPlate as
+# objects of one plate. Each object is labeled, so the injector knows the tower.
+plateSliceArgs = [ "--merge", "--dont-arrange", "--gcode-label-objects",
+                   "--before-layer-gcode", ";CT_LAYER:[layer_num]" ]
+
+# Object label of Prusa-Slicer, the tower number is part of the STL name
+towerObjectRe = re.compile(rb'^; printing object [^\n]*?CT_Tower-([0-9]+)', re.M)
+
+# Parse a tower given as START:END:STEP, returns (startTemp, endTemp, tempStep)
+def parseTower(text):
+    fields = text.split(":")
+    if len(fields) != 3:
+        raise ValueError("expected START:END:STEP")
+    tower = tuple(int(field) for field in fields)
+    checkTempRange(*tower)
+    return(tower)
+
+# Get the bed as (xmin, xmax, ymin, ymax) from a bed_shape like "0x0,250x0,250x210,0x210"
+def parseBedShape(text):
+    points = [tuple(float(v) for v in point.split("x")) for point in text.split(",")]
+    return((min(p[0] for p in points), max(p[0] for p in points),
+            min(p[1] for p in points), max(p[1] for p in points)))
+
+# Pack rectangles (width, depth) on the bed (xmin, xmax, ymin, ymax) in rows
+# (shelf packing, deepest first), gap apart. The packed block is centered on
+# the bed. Returns the centers in the order of sizes, or None if they do not fit.
+def packFootprints(sizes, bed, gap):
+    bedWidth, bedDepth = bed[1] - bed[0], bed[3] - bed[2]
+    centers = [None] * len(sizes)
+    x = y = rowDepth = width = 0.0
+    for i in sorted(range(len(sizes)), key=lambda i: -sizes[i][1]):
+        w, d = sizes[i]
+        if x > 0 and x + w > bedWidth:
+            y += rowDepth + gap
+            x = rowDepth = 0.0
+        if x + w > bedWidth or y + d > bedDepth:
+            return(None)
+        centers[i] = (x + w / 2, y + d / 2)
+        x += w + gap
+        rowDepth = max(rowDepth, d)
+        width = max(width, x - gap)
+    ox = bed[0] + (bedWidth - width) / 2
+    oy = bed[2] + (bedDepth - y - rowDepth) / 2
+    return([(ox + cx, oy + cy) for cx, cy in centers])
+
+# STEP 1 for several towers: create the STL of each tower (see createSTL) and
+# place them on the bed of the printer profile. The towers are printed one
+# after another (complete_objects) if all but the tallest are lower than the
+# extruder clearance and they fit with the clearance radius between them.
+# Otherwise they can only be printed together, layer by layer, which changes
+# the temperature for each object on every layer: this raises ValueError
+# unless interleave is set.
+# Returns ([stlFile, ...], sequential).
+def createTowerPlate(towers, directory, loadProfilesList, engine="openscad", useCache=True, workers=1,
+                     interleave=False):
+    values = dict(plateDefaults)
+    values.update(getProfileValues(loadProfilesList))
+    bed = parseBedShape(values["bed_shape"])
+    meshes = []
+    for i, tower in enumerate(towers):
+        stlFile = os.path.join(directory, "CT_Tower-{}.stl".format(i))
+        createSTL(*tower, stlFile, engine, useCache, workers)
+        meshes.append(loadSTLMesh(stlFile))
+    ranges = [getMeshXYRange(mesh) for mesh in meshes]
+    sizes = [(xmax - xmin, ymax - ymin) for xmin, xmax, ymin, ymax in ranges]
+    heights = sorted(towerGeometry["floor_height"] * len(getFloorTemps(*tower)) for tower in towers)
+
+    centers = None
+    # Only the towers printed before the last one must stay below the gantry
+    sequential = len(heights) < 2 or heights[-2] <= float(values["extruder_clearance_height"])
+    if sequential:
+        centers = packFootprints(sizes, bed, float(values["extruder_clearance_radius"]))
+        sequential = centers is not None
+    if not sequential and not interleave:
+        if len(heights) > 1 and heights[-2] > float(values["extruder_clearance_height"]):
+            reason = "all towers but the tallest must be at most {} mm high (extruder_clearance_height), the second tallest is {:g} mm".format(
+                     values["extruder_clearance_height"], heights[-2])
+        else:
+            reason = "they do not fit on the bed {} with {} mm between them (extruder_clearance_radius)".format(
+                     values["bed_shape"], values["extruder_clearance_radius"])
+        raise ValueError("The towers cannot be printed one after another: " + reason +
+                         ". Use --interleave to print them together, layer by layer")
+    if centers is None:
+        centers = packFootprints(sizes, bed, float(values["duplicate_distance"]))
+    if centers is None:
+        raise ValueError("{} towers do not fit on the bed {}".format(len(towers), values["bed_shape"]))
+
+    stlFiles = []
+    for i, (mesh, (xmin, xmax, ymin, ymax), (cx, cy)) in enumerate(zip(meshes, ranges, centers)):
+        stlFile = os.path.join(directory, "CT_Tower-{}.stl".format(i))
+        writeSTLMesh(joinMeshes([(mesh, 0)], cx - (xmin + xmax) / 2, cy - (ymin + ymax) / 2), stlFile)
+        stlFiles.append(stlFile)
+    return((stlFiles, sequential))
+
+# Insert positions for the temperatures of several towers: after each object
+# label, the temperature of the floor the object is printed at is set if it
+# differs from the last one. Like for a single tower, the bottom layers of the
+# first object use the default temperature. When printed one after another,
+# the first layer of the next tower waits for its temperature (M109).
+def towerInserts(buf, towers, floorHeight, sequential, firstChange=2):
+    temps = [getFloorTemps(*tower) for tower in towers]
+    layers = [(start, z) for layer, z, start, end in findMarkers(buf)]
+    inserts = []
+    state = {"temp": None, "tower": None}
+    seen = [(-math.inf, 0) for tower in towers]
+    i = 0
+    z = 0.0
+    for m in towerObjectRe.finditer(buf):
+        while i < len(layers) and layers[i][0] < m.start():
+            z = layers[i][1]
+            i += 1
+        tower = int(m.group(1))
+        lastZ, count = seen[tower]
+        if z > lastZ + 1e-6:
+            seen[tower] = (z, count + 1)
+            count += 1
+        floor = max(math.ceil((z - 0.001) / floorHeight) - 1, 0)
+        temp = temps[tower][min(floor, len(temps[tower]) - 1)]
+        switched = state["tower"] is not None and tower != state["tower"]
+        state["tower"] = tower
+        if state["temp"] is None and count <= firstChange:
+            continue
+        if temp == state["temp"]:
+            continue
+        state["temp"] = temp
+        end = buf.find(b"\n", m.end()) + 1 or len(buf)
+        inserts.append((end, b"%s S%d\n" % (b"M109" if sequential and switched else b"M104", temp)))
+    return(inserts)
+
+# STEP 2 for several towers: slice all towers in one Prusa-Slicer run
+# Returns how it was created ("" or "cached").
+def createPlateGCode(stlFiles, gcodeFile, loadProfilesList, sequential, useCache=True):
+    args = plateSliceArgs + ([ "--complete-objects" ] if sequential else [])
+    return(createGCode(stlFiles, gcodeFile, loadProfilesList, useCache, args))
+
+# STEP 3 for several towers: insert the temperatures of each tower (see towerInserts)
+def addTowerTemps(gcodeIn, gcodeOut, towers, sequential, saveIndex=False):
+    with timedStage("inject M104"):
+        floorHeight = getFloorHeight()
+        with open(gcodeIn, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            inserts = towerInserts(mm, towers, floorHeight, sequential)
+        injectAtOffsets(gcodeIn, gcodeOut, inserts)
+        if saveIndex:
+            saveLayerIndex(gcodeOut, shiftLayerIndex(buildLayerIndex(gcodeIn), inserts))
+
+# Get the name of the resulting gcode file
+def getGCodeFile(gcodePrefix, startTemp, endTemp, tempStep, fmt="gcode"):
+    return(gcodePrefix + "-" + str(startTemp) + "-" + str(endTemp) + "-" + str(tempStep) + gcodeFormats[fmt])
+
+# Get the name of the resulting gcode file of several towers
+def getPlateGCodeFile(gcodePrefix, towers, fmt="gcode"):
+    return(gcodePrefix + "-" + "+".join("{}-{}-{}".format(*tower) for tower in towers) + gcodeFormats[fmt])
+
+# Read batch jobs from a CSV file. Columns (with header line):
+#   startTemp,endTemp,tempStep,printIni,printerIni,filamentIni,gcodePrefix
+# Empty profile columns use the profiles from SmartTemperatureTower.ini.
+# All jobs are written in the output format fmt (see GCodeWriter), saveIndex
+# writes the layer index of plain GCODE. heaterRate sets the temperatures
+# earlier (see leadInserts).
+def readBatchJobs(filename, printProfile, printerProfile, filamentProfile, transforms=(), fmt="gcode", strip=False,
+                  saveIndex=False, heaterRate=None):
+    jobs = []
+    with open(filename, 'r', newline='') as f:
+        for row in csv.DictReader(f, skipinitialspace=True):
+            if not any(row.values()):
+                continue
+            job = {
+                "startTemp": int(row["startTemp"]),
+                "endTemp": int(row["endTemp"]),
+                "tempStep": int(row["tempStep"]),
+                "printIni": row.get("printIni") or printProfile,
+                "printerIni": row.get("printerIni") or printerProfile,
+                "filamentIni": row.get("filamentIni") or filamentProfile,
+                "gcodePrefix": row.get("gcodePrefix") or "CalibrationTower",
+                "transforms": transforms,
+                "format": fmt,
+                "strip": strip,
+                "index": saveIndex,
+                "heaterRate": heaterRate,
+                "times": {},
+                "status": "OK"
+            }
+            checkTempRange(job["startTemp"], job["endTemp"], job["tempStep"])
+            job["gcodeFile"] = getGCodeFile(job["gcodePrefix"], job["startTemp"], job["endTemp"], job["tempStep"], fmt)
+            jobs.append(job)
+    return(jobs)
+
+# Create STL file of one geometry for the batch, returns the time needed
+def batchSTL(stlFile, tfirst, tlast, tstep, engine, useCache):
+    start = time.perf_counter()
+    createSTL(tfirst, tlast, tstep, stlFile, engine, useCache)
+    return(time.perf_counter() - start)
+
+# Slice one batch job and insert the M104 commands. With uploadUrl, the GCODE
+# is also uploaded (the connections to the host are shared between the jobs).
+def batchGCode(job, stlFile, gcodeTemp, useCache, uploadUrl=None, apiKey=None):
+    try:
+        start = time.perf_counter()
+        createGCode(stlFile, gcodeTemp, job["loadProfilesList"], useCache)
+        job["times"]["slice"] = time.perf_counter() - start
+        start = time.perf_counter()
+        limits = None
+        if job["heaterRate"] != None:
+            printerIni = os.path.join(iniPSD, "printer", job["printerIni"]) if job["printerIni"] != "" else ""
+            limits = getPrinterLimits(printerIni, gcodeTemp)
+        with atomicOutput(job["gcodeFile"]) as gcodePartial:
+            if uploadUrl == None and job["format"] == "gcode" and not job["strip"]:
+                addM104(gcodeTemp, gcodePartial, job["startTemp"], job["tempStep"], job["index"], job["transforms"],
+                        heaterRate=job["heaterRate"], limits=limits)
+            else:
+                upload = GCodeUpload(uploadUrl, os.path.basename(job["gcodeFile"]), apiKey=apiKey) if uploadUrl != None else None
+                metadata = readGCodeMetadata(gcodeTemp) if job["format"] == "bgcode" else None
+                out = GCodeWriter(gcodePartial, job["format"], job["strip"], metadata, upload)
+                try:
+                    addM104(gcodeTemp, out, job["startTemp"], job["tempStep"], transforms=job["transforms"],
+                            heaterRate=job["heaterRate"], limits=limits)
+                finally:
+                    out.close()
+        job["times"]["m104"] = time.perf_counter() - start
+        if uploadUrl != None:
+            upload.finish()
+            job["upload"] = "OK" if upload.error == None else "Upload failed: " + upload.error
+            if upload.error != None:
+                job["status"] = job["upload"]
+    finally:
+        if isfile(gcodeTemp):
+            os.remove(gcodeTemp)
+
+# Run batch jobs on a pool of workers. Each distinct geometry (temperature range)
+# is rendered once, its jobs are sliced as soon as the STL file is ready.
+# Intermediate files are kept in a private directory inside scratchDir.
+def runBatch(jobs, workers, engine="openscad", useCache=True, uploadUrl=None, apiKey=None):
+    geometries = {}
+    for job in jobs:
+        try:
+            job["loadProfilesList"] = getLoadProfilesList(job["printIni"], job["printerIni"], job["filamentIni"])
+        except ProfileError as e:
+            job["status"] = "Missing " + e.kind + " profile"
+            continue
+        geometries.setdefault((job["startTemp"], job["endTemp"], job["tempStep"]), []).append(job)
+    getSTLZSize(requiredFiles["stlFloor"])  # fill STL info cache before the workers start
+
+    workDir = tempfile.mkdtemp(prefix="CT_", dir=scratchDir)
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            stlFutures = {}
+            for key in geometries:
+                stlFile = os.path.join(workDir, "CT_Temp-{}-{}-{}.stl".format(*key))
+                stlFutures[pool.submit(batchSTL, stlFile, *key, engine, useCache)] = (key, stlFile)
+            gcodeFutures = {}
+            for future in concurrent.futures.as_completed(stlFutures):
+                key, stlFile = stlFutures[future]
+                try:
+                    stlTime = future.result()
+                except (ToolError, OSError) as e:
+                    for job in geometries[key]:
+                        job["status"] = "STL failed: " + str(e).strip().split("\n")[-1]
+                    continue
+                for job in geometries[key]:
+                    job["times"]["stl"] = stlTime
+                    gcodeTemp = os.path.join(workDir, "CT_Temp-{}.gcode".format(jobs.index(job)))
+                    gcodeFutures[pool.submit(batchGCode, job, stlFile, gcodeTemp, useCache, uploadUrl, apiKey)] = job
+            for future in concurrent.futures.as_completed(gcodeFutures):
+                job = gcodeFutures[future]
+                try:
+                    future.result()
+                except (ToolError, OSError) as e:
+                    job["status"] = "GCODE failed: " + str(e).strip().split("\n")[-1]
+    finally:
+        shutil.rmtree(workDir, ignore_errors=True)
+
+# Print the result table of a batch run
+def printBatchSummary(jobs):
+    print()
+    print("{:<40} {:>9} {:>9} {:>9}  {}".format("gcodeFile", "STL [s]", "Slice [s]", "M104 [s]", "Status"))
+    shared = {}
+    for job in jobs:
+        key = (job["startTemp"], job["endTemp"], job["tempStep"])
+        shared[key] = shared.get(key, 0) + 1
+    for job in jobs:
+        times = job["times"]
+        key = (job["startTemp"], job["endTemp"], job["tempStep"])
+        stl = "{:.2f}".format(times["stl"]) if "stl" in times else "-"
+        if shared[key] > 1 and "stl" in times:
+            stl += "*"
+        print("{:<40} {:>9} {:>9} {:>9}  {}".format(job["gcodeFile"], stl,
+              "{:.2f}".format(times["slice"]) if "slice" in times else "-",
+              "{:.2f}".format(times["m104"]) if "m104" in times else "-", job["status"]))
+    if max(shared.values(), default=0) > 1:
+        print()
+        print("* STL file shared between jobs with the same temperatures")
+    print()
+
+# Print output of a failed tool
+def printToolError(e):
+    print("- ERROR: RC != 0")
+    print("Error output was:")
+    print(e)
+    print()
 
 # Print error messaga about missing tools or profiles
 def toolNotFound(toolname,toolpath):
@@ -66,238 +2749,712 @@ def toolNotFound(toolname,toolpath):
     print("       "+toolpath)
 
 
+# Configuration file
+cfgFile = "SmartTemperatureTower.ini"
+
+# Settings of the process that come from the configuration file
+processSettings = ("cmdOpenScad", "cmdPrusaSlicer", "iniPSD", "scratchDir", "cacheDir", "cacheMaxSize", "cacheMaxAge")
+
+# Read the configuration file (if existing) without changing anything.
+# Returns a dict with the settings of processSettings (the defaults if not
+# configured) and the slicer profiles of the [Profile] section as "profiles"
+# (print, printer, filament).
+def loadConfig(filename=cfgFile):
+    config = {name: globals()[name] for name in processSettings}
+    config["profiles"] = ("", "", "")
+    with timedStage("load config"):
+        if not isfile(filename):
+            return(config)
+        cfg = configparser.ConfigParser()
+        cfg.read(filename)
+
+    config["cmdOpenScad"] = getOpt(cfg["Path"], "openscad", config["cmdOpenScad"])
+    config["cmdPrusaSlicer"] = getOpt(cfg["Path"], "prusa_slicer", config["cmdPrusaSlicer"])
+    config["iniPSD"] = getOpt(cfg["Path"], "prusa_slicer_ini", config["iniPSD"])
+    config["scratchDir"] = getOpt(cfg["Path"], "scratch_dir", config["scratchDir"])
+    if cfg.has_section("Cache"):
+        config["cacheDir"] = getOpt(cfg["Cache"], "dir", config["cacheDir"])
+        config["cacheMaxSize"] = getOpt(cfg["Cache"], "max_size", config["cacheMaxSize"])
+        config["cacheMaxAge"] = getOpt(cfg["Cache"], "max_age", config["cacheMaxAge"])
+    config["profiles"] = (getOpt(cfg["Profile"], "print", ""),
+                          getOpt(cfg["Profile"], "printer", ""),
+                          getOpt(cfg["Profile"], "filament", ""))
+    return(config)
+
+# The process settings are set once from a config (see applyConfig) and
+# never rebound while towers are built, e.g. by the threads of --serve
+appliedSettings = {}
+appliedSettingsLock = threading.Lock()
+
+# Make the settings of config (see loadConfig) those of the process. Once set,
+# they stay: a config with other settings raises ValueError.
+def applyConfig(config):
+    settings = {name: config[name] for name in processSettings}
+    with appliedSettingsLock:
+        if not appliedSettings:
+            globals().update(settings)
+            appliedSettings.update(settings)
+        elif settings != appliedSettings:
+            changed = [name for name in processSettings if settings[name] != appliedSettings[name]]
+            raise ValueError("the paths and cache settings are global to the process and already set, "
+                             "other values for: " + ", ".join(changed))
+
+# Read the configuration file (if existing) and override the defaults.
+# Returns the slicer profiles of the [Profile] section as (print, printer, filament).
+def readConfig(filename=cfgFile):
+    config = loadConfig(filename)
+    applyConfig(config)
+    return(config["profiles"])
+
 ###
-# MAIN
+# Library interface
 ###
 
-# Check completeness of this package
-if not checkRequiredFiles():
-    print()
-    print("ERROR: Cannot find all required files. Please make sure all files")
-    print("       listed below are in your current directory.\n")
-    for file in requiredFiles.keys():
-        print( "   * " + requiredFiles[file] )
-    print()
-    exit(1)
-
-# Commandline parsing
-parser = argparse.ArgumentParser(description="Create a gcode file to print a Heat Calibration Tower.")
-requiredNamed = parser.add_argument_group('required arguments')
-requiredNamed.add_argument('-s', '--startTemp', type=int, help="Temperature of the first (lowest) block.")
-requiredNamed.add_argument('-e', '--endTemp', type=int, help="Temperature of the last (highest) block.")
-requiredNamed.add_argument('-t', '--tempStep', type=int, help="Temperature change between blocks.")
-parser.add_argument('-p', '--gcodePrefix', help="Prefix for gcode output file")
-parser.add_argument('-l', '--profiles', nargs='?', help="List printer profiles (PROFILES=print, printer, filament)")
-parser.add_argument('--printIni', nargs='?', help="Print ini file to use (without directory part)")
-parser.add_argument('--printerIni', nargs='?', help="Printer ini file to use (without directory part)")
-parser.add_argument('--filamentIni', nargs='?', help="Filament ini file to use (without directory part)")
-args = parser.parse_args()
-
-
-### Check for config file and override defaults if desired
-
-# Read configuration if existing
-cfgFile="SmartTemperatureTower.ini"
-if isfile(cfgFile):
-    cfg = configparser.ConfigParser()
-    cfg.read(cfgFile)
-
-    cmdOpenScad = getOpt(cfg["Path"], "openscad", cmdOpenScad)
-    cmdPrusaSlicer = getOpt(cfg["Path"], "prusa_slicer", cmdPrusaSlicer)
-    iniPSD = getOpt(cfg["Path"], "prusa_slicer_ini", iniPSD)
-
-    # Use slicer profiles only from INI, if not yet supplied by cmdline
-    if args.printIni == None:
-        printProfile = getOpt(cfg["Profile"], "print", "")
-    else:
-        printProfile = args.printIni
+# Builds towers with one set of slicer profiles. The configuration file is read
+# into the builder when it is created. Paths and cache settings are global to
+# the process: the first configuration sets them, a builder with other ones
+# raises ValueError.
+#
+#   import SmartTemperatureTower as stt
+#   builder = stt.TowerBuilder(filamentIni="Generic PLA.ini")
+#   builder.build(190, 240, 5, "PLA-190-240-5.gcode")
+#
+# Raises ProfileError for unknown profiles and ToolError if OpenSCAD or Prusa-Slicer fail.
+class TowerBuilder:
+    def __init__(self, printIni=None, printerIni=None, filamentIni=None, configFile=cfgFile,
+                 engine="openscad", useCache=True):
+        self.config = loadConfig(configFile)
+        applyConfig(self.config)
+        profileNames = self.config["profiles"]
+        self.printIni = profileNames[0] if printIni == None else printIni
+        self.printerIni = profileNames[1] if printerIni == None else printerIni
+        self.filamentIni = profileNames[2] if filamentIni == None else filamentIni
+        self.loadProfilesList = getLoadProfilesList(self.printIni, self.printerIni, self.filamentIni,
+                                                    self.config["iniPSD"])
+        self.engine = engine
+        self.useCache = useCache
 
-    if args.printerIni == None:    
-        printerProfile = getOpt(cfg["Profile"], "printer", "")
-    else:
-        printerProfile = args.printerIni
+    # STEP 1: Create the STL file of the tower
+    def renderSTL(self, startTemp, endTemp, tempStep, stlFile):
+        return(createSTL(startTemp, endTemp, tempStep, stlFile, self.engine, self.useCache))
+
+    # STEP 2: Slice the STL file
+    def slice(self, stlFile, gcodeFile):
+        return(createGCode(stlFile, gcodeFile, self.loadProfilesList, self.useCache))
+
+    # STEP 3: Insert the M104 commands and the G-code of further transforms
+    # (list of parseTransform results)
+    def injectTemperatures(self, gcodeIn, gcodeOut, startTemp, tempStep, saveIndex=False, transforms=()):
+        addM104(gcodeIn, gcodeOut, startTemp, tempStep, saveIndex, transforms)
+
+    # All steps. The intermediate files are kept in a private temporary directory
+    # inside scratchDir. gcodeFile is a filename or an object with a write
+    # method, to which the final G-code is streamed while it is injected.
+    def build(self, startTemp, endTemp, tempStep, gcodeFile, transforms=()):
+        workDir = tempfile.mkdtemp(prefix="CT_", dir=scratchDir)
+        try:
+            stlFile = os.path.join(workDir, "CT_Temp.stl")
+            gcodeTemp = os.path.join(workDir, "CT_Temp.gcode")
+            self.renderSTL(startTemp, endTemp, tempStep, stlFile)
+            self.slice(stlFile, gcodeTemp)
+            if not isinstance(gcodeFile, str):
+                self.injectTemperatures(gcodeTemp, gcodeFile, startTemp, tempStep, transforms=transforms)
+                return
+            with atomicOutput(gcodeFile) as gcodePartial:
+                self.injectTemperatures(gcodeTemp, gcodePartial, startTemp, tempStep, transforms=transforms)
+        finally:
+            shutil.rmtree(workDir, ignore_errors=True)
+
+###
+# Service mode
+###
+
+# HTTP interface of --serve:
+#   GET /tower?startTemp=190&endTemp=240&tempStep=5[&printIni=..][&printerIni=..][&filamentIni=..]
+# returns the G-code as chunked stream. Requests are handled concurrently.
+
+# Response body of --serve with chunked transfer encoding. The G-code is sent
+# as it is written by the injector; the headers go out with the first chunk,
+# so errors before it can still be answered with an error status.
+class ChunkedResponse:
+    def __init__(self, handler, headers):
+        self.handler = handler
+        self.headers = headers
+        self.started = False
+
+    def start(self):
+        self.started = True
+        self.handler.send_response(200)
+        for name, value in self.headers:
+            self.handler.send_header(name, value)
+        self.handler.send_header("Transfer-Encoding", "chunked")
+        self.handler.end_headers()
 
-    if args.filamentIni == None:
-        filamentProfile = getOpt(cfg["Profile"], "filament", "")
+    def write(self, data):
+        if len(data) == 0:
+            return  # an empty chunk ends the response
+        if not self.started:
+            self.start()
+        self.handler.wfile.write(b"%x\r\n" % len(data))
+        self.handler.wfile.write(data)
+        self.handler.wfile.write(b"\r\n")
+
+    def close(self):
+        if not self.started:
+            self.start()
+        self.handler.wfile.write(b"0\r\n\r\n")
+
+class TowerRequestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        if url.path != "/tower":
+            self.send_error(404)
+            return
+        query = dict(urllib.parse.parse_qsl(url.query))
+        try:
+            startTemp = int(query["startTemp"])
+            endTemp = int(query["endTemp"])
+            tempStep = int(query["tempStep"])
+        except (KeyError, ValueError):
+            self.send_error(400, "startTemp, endTemp and tempStep are required")
+            return
+        try:
+            checkTempRange(startTemp, endTemp, tempStep)
+        except ValueError as e:
+            self.send_error(400, "Invalid temperatures: " + str(e))
+            return
+
+        gcodeName = getGCodeFile(query.get("gcodePrefix", "CalibrationTower"), startTemp, endTemp, tempStep)
+        response = ChunkedResponse(self, [("Content-Type", "text/x.gcode"),
+                                          ("Content-Disposition", "attachment; filename=\"" + gcodeName + "\"")])
+        try:
+            builder = self.server.getBuilder(query.get("printIni"), query.get("printerIni"), query.get("filamentIni"))
+            builder.build(startTemp, endTemp, tempStep, response)
+            response.close()
+        except ProfileError as e:
+            self.send_error(404, "Unknown " + e.kind + " profile")
+        except ToolError as e:
+            self.send_error(500, "Tool failed", str(e))
+        except (OSError, ValueError) as e:
+            self.log_error("%s failed: %s", self.path, e)
+            if response.started:
+                self.close_connection = True  # the response is cut off
+            else:
+                self.send_error(500, "Tower failed", str(e))
+
+    # Unix sockets have no client address
+    def address_string(self):
+        if isinstance(self.client_address, tuple):
+            return(self.client_address[0])
+        return("unix")
+
+# Mixin keeping one TowerBuilder per profile combination
+class BuilderCache:
+    def initBuilders(self, profileNames):
+        self.profileNames = profileNames
+        self.builders = {}
+        self.buildersLock = threading.Lock()
+
+    def getBuilder(self, printIni, printerIni, filamentIni):
+        key = (printIni or self.profileNames[0], printerIni or self.profileNames[1],
+               filamentIni or self.profileNames[2])
+        with self.buildersLock:
+            if key not in self.builders:
+                self.builders[key] = TowerBuilder(*key)
+            return(self.builders[key])
+
+class TowerHTTPServer(BuilderCache, http.server.ThreadingHTTPServer):
+    pass
+
+if hasattr(socketserver, "UnixStreamServer"):
+    class TowerUnixServer(BuilderCache, socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+# Run the service on "[HOST:]PORT" or "unix:PATH" until interrupted
+def serve(address, printProfile="", printerProfile="", filamentProfile=""):
+    if address.startswith("unix:"):
+        path = address[5:]
+        if os.path.exists(path):
+            os.remove(path)
+        server = TowerUnixServer(path, TowerRequestHandler)
     else:
-        filamentProfile = args.filamentIni
-
-# Check configured paths
-if not isfile(cmdOpenScad):
-    toolNotFound("OpenSCAD tool",cmdPrusaSlicer)
-    exit(1)
-if not isfile(cmdPrusaSlicer):
-    toolNotFound("Prusa-Slicer tool",cmdPrusaSlicer)
-    exit(1)
-if not isdir(iniPSD):
-    toolNotFound("Prusa-Slicer profile dir", iniPSD)
-    exit(1)
-
-# Check configured profiles
-profiles = []
-if printProfile != "":
-    printProfile = iniPSD+"\\print\\"+printProfile
-    if not isfile(printProfile):
-        print()
-        toolNotFound("Prusa-Slicer print profile", printProfile)
+        host, sep, port = address.rpartition(":")
+        server = TowerHTTPServer((host or "127.0.0.1", int(port)), TowerRequestHandler)
+    server.initBuilders((printProfile, printerProfile, filamentProfile))
+    print("Serving towers on " + address + " (Ctrl+C to stop)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+###
+# MAIN
+###
+
+def main(argv=None):
+    # Commandline parsing
+    parser = argparse.ArgumentParser(description="Create a gcode file to print a Heat Calibration Tower.")
+    requiredNamed = parser.add_argument_group('required arguments')
+    requiredNamed.add_argument('-s', '--startTemp', type=int, help="Temperature of the first (lowest) block.")
+    requiredNamed.add_argument('-e', '--endTemp', type=int, help="Temperature of the last (highest) block.")
+    requiredNamed.add_argument('-t', '--tempStep', type=int, help="Temperature change between blocks.")
+    parser.add_argument('-p', '--gcodePrefix', help="Prefix for gcode output file")
+    parser.add_argument('-l', '--profiles', nargs='?', help="List printer profiles (PROFILES=print, printer, filament)")
+    parser.add_argument('--printIni', nargs='?', help="Print ini file to use (without directory part)")
+    parser.add_argument('--printerIni', nargs='?', help="Printer ini file to use (without directory part)")
+    parser.add_argument('--filamentIni', nargs='?', help="Filament ini file to use (without directory part)")
+    parser.add_argument('--engine', choices=['openscad', 'native'], default='openscad', help="Build the tower STL with OpenSCAD (default) or natively out of pre-rendered floors")
+    parser.add_argument('--batch', help="Create towers for all jobs in a CSV file (columns: startTemp,endTemp,tempStep,printIni,printerIni,filamentIni,gcodePrefix)")
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(), help="Number of parallel workers in batch mode, for --split-slice and for rendering the parts of --engine native")
+    parser.add_argument('--split-slice', dest='splitSlice', action='store_true', help="Slice the stand with the first floor and each further floor as parts in parallel (--jobs), then stitch the GCODE")
+    parser.add_argument('--tower', action='append', default=[], metavar='START:END:STEP', help="Add a tower to the plate (with -s/-e/-t, if given), can be given several times. All towers are placed on the bed and sliced together.")
+    parser.add_argument('--interleave', action='store_true', help="Allow towers of --tower that cannot be printed one after another to be printed together, layer by layer (the temperatures of the floors are not reached)")
+    parser.add_argument('--quick', action='store_true', help="Print a compact tower: lower floors with only the overhang and the bridge, smaller footprint (floor height {floor_height:g} mm, XY scale {xy_scale:g})".format(**quickGeometry))
+    parser.add_argument('--floor-height', dest='floorHeight', type=float, metavar='MM', help="Height of a floor in mm (default: 10)")
+    parser.add_argument('--xy-scale', dest='xyScale', type=float, metavar='SCALE', help="Scale of the footprint of the tower (default: 1)")
+    parser.add_argument('--compare', action='store_true', help="Also create and slice the standard tower to report the time and filament saved by --quick/--floor-height/--xy-scale")
+    parser.add_argument('--from-gcode', dest='fromGCode', metavar='FILE', help="Insert the M104 commands into an existing GCODE file (any slicer) instead of creating the tower")
+    parser.add_argument('--index', action='store_true', help="Write a layer index (<gcodeFile>.idx) for random access to the layers")
+    parser.add_argument('--serve', metavar='ADDRESS', help="Run as local HTTP service on [HOST:]PORT or unix:PATH")
+    parser.add_argument('--no-cache', dest='noCache', action='store_true', help="Do not use cached intermediate results")
+    parser.add_argument('--cache-stats', dest='cacheStats', action='store_true', help="Show cache usage and exit")
+    parser.add_argument('--benchmark', action='store_true', help="Compare internal helpers against the external tools and exit")
+    parser.add_argument('--transform', action='append', default=[], metavar='NAME=START:STEP[:EVERY[:COUNT]]', help="Also change temp, fan (%%), flow (%%), retract (mm) or pa (pressure advance) per floor, can be given several times")
+    parser.add_argument('--estimate', action='store_true', help="Estimate print time and filament per floor (uses the printer limits of the printer profile)")
+    parser.add_argument('--heater-rate', dest='heaterRate', type=float, metavar='C/S', help="Heat up/cool down rate of the hotend in C/s: set each temperature earlier, so it is reached when the floor starts (uses the layer times estimated with the printer limits)")
+    parser.add_argument('--format', choices=list(gcodeFormats), default='gcode', help="Output format: plain GCODE (default), gzip compressed, MeatPack encoded or binary GCODE (.bgcode)")
+    parser.add_argument('--strip', action='store_true', help="Remove comments and surplus whitespace from the GCODE")
+    parser.add_argument('--baud', type=int, default=115200, help="Baud rate for the transfer time report of --format/--strip")
+    parser.add_argument('--upload', metavar='URL', help="Also upload the GCODE to OctoPrint or Moonraker while it is written, plain GCODE only (e.g. http://octopi.local, the path defaults to {})".format(uploadPath))
+    parser.add_argument('--start-print', dest='startPrint', action='store_true', help="Start the print after the upload (--upload)")
+    parser.add_argument('--api-key', dest='apiKey', metavar='KEY', help="API key for --upload (sent as X-Api-Key)")
+    parser.add_argument('--timings', action='store_true', help="Show wall time, child CPU time, peak memory and I/O of each stage")
+    parser.add_argument('--trace', metavar='FILE', help="Write the stage timings as Chrome trace (JSON) to FILE")
+    parser.add_argument('--profile', metavar='FILE', help="Write a cProfile profile of the in-process stages to FILE")
+    args = parser.parse_args(argv)
+
+    stageTiming["enabled"] = args.timings or args.trace != None or args.profile != None
+    if args.profile != None:
+        stageTiming["profiler"] = cProfile.Profile()
+    try:
+        return(runMain(parser, args))
+    finally:
+        if args.timings:
+            printTimings()
+        if args.trace != None:
+            writeTrace(args.trace)
+        if args.profile != None:
+            stageTiming["profiler"].dump_stats(args.profile)
+
+def runMain(parser, args):
+    # Check completeness of this package
+    with timedStage("check files"):
+        filesFound = checkRequiredFiles()
+    if not filesFound:
         print()
-        print("Please use \"SmartTemperatureTower.py -l print\" to get available profiles.")
+        print("ERROR: Cannot find all required files. Please make sure all files")
+        print("       listed below are in your current directory.\n")
+        for file in requiredFiles.keys():
+            print( "   * " + requiredFiles[file] )
         print()
         exit(1)
-    else:
-        profiles.append(printProfile)
-if printerProfile != "":
-    printerProfile = iniPSD+"\\printer\\"+printerProfile
-    if not isfile(printerProfile):
+
+    # With --no-cache, the STL info is not stored in the cache directory either
+    stlZSizeStore["enabled"] = not args.noCache
+
+    # Tower geometry: the standard tower, --quick or single values changed
+    towerGeometry.update(quickGeometry if args.quick else standardGeometry)
+    if args.floorHeight != None:
+        towerGeometry["floor_height"] = args.floorHeight
+    if args.xyScale != None:
+        towerGeometry["xy_scale"] = args.xyScale
+    if towerGeometry["floor_height"] < 4 or not 0.5 <= towerGeometry["xy_scale"] <= 2:
+        print("ERROR: --floor-height must be at least 4 (mm) and --xy-scale between 0.5 and 2.")
+        exit(1)
+    if args.compare and (towerGeometry == standardGeometry or args.fromGCode != None or args.tower or args.batch != None):
+        print("ERROR: --compare needs --quick, --floor-height or --xy-scale and cannot be used with --from-gcode, --tower or --batch.")
+        exit(1)
+
+    # Floor transforms in addition to the temperature
+    try:
+        transforms = [parseTransform(text) for text in args.transform]
+    except ValueError as e:
+        print("ERROR: Invalid --transform: "+str(e))
+        exit(1)
+
+    # Read configuration and use slicer profiles only from INI, if not yet supplied by cmdline
+    profileNames = readConfig(cfgFile)
+    printProfile = profileNames[0] if args.printIni == None else args.printIni
+    printerProfile = profileNames[1] if args.printerIni == None else args.printerIni
+    filamentProfile = profileNames[2] if args.filamentIni == None else args.filamentIni
+
+    # Check configured paths (not needed to post-process an existing GCODE file)
+    needTools = args.fromGCode == None
+    if needTools and not isfile(cmdOpenScad):
+        toolNotFound("OpenSCAD tool",cmdPrusaSlicer)
+        exit(1)
+    if needTools and not isfile(cmdPrusaSlicer):
+        toolNotFound("Prusa-Slicer tool",cmdPrusaSlicer)
+        exit(1)
+    if needTools and not isdir(iniPSD):
+        toolNotFound("Prusa-Slicer profile dir", iniPSD)
+        exit(1)
+
+    # Check configured profiles
+    try:
+        loadProfilesList = getLoadProfilesList(printProfile, printerProfile, filamentProfile) if needTools else []
+    except ProfileError as e:
         print()
-        toolNotFound("Prusa-Slicer printer profile", printerProfile)
+        toolNotFound("Prusa-Slicer "+e.kind+" profile", e.path)
         print()
-        print("Please use \"SmartTemperatureTower.py -l printer\" to get available profiles.")
+        print("Please use \"SmartTemperatureTower.py -l "+e.kind+"\" to get available profiles.")
         print()
         exit(1)
-    else:
-        profiles.append(printerProfile)
-if filamentProfile != "":
-    filamentProfile = iniPSD+"\\filament\\"+filamentProfile
-    if not isfile(filamentProfile):
+    profileNames = (printProfile, printerProfile, filamentProfile)
+    if printProfile != "":
+        printProfile = os.path.join(iniPSD, "print", printProfile)
+    if printerProfile != "":
+        printerProfile = os.path.join(iniPSD, "printer", printerProfile)
+    if filamentProfile != "":
+        filamentProfile = os.path.join(iniPSD, "filament", filamentProfile)
+
+    # List printer profiles
+    if args.profiles != None:
+        validIniDirs=["printer","print","filament"]
+        if not args.profiles in validIniDirs:
+            print()
+            print("ERROR: Unknown ini path: "+args.profiles)
+            print()
+            print("       Valid paths are:")
+            for path in validIniDirs:
+                print("       * "+path)
+            print()
+            sys.exit(1)
+        path=os.path.join(iniPSD, args.profiles)
+        iniarr = os.listdir(path)
         print()
-        toolNotFound("Prusa-Slicer filament profile", filamentProfile)
+        print("Printer profiles available in directory:")
+        print(path)
         print()
-        print("Please use \"SmartTemperatureTower.py -l filament\" to get available profiles.")
+        for ini in iniarr:
+            print("* "+ini)
         print()
-        exit(1)
-    else:
-        profiles.append(filamentProfile)
-
-loadProfiles = ""
-loadProfilesList = []
-for profile in profiles:
-    loadProfilesList.append("--load")
-    loadProfilesList.append(profile)
-    if loadProfiles == "":
-        loadProfiles = "--load "+profile
-    else:
-        loadProfiles += " --load "+profile
+        sys.exit(0)
 
-# List printer profiles
-if args.profiles != None:
-    validIniDirs=["printer","print","filament"]
-    if not args.profiles in validIniDirs:
-        print()
-        print("ERROR: Unknown ini path: "+args.profiles)
+    # Show cache statistics
+    if args.cacheStats:
+        printCacheStats()
+        sys.exit(0)
+
+    # Run benchmarks
+    if args.benchmark:
         print()
-        print("       Valid paths are:")
-        for path in validIniDirs:
-            print("       * "+path)
+        benchmarkSTLZSize(requiredFiles["stlFloor"])
+        benchmarkSTLZSize(requiredFiles["stlStand"])
+        benchmarkIntermediateSTL(scratchDir)
+        benchmarkInjector()
+        sys.exit(0)
+
+    # Service mode
+    if args.serve != None:
+        if args.serve.startswith("unix:") and not hasattr(socketserver, "UnixStreamServer"):
+            print("ERROR: Unix sockets are not supported on this platform, use --serve [HOST:]PORT.")
+            exit(1)
+        serve(args.serve, *profileNames)
+        sys.exit(0)
+
+    if args.upload != None and args.format not in uploadFormats:
+        print("ERROR: --upload only works with --format "+" or ".join(uploadFormats)+", OctoPrint and Moonraker do not accept "+gcodeFormats[args.format]+" files.")
+        exit(1)
+
+    # Batch mode
+    if args.batch != None:
+        try:
+            jobs = readBatchJobs(args.batch, *profileNames, transforms, args.format, args.strip, args.index, args.heaterRate)
+        except (OSError, KeyError, ValueError) as e:
+            print("ERROR: Cannot read batch file "+args.batch+": "+str(e))
+            exit(1)
+        gcodeFiles = [job["gcodeFile"] for job in jobs]
+        if len(set(gcodeFiles)) != len(gcodeFiles):
+            print("ERROR: Batch jobs must have distinct gcode files (use different gcodePrefix values).")
+            exit(1)
+        if args.startPrint:
+            print("ERROR: --start-print cannot be used with --batch.")
+            exit(1)
+        if args.splitSlice or args.fromGCode != None or args.tower or args.estimate:
+            print("ERROR: --batch cannot be used with --split-slice, --from-gcode, --tower or --estimate.")
+            exit(1)
+        if args.index and (args.format != "gcode" or args.strip or args.upload != None):
+            print("ERROR: --index can only be used with plain GCODE output and without --upload.")
+            exit(1)
+        if args.heaterRate != None and args.heaterRate <= 0:
+            print("ERROR: --heater-rate must be greater than 0.")
+            exit(1)
         print()
+        print("* Run {} batch jobs with {} workers".format(len(jobs), args.jobs))
+        runBatch(jobs, args.jobs, args.engine, not args.noCache, args.upload, args.apiKey)
+        printBatchSummary(jobs)
+        if args.upload != None:
+            print("Uploads:           {} of {} to {} over {} connection(s)".format(
+                  sum(job.get("upload") == "OK" for job in jobs), len(jobs), args.upload, uploadStats["connections"]))
+            print()
+        sys.exit(0 if all(job["status"] == "OK" for job in jobs) else 1)
+
+    # Several towers on one plate: -s/-e/-t (if given) and each --tower
+    try:
+        towers = [parseTower(text) for text in args.tower]
+    except ValueError as e:
+        print("ERROR: Invalid --tower: "+str(e))
+        exit(1)
+    if towers and args.startTemp != None and args.endTemp != None and args.tempStep != None:
+        towers.insert(0, (args.startTemp, args.endTemp, args.tempStep))
+    if args.interleave and not towers:
+        print("ERROR: --interleave can only be used with --tower.")
+        exit(1)
+
+    # Check that all required arguments are given
+    if not towers and (args.startTemp == None or args.endTemp == None or args.tempStep == None):
+        parser.print_help()
         sys.exit(1)
-    path=iniPSD+"\\"+args.profiles
-    iniarr = os.listdir(path)
-    print()
-    print("Printer profiles available in directory:")
-    print(path)
-    print()
-    for ini in iniarr:
-        print("* "+ini)
-    print()
-    sys.exit(0)
-
-# Check that all required arguments are given
-if args.startTemp == None or args.endTemp == None or args.tempStep == None:
-    parser.print_help()
-    sys.exit(1)
-
-# Get name for gcode file
-if args.gcodePrefix == None:
-    gcodePrefix = "CalibrationTower"
-else:
-    gcodePrefix = args.gcodePrefix
-
-    # We don't want a full filename with extension for the -p (prefix) parameter
-    if re.search('\\.', args.gcodePrefix):
-        ext=re.sub('^.*(\\..*)$', '\\1', args.gcodePrefix)
-        print("ERROR: The -p / --gcodePrefix parameter contains an extension ("+ext+").")
+    if not towers:
+        try:
+            checkTempRange(args.startTemp, args.endTemp, args.tempStep)
+        except ValueError as e:
+            print("ERROR: Invalid temperatures: "+str(e)+".")
+            exit(1)
+
+    # Get name for gcode file
+    if args.gcodePrefix == None:
+        gcodePrefix = "CalibrationTower"
+    else:
+        gcodePrefix = args.gcodePrefix
+
+        # We don't want a full filename with extension for the -p (prefix) parameter
+        if re.search('\\.', args.gcodePrefix):
+            ext=re.sub('^.*(\\..*)$', '\\1', args.gcodePrefix)
+            print("ERROR: The -p / --gcodePrefix parameter contains an extension ("+ext+").")
+            exit(1)
+
+    if towers:
+        gcodeFile = getPlateGCodeFile(gcodePrefix, towers, args.format)
+    else:
+        gcodeFile = getGCodeFile(gcodePrefix, args.startTemp, args.endTemp, args.tempStep, args.format)
+    encoded = args.format != "gcode" or args.strip
+    if encoded and args.index:
+        print("ERROR: --index can only be used with plain GCODE output.")
+        exit(1)
+    if args.fromGCode != None and not isfile(args.fromGCode):
+        print("ERROR: GCODE file "+args.fromGCode+" not found.")
+        exit(1)
+    if args.fromGCode != None and isfile(gcodeFile) and os.path.samefile(args.fromGCode, gcodeFile):
+        print("ERROR: --from-gcode must not be the output file "+gcodeFile+" (use -p).")
+        exit(1)
+    if args.fromGCode != None and args.splitSlice:
+        print("ERROR: --from-gcode cannot be used with --split-slice.")
+        exit(1)
+    if args.splitSlice and not getFloorTemps(args.startTemp, args.endTemp, args.tempStep):
+        print("ERROR: --split-slice needs a tower with at least 2 floors.")
+        exit(1)
+    if towers and (args.splitSlice or args.fromGCode != None or transforms or args.estimate):
+        print("ERROR: --tower cannot be used with --split-slice, --from-gcode, --transform or --estimate.")
+        exit(1)
+    if args.heaterRate != None and (args.heaterRate <= 0 or towers):
+        print("ERROR: --heater-rate must be greater than 0 and cannot be used with --tower.")
+        exit(1)
+    if any(not getFloorTemps(*tower) for tower in towers):
+        print("ERROR: Each tower needs at least 2 floors.")
+        exit(1)
+    if args.upload != None and args.index:
+        print("ERROR: --index cannot be used with --upload.")
+        exit(1)
+    if args.upload == None and (args.startPrint or args.apiKey != None):
+        print("ERROR: --start-print and --api-key need --upload.")
+        exit(1)
+    if args.upload != None and urllib.parse.urlsplit(args.upload).scheme not in ("http", "https"):
+        print("ERROR: --upload needs an http:// or https:// URL.")
         exit(1)
-        
-gcodeFile = gcodePrefix + "-" + str(args.startTemp) + "-" + str(args.endTemp) + "-" + str(args.tempStep) + ".gcode"
-
-print()
-print("Start Temperature: {}".format(args.startTemp))
-print("End Temperature:   {}".format(args.endTemp))
-print("Temperature Step:  {}".format(args.tempStep))
-print("Printer Profile:   {}".format(printerProfile))
-print("Print Profile:     {}".format(printProfile))
-print("Filament Profile:  {}".format(filamentProfile))
-print("gcodeFile:         {}".format(gcodeFile))
-print()
 
-###
-# STEP 1: Create STL file of Calibration Tower using OpenSCAD
-###
-print("* Create STL file ", end="", flush=True)
-if isfile("CT_Temp.stl"):
-    os.remove("CT_Temp.stl")
-rc = subprocess.run( [ cmdOpenScad, "-o", "CT_Temp.stl",
-                       "-D", "tfirst=" + str(args.startTemp), "-D", "tlast=" + str(args.endTemp), 
-                       "-D", "tstep=" + str(args.tempStep), requiredFiles["scadFile"] ],
-                       stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True )
-
-if rc.returncode != 0:
-    print("- ERROR: RC != 0")
-    print("Error output was:")
-    print(rc.stdout)
     print()
-    exit(1)
-print("- OK")
-
-###
-# STEP 2: Create GCODE file using Prusa Slicer
-###
-print("* Create GCODE file ", end="", flush=True)
-if isfile("CT_Temp.gcode"):
-    os.remove("CT_Temp.gcode")
-rc = subprocess.run( [ cmdPrusaSlicer, "--loglevel", "2", "--printer-technology", "FFF",
-                                       "--center", "120,120", 
-                                       "--before-layer-gcode", ";CT_LAYER:[layer_num]",
-                                       *loadProfilesList,
-                                       "--export-gcode", "--loglevel", "1",
-                                       "--output", "CT_Temp.gcode", "CT_Temp.stl" ],
-                        stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True )
-if rc.returncode != 0:
-    print("- ERROR: RC != 0")
-    print("Error output was:")
-    print(rc.stdout)
+    if towers:
+        print("Towers:            {}".format(", ".join("{}-{}-{}".format(*tower) for tower in towers)))
+    else:
+        print("Start Temperature: {}".format(args.startTemp))
+        print("End Temperature:   {}".format(args.endTemp))
+        print("Temperature Step:  {}".format(args.tempStep))
+    if transforms:
+        print("Transforms:        {}".format(", ".join(args.transform)))
+    if towerGeometry != standardGeometry:
+        print("Geometry:          {:g} mm floors, XY scale {:g}, {} floors".format(
+              towerGeometry["floor_height"], towerGeometry["xy_scale"], towerGeometry["variant"]))
+    print("Printer Profile:   {}".format(printerProfile))
+    print("Print Profile:     {}".format(printProfile))
+    print("Filament Profile:  {}".format(filamentProfile))
+    if args.fromGCode != None:
+        print("Input gcodeFile:   {}".format(args.fromGCode))
+    print("gcodeFile:         {}".format(gcodeFile))
+    if args.upload != None:
+        print("Upload to:         {}{}".format(args.upload, " (start print)" if args.startPrint else ""))
     print()
-    exit(1)
-print("- OK")
 
+    # Each run works in its own directory inside scratchDir, so runs at the
+    # same time do not clobber each other. The GCODE is written under a
+    # temporary name, which is renamed when it is complete.
+    # With --upload, the GCODE is sent to the printer host while it is written.
+    upload = None
+    if args.upload != None:
+        upload = GCodeUpload(args.upload, os.path.basename(gcodeFile), args.startPrint, args.apiKey)
+    workDir = tempfile.mkdtemp(prefix="CT_", dir=scratchDir)
+    try:
+        with atomicOutput(gcodeFile) as gcodePartial:
+            if towers:
+                runPlateSteps(args, towers, loadProfilesList, gcodePartial, encoded, workDir, upload)
+            else:
+                runSteps(args, transforms, loadProfilesList, printerProfile, gcodePartial, encoded, workDir, upload)
+    finally:
+        shutil.rmtree(workDir, ignore_errors=True)
+    if upload != None:
+        upload.finish()
+        printUploadReport(upload)
+        if upload.error != None:
+            exit(1)
+    return(0)
+
+# STEP 1 to 3 of runMain. Intermediate files are written to workDir.
+def runSteps(args, transforms, loadProfilesList, printerProfile, gcodeFile, encoded, workDir, upload=None):
+    ###
+    # STEP 1: Create STL file of Calibration Tower using OpenSCAD
+    ###
+    stlTemp = os.path.join(workDir, "CT_Temp.stl")
+    gcodeTemp = os.path.join(workDir, "CT_Temp.gcode") if args.fromGCode == None else args.fromGCode
+    if args.fromGCode != None:
+        print("* Read layers of GCODE file ", end="", flush=True)
+        index = buildLayerIndex(gcodeTemp)
+        if len(index) < 2:
+            print()
+            print("ERROR: No layer changes found in "+gcodeTemp+".")
+            exit(1)
+        print("- OK ({} layers)".format(len(index)))
+    elif args.splitSlice:
+        print("* Create STL files of the parts ", end="", flush=True)
+        try:
+            parts = createSplitSTLs(args.startTemp, args.endTemp, args.tempStep, workDir, args.jobs)
+        except ToolError as e:
+            printToolError(e)
+            exit(1)
+        print("- OK ({} parts)".format(len(parts)))
+    else:
+        print("* Create STL file ", end="", flush=True)
+        try:
+            how = createSTL(args.startTemp, args.endTemp, args.tempStep, stlTemp, args.engine, not args.noCache, args.jobs)
+        except ToolError as e:
+            printToolError(e)
+            exit(1)
+        print("- OK" + (" (" + how + ")" if how else ""))
+        print("  Intermediate STL: {:.1f} MB binary in {}".format(os.path.getsize(stlTemp) / 1024 / 1024, scratchDir))
 
-###
-# STEP 3: Insert M104 (set temp) on floor changes
-###
-floorZSize = getSTLZSize(requiredFiles["stlFloor"])
-floorLayer=round(float(floorZSize)/0.2)
-firstChange=2 # Start at layer 2, so we use default temp for bottom 2 layers
-nextChange=firstChange
-nextTemp=args.startTemp
-
-print("* Add M104 commands ", end="", flush=True)
-gcodeInput = open("CT_Temp.gcode", 'r')
-gcodeOutput = open(gcodeFile, 'w')
-for LINE in gcodeInput:
-    gcodeOutput.write(LINE)
-    if re.match('^;CT_LAYER:[0-9]+$', LINE):
-        lineNum = int(re.sub('^;CT_LAYER:([0-9]+)','\\1',LINE))
-        if lineNum == nextChange:
-            gcodeOutput.write("M104 S" + str(nextTemp) + '\n')
-            if nextChange == firstChange:
-                nextChange=floorLayer
+    ###
+    # STEP 2: Create GCODE file using Prusa Slicer
+    ###
+    if args.fromGCode == None:
+        print("* Create GCODE file ", end="", flush=True)
+        try:
+            if args.splitSlice:
+                how = createGCodeSplit(parts, gcodeTemp, loadProfilesList, args.jobs, not args.noCache)
             else:
-                nextChange+=floorLayer
-            nextTemp+=args.tempStep    
+                how = createGCode(stlTemp, gcodeTemp, loadProfilesList, not args.noCache)
+        except ToolError as e:
+            printToolError(e)
+            exit(1)
+        print("- OK" + (" (" + how + ")" if how else ""))
+        index = None
+
 
-gcodeInput.close()
-gcodeOutput.close()
-print("- OK")
+    ###
+    # STEP 3: Insert M104 (set temp) on floor changes
+    ###
+    print("* Add M104 commands ", end="", flush=True)
+    limits = getPrinterLimits(printerProfile, gcodeTemp) if args.heaterRate != None else None
+    if encoded or upload != None:
+        metadata = readGCodeMetadata(gcodeTemp) if args.format == "bgcode" else None
+        out = GCodeWriter(gcodeFile, args.format, args.strip, metadata, upload)
+        try:
+            report = addM104(gcodeTemp, out, args.startTemp, args.tempStep, transforms=transforms, index=index,
+                             heaterRate=args.heaterRate, limits=limits)
+        finally:
+            out.close()
+    else:
+        report = addM104(gcodeTemp, gcodeFile, args.startTemp, args.tempStep, args.index, transforms, index,
+                         args.heaterRate, limits)
+    print("- OK")
+    if encoded:
+        printTransferReport(out.bytesIn, gcodeFile, args.baud)
+    if report is not None:
+        printSettleReport(report, args.heaterRate)
+
+    # The moves of the temporary GCODE are the same as in the encoded output
+    if args.estimate:
+        printEstimate(gcodeTemp if encoded else gcodeFile, printerProfile, args.startTemp, args.tempStep, transforms)
+
+    # Compare a tower of another geometry with the standard tower
+    if args.compare:
+        print("* Compare with the standard tower ", end="", flush=True)
+        try:
+            estimate, standard = estimateSavings(gcodeTemp, args.startTemp, args.endTemp, args.tempStep,
+                                                 loadProfilesList, printerProfile, workDir, args.engine, not args.noCache)
+        except ToolError as e:
+            print()
+            print("WARNING: The standard tower could not be created, no comparison:")
+            print(e)
+            return
+        print("- OK")
+        printSavingsReport(estimate, standard)
+
+# STEP 1 to 3 for several towers on one plate (see createTowerPlate)
+def runPlateSteps(args, towers, loadProfilesList, gcodeFile, encoded, workDir, upload=None):
+    print("* Create STL files and place them on the bed ", end="", flush=True)
+    try:
+        stlFiles, sequential = createTowerPlate(towers, workDir, loadProfilesList, args.engine, not args.noCache, args.jobs,
+                                                args.interleave)
+    except ToolError as e:
+        printToolError(e)
+        exit(1)
+    except ValueError as e:
+        print()
+        print("ERROR: "+str(e)+".")
+        exit(1)
+    print("- OK (" + ("printed one after another" if sequential else "printed together, layer by layer") + ")")
+
+    print("* Create GCODE file ", end="", flush=True)
+    gcodeTemp = os.path.join(workDir, "CT_Temp.gcode")
+    try:
+        how = createPlateGCode(stlFiles, gcodeTemp, loadProfilesList, sequential, not args.noCache)
+    except ToolError as e:
+        printToolError(e)
+        exit(1)
+    print("- OK" + (" (" + how + ")" if how else ""))
+
+    print("* Add M104 commands ", end="", flush=True)
+    if encoded or upload != None:
+        metadata = readGCodeMetadata(gcodeTemp) if args.format == "bgcode" else None
+        out = GCodeWriter(gcodeFile, args.format, args.strip, metadata, upload)
+        try:
+            addTowerTemps(gcodeTemp, out, towers, sequential)
+        finally:
+            out.close()
+    else:
+        addTowerTemps(gcodeTemp, gcodeFile, towers, sequential, args.index)
+    print("- OK")
+    if encoded:
+        printTransferReport(out.bytesIn, gcodeFile, args.baud)
+    if not sequential:
+        print()
+        print("WARNING: The towers are printed together (--interleave): the temperature is changed for each")
+        print("         object on every layer and the hotend does not reach it before printing. The floors")
+        print("         are NOT printed at their labeled temperatures, this plate is not a calibration.")
 
-exit(0)
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+
+# Round-trip check of the output formats of SmartTemperatureTower.py
+#
+# Writes synthetic G-code through GCodeWriter in each format (gz, meatpack,
+# bgcode, with and without --strip), decodes the result again with the
+# decoders below and compares it with the expected G-code. MeatPack is checked
+# with and without numpy. The gzip header must not carry a file name.
+#
+# example Usage:
+#           python bench/check_formats.py
+#           python bench/check_formats.py --layers 200
+
+import argparse
+import gzip
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import zlib
+
+benchDir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(benchDir, ".."))
+import SmartTemperatureTower as stt
+
+# Lines not covered by the synthetic G-code: comments after commands, tabs,
+# spaces outside of G moves, characters that are not packed by MeatPack
+extraGCode = (b"G1 X10 Y10 ; move with comment\n"
+              b"M117 Tower\tdone  at 215C\n"
+              b"G1  X12.5\tY-3 E0.5\n"
+              b"; only a comment\n"
+              b"\n"
+              b"M104 S0\n")
+
+### Functions
+
+# Decode MeatPack data (as written by stt.meatPack with its signals)
+def meatUnpack(data):
+    out = bytearray()
+    chars = stt.meatPackChars
+    i = 0
+    while i < len(data):
+        if data[i] == 0xff and i + 1 < len(data) and data[i + 1] == 0xff:
+            i += 3  # signal: enable, no spaces, reset
+            continue
+        p1, p2 = data[i] & 0xf, data[i] >> 4
+        i += 1
+        for p in (p1, p2):
+            if p == 15:
+                out.append(data[i])
+                i += 1
+            else:
+                out.append(chars[p])
+    return(bytes(out))
+
+# Decode a binary G-code file, returns (G-code, {block type: metadata text})
+def bgcodeDecode(data):
+    magic, version, checksum = stt.bgcodeHeader.unpack_from(data, 0)
+    if magic != b"GCDE" or version != 1 or checksum != 1:
+        raise ValueError("bad file header")
+    pos = stt.bgcodeHeader.size
+    gcode = []
+    metadata = {}
+    while pos < len(data):
+        blockType, compression, size = stt.bgcodeBlockHeader.unpack_from(data, pos)
+        headerSize = stt.bgcodeBlockHeader.size
+        packedSize = size
+        if compression:
+            packedSize = struct.unpack_from("<I", data, pos + headerSize)[0]
+            headerSize += 4
+        encoding = struct.unpack_from("<H", data, pos + headerSize)[0]
+        end = pos + headerSize + 2 + packedSize
+        payload = data[pos + headerSize + 2:end]
+        if struct.unpack_from("<I", data, end)[0] != zlib.crc32(data[pos:end]):
+            raise ValueError("bad CRC of block at {}".format(pos))
+        if compression:
+            payload = zlib.decompress(payload)
+        if len(payload) != size:
+            raise ValueError("bad size of block at {}".format(pos))
+        if blockType == stt.bgcodeGCode:
+            gcode.append(meatUnpack(payload) if encoding == 1 else payload)
+        else:
+            metadata[blockType] = payload.decode("utf-8")
+        pos = end + 4
+    return((b"".join(gcode), metadata))
+
+# The G-code as MeatPack stores it: stripped, no spaces in G moves, no empty lines
+def meatPackExpected(gcode):
+    lines = stt.stripGCode(gcode).split(b"\n")
+    return(b"".join(line.replace(b" ", b"") + b"\n" if line[:1] == b"G" else line + b"\n" for line in lines if line))
+
+# Write gcode through a GCodeWriter in chunks of odd size, returns the file content
+def writeFormat(filename, gcode, fmt, strip):
+    out = stt.GCodeWriter(filename, fmt, strip, {"Producer": "check_formats"})
+    for pos in range(0, len(gcode), 4099):
+        out.write(gcode[pos:pos + 4099])
+    out.close()
+    with open(filename, 'rb') as f:
+        return(f.read())
+
+# Check one format, returns an error message or None
+def checkFormat(directory, gcode, fmt, strip):
+    filename = os.path.join(directory, "CT_Check" + stt.gcodeFormats[fmt] + ".part")
+    data = writeFormat(filename, gcode, fmt, strip)
+    expected = stt.stripGCode(gcode) if strip else gcode
+    if fmt == "gz":
+        if data[3] & 0x08:
+            return("the gzip header holds a file name")
+        decoded = gzip.decompress(data)
+    elif fmt == "meatpack":
+        decoded = meatUnpack(data).replace(b"\n\n", b"\n")
+        expected = meatPackExpected(gcode)
+    else:
+        decoded, metadata = bgcodeDecode(data)
+        if "Producer=check_formats" not in metadata.get(stt.bgcodeFileMetadata, ""):
+            return("the producer is missing in the file metadata")
+        if strip:
+            decoded = decoded.replace(b"\n\n", b"\n")
+            expected = meatPackExpected(gcode)
+    if decoded != expected:
+        at = next((i for i, (a, b) in enumerate(zip(decoded, expected)) if a != b), min(len(decoded), len(expected)))
+        return("decoded G-code differs at byte {}: {!r} instead of {!r}".format(
+               at, decoded[max(at - 20, 0):at + 20], expected[max(at - 20, 0):at + 20]))
+    return(None)
+
+###
+# MAIN
+###
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Check that the output formats of SmartTemperatureTower.py decode to the written G-code.")
+    parser.add_argument('--layers', type=int, default=20, help="Layers of the synthetic G-code")
+    args = parser.parse_args(argv)
+
+    workDir = tempfile.mkdtemp(prefix="STT_Formats_")
+    failed = 0
+    try:
+        gcodeFile = os.path.join(workDir, "CT_Check.gcode")
+        stt.writeSyntheticGCode(gcodeFile, layers=args.layers, movesPerLayer=50)
+        with open(gcodeFile, 'rb') as f:
+            gcode = f.read() + extraGCode
+        numpy = stt.numpy
+        for useNumpy in ([True, False] if numpy is not None else [False]):
+            stt.numpy = numpy if useNumpy else None
+            for fmt in ("gz", "meatpack", "bgcode"):
+                for strip in (False, True):
+                    name = "{}{}{}".format(fmt, " --strip" if strip else "", "" if useNumpy else " (no numpy)")
+                    error = checkFormat(workDir, gcode, fmt, strip)
+                    if error:
+                        failed += 1
+                        print("ERROR: {}: {}".format(name, error))
+                    else:
+                        print("OK: " + name)
+        stt.numpy = numpy
+    finally:
+        shutil.rmtree(workDir, ignore_errors=True)
+    return(1 if failed else 0)
+
+if __name__ == "__main__":
+    sys.exit(main())
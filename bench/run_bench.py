@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+
+# Benchmark harness for SmartTemperatureTower.py
+#
+# Runs each stage of the pipeline on its own against the stand-in executables
+# stub_openscad.py and stub_prusaslicer.py, so neither OpenSCAD nor Prusa-Slicer
+# need to be installed. Results are written as JSON and compared against a
+# stored baseline.
+#
+# example Usage:
+#           python bench/run_bench.py --sizes 1M,100M,1G
+#           python bench/run_bench.py --save-baseline
+#           python bench/run_bench.py --threshold 0.2      (fails on a 20% regression)
+#           python bench/run_bench.py --openscad openscad --prusa-slicer prusa-slicer
+#
+# Before the timings, the G-code of a tower built by --engine native is compared
+# layer by layer with the G-code of the tower rendered by OpenSCAD; the run fails
+# if they differ. With --openscad and --prusa-slicer the real tools are used for
+# this check and the timings instead of the stand-in tools.
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+benchDir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(benchDir, ".."))
+import SmartTemperatureTower as stt
+
+### Functions
+
+# Parse a size like "100M" or "2G" into bytes
+def parseSize(text):
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+    if text[-1].upper() in units:
+        return(int(float(text[:-1]) * units[text[-1].upper()]))
+    return(int(text))
+
+# Create an executable wrapper for a stub in directory
+def createStubWrapper(directory, name, stub):
+    if os.name == "nt":
+        wrapper = os.path.join(directory, name + ".cmd")
+        with open(wrapper, 'w') as f:
+            f.write("@\"{}\" \"{}\" %*\n".format(sys.executable, stub))
+    else:
+        wrapper = os.path.join(directory, name)
+        with open(wrapper, 'w') as f:
+            f.write("#!/bin/sh\nexec \"{}\" \"{}\" \"$@\"\n".format(sys.executable, stub))
+        os.chmod(wrapper, 0o755)
+    return(wrapper)
+
+# Create a workspace with all required files and point the module at the stubs
+# (or at the given executables)
+def createWorkspace(directory, openscad=None, prusaSlicer=None):
+    for file in stt.requiredFiles.values():
+        shutil.copy(os.path.join(benchDir, "..", file), directory)
+    os.makedirs(os.path.join(directory, "profiles"))
+    stt.cmdOpenScad = openscad or createStubWrapper(directory, "openscad", os.path.join(benchDir, "stub_openscad.py"))
+    stt.cmdPrusaSlicer = prusaSlicer or createStubWrapper(directory, "prusa-slicer", os.path.join(benchDir, "stub_prusaslicer.py"))
+    stt.iniPSD = os.path.join(directory, "profiles")
+    stt.cacheDir = os.path.join(directory, "STT_Cache")
+
+# Run func repeat times, return the median of the wall times in seconds
+def timeStage(func, repeat):
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return(statistics.median(times))
+
+# Read the layers of a G-code file, returns [(z, extrusion)]: the Z of the
+# ;Z: comment and the sum of the E values of the layer (relative extrusion)
+def readGCodeLayers(filename):
+    layers = []
+    with open(filename, 'r') as f:
+        for line in f:
+            if line.startswith(";LAYER_CHANGE"):
+                layers.append([None, 0.0])
+            elif line.startswith(";Z:") and layers:
+                layers[-1][0] = float(line[3:])
+            elif line.startswith(("G1 ", "G0 ")) and layers:
+                for word in line.split(";")[0].split()[1:]:
+                    if word[0] == "E":
+                        layers[-1][1] += float(word[1:])
+    return([tuple(layer) for layer in layers])
+
+# Slice the tower of both engines and compare the G-code layer by layer.
+# Returns the list of differences (empty if both match).
+def compareEngines(tfirst, tlast, tstep, tolerance=0.01):
+    stt.createSTL(tfirst, tlast, tstep, "CT_Check-openscad.stl", "openscad", useCache=False)
+    stt.createSTL(tfirst, tlast, tstep, "CT_Check-native.stl", "native", useCache=False)
+    stt.createGCode("CT_Check-openscad.stl", "CT_Check-openscad.gcode", [], useCache=False)
+    stt.createGCode("CT_Check-native.stl", "CT_Check-native.gcode", [], useCache=False)
+    ref = readGCodeLayers("CT_Check-openscad.gcode")
+    layers = readGCodeLayers("CT_Check-native.gcode")
+    differences = []
+    if len(layers) != len(ref):
+        differences.append("{} layers instead of {}".format(len(layers), len(ref)))
+    for n, ((z, e), (refZ, refE)) in enumerate(zip(layers, ref)):
+        if z != refZ:
+            differences.append("layer {}: Z {} instead of {}".format(n, z, refZ))
+        elif abs(e - refE) > tolerance * max(refE, 1.0):
+            differences.append("layer {} (Z {}): extrusion {:.3f} instead of {:.3f}".format(n, z, e, refE))
+    return(differences)
+
+# Run all stages, returns {stage: {"seconds": ..., ["mb_per_s": ...]}}
+def runStages(sizes, repeat, tfirst, tlast, tstep):
+    stages = {}
+    stages["render_openscad"] = {"seconds": timeStage(
+        lambda: stt.createSTL(tfirst, tlast, tstep, "CT_Temp.stl", "openscad", useCache=False), repeat)}
+    stt.createSTL(tfirst, tlast, tstep, "CT_Temp.stl", "native")  # fill floor library
+    stages["render_native"] = {"seconds": timeStage(
+        lambda: stt.createSTL(tfirst, tlast, tstep, "CT_Native.stl", "native"), repeat)}
+    stages["stl_info"] = {"seconds": timeStage(
+        lambda: stt.getSTLZSize(stt.requiredFiles["stlFloor"], useCache=False), repeat)}
+    stages["slice"] = {"seconds": timeStage(
+        lambda: stt.createGCode("CT_Temp.stl", "CT_Temp.gcode", [], useCache=False), repeat)}
+    stages["plate_1"] = {"seconds": timeStage(
+        lambda: stt.createTowerPlate([(tfirst, tlast, tstep)], ".", [], "native"), repeat)}
+    stages["plate_2"] = {"seconds": timeStage(
+        lambda: stt.createTowerPlate([(tfirst, tlast, tstep), (tlast, tfirst, tstep)], ".", [], "native", interleave=True), repeat)}
+    parts = stt.createSplitSTLs(tfirst, tlast, tstep, ".")
+    stages["slice_split"] = {"seconds": timeStage(
+        lambda: stt.createGCodeSplit(parts, "CT_Split.gcode", [], os.cpu_count(), useCache=False), repeat)}
+    stages["inject"] = {"seconds": timeStage(
+        lambda: stt.addM104("CT_Temp.gcode", "CT_Out.gcode", tfirst, tstep), repeat)}
+
+    for size in sizes:
+        stt.writeSyntheticGCode("CT_Bench.gcode", size=size)
+        mb = os.path.getsize("CT_Bench.gcode") / 1024 / 1024
+        seconds = timeStage(lambda: stt.addM104("CT_Bench.gcode", "CT_Bench-out.gcode", tfirst, tstep), repeat)
+        stages["inject_{}MB".format(int(round(mb)))] = {"seconds": seconds, "mb_per_s": mb / seconds}
+        os.remove("CT_Bench.gcode")
+        os.remove("CT_Bench-out.gcode")
+    return(stages)
+
+# Compare results against a baseline. Returns the list of regressed stages.
+# Differences below minDelta seconds are ignored (timer noise of fast stages).
+def compareBaseline(stages, baseline, threshold, minDelta):
+    regressions = []
+    print("{:<20} {:>12} {:>12} {:>8}".format("Stage", "Baseline [s]", "Now [s]", "Change"))
+    for name, result in stages.items():
+        if name not in baseline["stages"]:
+            print("{:<20} {:>12} {:>12.4f} {:>8}".format(name, "-", result["seconds"], "new"))
+            continue
+        ref = baseline["stages"][name]["seconds"]
+        change = (result["seconds"] - ref) / ref if ref > 0 else 0.0
+        flag = ""
+        if change > threshold and result["seconds"] - ref > minDelta:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print("{:<20} {:>12.4f} {:>12.4f} {:>+7.1f}%{}".format(name, ref, result["seconds"], change * 100, flag))
+    return(regressions)
+
+###
+# MAIN
+###
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the stages of SmartTemperatureTower.py with stand-in tools.")
+    parser.add_argument('--sizes', default="1M,100M", help="Sizes of the synthetic G-code for the injector (e.g. 1M,100M,2G)")
+    parser.add_argument('--repeat', type=int, default=3, help="Runs per stage (the median is used)")
+    parser.add_argument('--latency', type=float, default=0.0, help="Startup latency of the stand-in tools in seconds")
+    parser.add_argument('--output', default=os.path.join(benchDir, "results.json"), help="Result file (JSON)")
+    parser.add_argument('--baseline', default=os.path.join(benchDir, "baseline.json"), help="Baseline file (JSON)")
+    parser.add_argument('--save-baseline', dest='saveBaseline', action='store_true', help="Store the results as new baseline")
+    parser.add_argument('--threshold', type=float, default=0.2, help="Allowed slowdown against the baseline (0.2 = 20%%)")
+    parser.add_argument('--min-delta', dest='minDelta', type=float, default=0.01, help="Ignore slowdowns below this many seconds")
+    parser.add_argument('--openscad', help="Use this OpenSCAD executable instead of the stand-in tool")
+    parser.add_argument('--prusa-slicer', dest='prusaSlicer', help="Use this Prusa-Slicer executable instead of the stand-in tool")
+    args = parser.parse_args(argv)
+
+    os.environ["STT_STUB_LATENCY"] = str(args.latency)
+    sizes = [parseSize(size) for size in args.sizes.split(",") if size]
+    cwd = os.getcwd()
+    workDir = tempfile.mkdtemp(prefix="STT_Bench_")
+    try:
+        createWorkspace(workDir, args.openscad, args.prusaSlicer)
+        os.chdir(workDir)
+        differences = compareEngines(190, 240, 5)
+        if differences:
+            print("ERROR: The G-code of --engine native differs from --engine openscad:")
+            for difference in differences[:20]:
+                print("  " + difference)
+            return(1)
+        print("OK: --engine native and --engine openscad slice to the same layers.")
+        stages = runStages(sizes, args.repeat, 190, 240, 5)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workDir, ignore_errors=True)
+
+    results = {
+        "meta": {
+            "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "numpy": stt.numpy is not None,
+            "latency": args.latency,
+            "repeat": args.repeat
+        },
+        "stages": stages
+    }
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=1)
+    print()
+    print("Results written to " + args.output)
+    print()
+
+    if args.saveBaseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=1)
+        print("Baseline written to " + args.baseline)
+        return(0)
+    if not os.path.isfile(args.baseline):
+        for name, result in stages.items():
+            print("{:<20} {:>12.4f} s".format(name, result["seconds"]))
+        print()
+        print("No baseline found, use --save-baseline to store one.")
+        return(0)
+
+    with open(args.baseline, 'r') as f:
+        baseline = json.load(f)
+    regressions = compareBaseline(stages, baseline, args.threshold, args.minDelta)
+    print()
+    if regressions:
+        print("ERROR: {} stage(s) slower than the baseline by more than {:.0f}%: {}".format(
+              len(regressions), args.threshold * 100, ", ".join(regressions)))
+        return(1)
+    print("OK: No regressions.")
+    return(0)
+
+if __name__ == "__main__":
+    sys.exit(main())
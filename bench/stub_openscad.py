@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+
+# Stand-in for OpenSCAD to benchmark SmartTemperatureTower.py without the real tool.
+# It understands what SmartTemperatureTower.py uses:
+#
+#   stub_openscad.py --version
+#   stub_openscad.py [--export-format binstl] -o OUT.stl [-D name=value ...] parameterized_STTMod.scad
+#
+# Instead of a CGAL render, the floors of SmartTemperatureTower_TempFloor.stl are
+# stacked (without labels) and written as ASCII STL, like OpenSCAD does, or
+# binary STL with "--export-format binstl". The stand and the floors are moved
+# by the same offsets as in parameterized_STTMod.scad and scaled by floor_height
+# and xy_scale, the "quick" variant is not cut.
+# The environment variable STT_STUB_LATENCY adds a delay in seconds.
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import SmartTemperatureTower as stt
+
+# Offsets of translate() in parameterized_STTMod.scad
+standOffset = (-9, -9)
+floorOffset = (-113, -100)
+
+# Move the vertices of a mesh by (dx, dy), then scale them by sxy in X/Y and sz in Z
+def placeMesh(mesh, dx, dy, sxy, sz):
+    scale = [1, 1, 1] + [sxy, sxy, sz] * 3
+    offset = [0, 0, 0] + [dx * sxy, dy * sxy, 0] * 3
+    if stt.numpy is not None:
+        return(mesh * stt.numpy.array(scale, dtype=mesh.dtype) + stt.numpy.array(offset, dtype=mesh.dtype))
+    return(stt.array('f', [v * scale[i % 12] + offset[i % 12] for i, v in enumerate(mesh)]))
+
+def main(argv):
+    if "--version" in argv:
+        sys.stderr.write("OpenSCAD version 2019.05 (stub)\n")
+        return(0)
+    time.sleep(float(os.environ.get("STT_STUB_LATENCY", "0")))
+
+    params = {"tfirst": "205", "tlast": "195", "tstep": "2", "part": "\"tower\"",
+              "floor_height": "10", "xy_scale": "1"}
+    outFile = None
+    exportFormat = "asciistl"
+    i = 0
+    while i < len(argv):
+        if argv[i] == "-o":
+            outFile = argv[i + 1]
+            i += 1
+        elif argv[i] == "--export-format":
+            exportFormat = argv[i + 1]
+            i += 1
+        elif argv[i] == "-D":
+            name, value = argv[i + 1].split("=", 1)
+            params[name] = value
+            i += 1
+        i += 1
+    if outFile is None:
+        sys.stderr.write("ERROR: no output file\n")
+        return(1)
+
+    part = params["part"].strip("\"")
+    floorHeight = float(params["floor_height"])
+    xyScale = float(params["xy_scale"])
+    stand = placeMesh(stt.loadSTLMesh(stt.requiredFiles["stlStand"]), *standOffset, xyScale, 1)
+    floor = placeMesh(stt.loadSTLMesh(stt.requiredFiles["stlFloor"]), *floorOffset, xyScale, floorHeight / 10)
+    if part == "stand":
+        parts = [(stand, 0)]
+    elif part in ("floor", "firstfloor"):
+        parts = [(floor, 0)]
+    elif part == "base":
+        parts = [(stand, 0), (floor, 0)]
+    else:
+        temps = stt.getFloorTemps(int(params["tfirst"]), int(params["tlast"]), int(params["tstep"]))
+        parts = [(stand, 0)] + [(floor, floorHeight * i) for i in range(len(temps))]
+    if exportFormat == "binstl":
+        stt.writeSTLMesh(stt.joinMeshes(parts), outFile)
+    else:
+        stt.writeSTLMeshASCII(stt.joinMeshes(parts), outFile)
+    return(0)
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+
+# Stand-in for the upload API of OctoPrint / Moonraker (POST /api/files/local),
+# to try --upload of SmartTemperatureTower.py without a printer host.
+# It accepts multipart/form-data uploads (chunked or with Content-Length),
+# stores the file part in a directory and logs each upload, including whether
+# the connection was reused and whether a print was requested.
+#
+# example Usage:
+#           python bench/stub_printhost.py --port 8080 --dir uploads
+#           python SmartTemperatureTower.py -s 190 -e 240 -t 5 --upload http://127.0.0.1:8080
+#
+# The environment variable STT_STUB_LATENCY adds a delay in seconds before each response.
+
+import argparse
+import http.server
+import json
+import os
+import re
+import sys
+import time
+
+### Functions
+
+# Read a request body with chunked transfer encoding
+def readChunked(rfile):
+    data = []
+    while True:
+        size = int(rfile.readline().split(b";")[0].strip(), 16)
+        if size == 0:
+            while rfile.readline() not in (b"\r\n", b"\n", b""):
+                pass
+            return(b"".join(data))
+        data.append(rfile.read(size))
+        rfile.readline()
+
+# Parse a multipart/form-data body, returns {name: (filename, data)}
+def parseForm(contentType, body):
+    boundary = re.search(r'boundary="?([^";]+)"?', contentType).group(1).encode()
+    fields = {}
+    for part in body.split(b"--" + boundary)[1:-1]:
+        headers, data = part[2:].split(b"\r\n\r\n", 1)
+        disposition = headers.decode("utf-8", "replace")
+        name = re.search(r'name="([^"]*)"', disposition).group(1)
+        filename = re.search(r'filename="([^"]*)"', disposition)
+        fields[name] = (filename.group(1) if filename else None, data[:-2])
+    return(fields)
+
+class PrintHostHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        self.requests = 0
+
+    def sendJSON(self, status, result):
+        body = json.dumps(result).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        self.requests += 1
+        start = time.perf_counter()
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            body = readChunked(self.rfile)
+        else:
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        seconds = time.perf_counter() - start
+        time.sleep(float(os.environ.get("STT_STUB_LATENCY", "0")))
+
+        if self.path.split("?")[0] != "/api/files/local":
+            self.sendJSON(404, {"error": "Unknown path " + self.path})
+            return
+        if self.server.apiKey != None and self.headers.get("X-Api-Key") != self.server.apiKey:
+            self.sendJSON(403, {"error": "Invalid API key"})
+            return
+        fields = parseForm(self.headers.get("Content-Type", ""), body)
+        if "file" not in fields or not fields["file"][0]:
+            self.sendJSON(400, {"error": "No file included"})
+            return
+        filename, data = fields["file"]
+        filename = os.path.basename(filename)
+        with open(os.path.join(self.server.directory, filename), 'wb') as f:
+            f.write(data)
+        startPrint = "print" in fields and fields["print"][1].strip().lower() == b"true"
+        sys.stderr.write("{} {} bytes in {:.2f} s, connection {} request {}{}\n".format(
+                         filename, len(data), seconds, self.client_address[1], self.requests,
+                         ", print started" if startPrint else ""))
+        self.sendJSON(201, {"done": True, "files": {"local": {"name": filename, "origin": "local"}},
+                            "print_started": startPrint})
+
+    def log_message(self, format, *args):
+        pass
+
+###
+# MAIN
+###
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Stand-in for the upload API of OctoPrint / Moonraker.")
+    parser.add_argument('--host', default="127.0.0.1", help="Address to listen on")
+    parser.add_argument('--port', type=int, default=8080, help="Port to listen on")
+    parser.add_argument('--dir', default="uploads", help="Directory for the uploaded files")
+    parser.add_argument('--api-key', dest='apiKey', help="Require this API key (X-Api-Key)")
+    args = parser.parse_args(argv)
+
+    os.makedirs(args.dir, exist_ok=True)
+    server = http.server.ThreadingHTTPServer((args.host, args.port), PrintHostHandler)
+    server.directory = args.dir
+    server.apiKey = args.apiKey
+    sys.stderr.write("Listening on http://{}:{}, uploads go to {}\n".format(args.host, server.server_address[1], args.dir))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return(0)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+
+# Stand-in for Prusa-Slicer to benchmark SmartTemperatureTower.py without the real tool.
+# It understands what SmartTemperatureTower.py uses:
+#
+#   stub_prusaslicer.py --help
+#   stub_prusaslicer.py --info FILE.stl
+#   stub_prusaslicer.py [options] --export-gcode --output OUT.gcode FILE.stl [FILE.stl ...]
+#
+# Exported G-code is synthetic: 0.2 mm layers (or layer_height/first_layer_height
+# of the loaded profiles or the command line) up to the height of the STL, each
+# starting with the ;CT_LAYER marker given by --before-layer-gcode. Several STL
+# files are printed as labeled objects, layer by layer or with --complete-objects
+# one after another. Like Prusa-Slicer, the G-code is written to "OUT.gcode.tmp",
+# post-processed (an M73 progress line is inserted at each layer change, written
+# to "OUT.gcode.tmp.postprocess", which replaces the .tmp file) and then renamed
+# to the output file.
+# The environment variable STT_STUB_LATENCY adds a delay in seconds.
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import SmartTemperatureTower as stt
+
+# Write synthetic G-code for several objects with Prusa-Slicer's object labels
+def writePlateGCode(filename, stlFiles, layerHeight, firstLayer, sequential):
+    moves = int(os.environ.get("STT_STUB_MOVES", "400"))
+    objects = []
+    for i, stlFile in enumerate(stlFiles):
+        zmin, zmax = stt.getSTLZRange(stlFile)
+        name = os.path.basename(stlFile)
+        layers = [round(firstLayer + layerHeight * n, 4)
+                  for n in range(int(round((zmax - zmin - firstLayer) / layerHeight)) + 1)]
+        objects.append((b"%s id:%d copy 0" % (name.encode(), i), layers))
+    if sequential:
+        plan = [[(label, z)] for label, layers in objects for z in layers]
+    else:
+        heights = sorted(set(z for label, layers in objects for z in layers))
+        plan = [[(label, z) for label, layers in objects if z in layers] for z in heights]
+    body = b"".join(b"G1 X%.3f Y%.3f E%.5f F1800\n" % (100 + (i % 40), 100 + (i * 7) % 30, 0.04)
+                    for i in range(moves))
+    with open(filename, 'wb') as f:
+        f.write(b"; synthetic G-code\nG21\nG90\nM83\nM104 S215\nG28\n")
+        for n, layer in enumerate(plan):
+            z = layer[0][1]
+            f.write(b";LAYER_CHANGE\n;Z:%.2f\n;CT_LAYER:%d\nG1 Z%.3f F7800\n" % (z, n, z))
+            for label, z in layer:
+                f.write(b"; printing object %s\n" % label)
+                f.write(body)
+                f.write(b"; stop printing object %s\n" % label)
+        f.write(b"M104 S0\nM84\n")
+
+# Post-process the G-code like Prusa-Slicer and move it to outFile
+def finishGCode(tmpFile, outFile):
+    with open(tmpFile, 'rb') as f:
+        layers = sum(line.startswith(b";LAYER_CHANGE") for line in f)
+    layer = 0
+    with open(tmpFile, 'rb') as inp, open(tmpFile + ".postprocess", 'wb') as out:
+        for line in inp:
+            if line.startswith(b";LAYER_CHANGE"):
+                out.write(b"M73 P%d\n" % (layer * 100 // max(layers, 1)))
+                layer += 1
+            out.write(line)
+    os.replace(tmpFile + ".postprocess", tmpFile)
+    os.replace(tmpFile, outFile)
+
+def main(argv):
+    if "--help" in argv:
+        print("PrusaSlicer-2.3.1 (stub) based on Slic3r")
+        return(0)
+    time.sleep(float(os.environ.get("STT_STUB_LATENCY", "0")))
+
+    stlFile = argv[-1]
+    if "--info" in argv:
+        zmin, zmax = stt.getSTLZRange(stlFile)
+        print("[" + os.path.basename(stlFile) + "]")
+        print("size_z = %f" % (zmax - zmin))
+        return(0)
+    if "--export-gcode" not in argv or "--output" not in argv:
+        sys.stderr.write("ERROR: unsupported arguments\n")
+        return(1)
+
+    outFile = argv[argv.index("--output") + 1]
+    tmpFile = outFile + ".tmp"
+    # Options on the command line override the loaded profiles
+    values = {"layer_height": "0.2"}
+    for i, arg in enumerate(argv[:-1]):
+        if arg == "--load":
+            values.update(stt.readIniValues(argv[i + 1]))
+    for i, arg in enumerate(argv[:-1]):
+        if arg in ("--layer-height", "--first-layer-height"):
+            values[arg[2:].replace("-", "_")] = argv[i + 1]
+    layerHeight = float(values["layer_height"])
+    firstLayer = values.get("first_layer_height", values["layer_height"])
+    if firstLayer.endswith("%"):
+        firstLayer = layerHeight * float(firstLayer[:-1]) / 100
+    firstLayer = float(firstLayer)
+    stlFiles = []
+    while len(stlFiles) < len(argv) and argv[-1 - len(stlFiles)].lower().endswith(".stl"):
+        stlFiles.insert(0, argv[-1 - len(stlFiles)])
+    if len(stlFiles) > 1:
+        writePlateGCode(tmpFile, stlFiles, layerHeight, firstLayer, "--complete-objects" in argv)
+        finishGCode(tmpFile, outFile)
+        return(0)
+    zmin, zmax = stt.getSTLZRange(stlFile)
+    stt.writeSyntheticGCode(tmpFile, layers=int(round((zmax - zmin - firstLayer) / layerHeight)) + 1,
+                            layerHeight=layerHeight, firstLayerHeight=firstLayer,
+                            movesPerLayer=int(os.environ.get("STT_STUB_MOVES", "400")))
+    finishGCode(tmpFile, outFile)
+    return(0)
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -1,5 +1,8 @@
 #!/usr/bin/env python
 
+# DEPRECATED: This Linux copy is no longer maintained. The SmartTemperatureTower.py
+# in the main directory runs on Linux as well, set the paths in its ini file.
+#
 # This script extracts settings from the gcode comments shown below.
 # The gcode comments should be added to the filament settings start G-Code in Prusa-Slicer
 # Each layer should begin with